@@ -1,67 +1,592 @@
+import hashlib
+import functools
+import hmac
+import importlib
 import json
 import os
-from typing import Dict, Any
-import requests
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
-
-def get_user_settings(telegram_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM telegram_users WHERE telegram_id = %s", (telegram_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
-    return dict(user) if user else None
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse
 
-def generate_photo_prompt(nsfw_enabled: bool, spicy_level: int, style_variation: int = 1) -> str:
+class LazyModule:
     """
-    Генерирует промпт для FLUX с учетом настроек пользователя
+    Прокси модуля, который импортируется при первом обращении к атрибуту.
+    Health-check и OPTIONS не платят за загрузку psycopg2 и requests на холодном старте.
+    """
+
+    def __init__(self, name: str, *submodules: str):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                for submodule in self._submodules:
+                    importlib.import_module(f"{self._name}.{submodule}")
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._module or self._load(), attr)
+
+psycopg2 = LazyModule('psycopg2', 'extensions', 'extras', 'pool')
+requests = LazyModule('requests', 'adapters')
+urllib3 = LazyModule('urllib3', 'exceptions')
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.05'))
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+
+_trace_local = threading.local()
+
+class Trace:
+    """
+    Тайминги стадий одного вызова: суммарное время и число входов по каждой стадии,
+    число SQL-запросов и статусы исходящих HTTP-вызовов
+    """
+
+    def __init__(self, name: str, sampled: bool):
+        self.name = name
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.db_queries = 0
+        self.http = {}
+        self.fields = {}
+
+    def add_stage(self, stage: str, elapsed_ms: float):
+        total, calls = self.stages.get(stage, (0.0, 0))
+        self.stages[stage] = (total + elapsed_ms, calls + 1)
+
+    def server_timing(self) -> str:
+        parts = [f"{stage};dur={total:.1f}" for stage, (total, _) in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(parts)
+
+    def log_line(self, **fields) -> str:
+        return json.dumps({
+            'trace': self.name,
+            **fields,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'stages_ms': {stage: round(total, 1) for stage, (total, _) in self.stages.items()},
+            'stage_calls': {stage: calls for stage, (_, calls) in self.stages.items()},
+            'db_queries': self.db_queries,
+            'http': self.http
+        }, ensure_ascii=False)
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_trace_local, 'trace', None)
+
+@contextmanager
+def trace_invocation(name: str, force: bool = False):
+    """
+    Открывает трассировку вызова с вероятностью TRACE_SAMPLE_RATE (или всегда при force)
+    и пишет по её итогам одну JSON-строку в лог. Вне выборки отдаёт None и ничего не стоит.
+    """
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled and not force:
+        yield None
+        return
+    trace = Trace(name, sampled)
+    previous, _trace_local.trace = current_trace(), trace
+    try:
+        yield trace
+    finally:
+        _trace_local.trace = previous
+        if sampled:
+            print(trace.log_line(**trace.fields))
+
+def traced(stage: str):
+    """
+    Декоратор стадии: если вызов трассируется, добавляет время функции к стадии stage
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                trace.add_stage(stage, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorate
+
+def traced_handler(name: str):
+    """
+    Трассирует handler целиком: статус ответа попадает в лог, а при TRACE_SERVER_TIMING
+    тайминги стадий возвращаются заголовком Server-Timing
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            with trace_invocation(name, force=TRACE_SERVER_TIMING) as trace:
+                response = fn(event, context)
+                if trace is not None:
+                    trace.fields = {
+                        'method': event.get('httpMethod', 'POST'),
+                        'action': (event.get('queryStringParameters') or {}).get('action'),
+                        'status': response.get('statusCode')
+                    }
+                    if TRACE_SERVER_TIMING:
+                        response['headers'] = {**(response.get('headers') or {}), 'Server-Timing': trace.server_timing()}
+                return response
+        return wrapper
+    return decorate
+
+@functools.lru_cache(maxsize=None)
+def traced_connection_class():
+    """
+    Класс соединения, курсоры которого считают execute в текущую трассировку.
+    Создаётся при первом подключении к БД, чтобы не импортировать psycopg2 заранее.
+    """
+    class TracedConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+            return super().cursor(*args, cursor_factory=_traced_cursor_class(base), **kwargs)
+    return TracedConnection
+
+_traced_cursor_classes = {}
+
+def _traced_cursor_class(base):
+    cls = _traced_cursor_classes.get(base)
+    if cls is None:
+        def execute(self, query, vars=None):
+            trace = current_trace()
+            if trace is not None:
+                trace.db_queries += 1
+            return base.execute(self, query, vars)
+        cls = _traced_cursor_classes[base] = type(f"Traced{base.__name__}", (base,), {'execute': execute})
+    return cls
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """
+    Пул соединений с Postgres, живущий между тёплыми вызовами функции.
+    Простаивавшие соединения проверяются при выдаче и пересоздаются, если БД их закрыла.
+    """
+
+    def __init__(self, max_size: int, timeout: float, healthcheck_after: float):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._counters = {'checkouts': 0, 'connects': 0, 'waits': 0, 'timeouts': 0, 'reconnects': 0, 'discarded': 0}
+        self.connection_factory = None
+
+    def _connect(self):
+        conn = psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=self.connection_factory or traced_connection_class())
+        conn.autocommit = True
+        return conn
+
+    def _is_alive(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if idle_for < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        conn, last_used = None, 0.0
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise psycopg2.pool.PoolError('connection pool exhausted')
+                if not waited:
+                    self._counters['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._counters['checkouts'] += 1
+        
+        try:
+            if conn is None:
+                conn = self._connect()
+                self._counters['connects'] += 1
+            elif not self._is_alive(conn, time.monotonic() - last_used):
+                self._close_quietly(conn)
+                conn = self._connect()
+                self._counters['reconnects'] += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard: bool = False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed:
+                self._size -= 1
+                self._counters['discarded'] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                **self._counters
+            }
+
+_db_pool = ConnectionPool(DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_AFTER)
+
+@contextmanager
+def db_connection():
+    conn = _db_pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        _db_pool.putconn(conn, discard=discard)
+
+def get_db_pool_stats() -> Dict[str, Any]:
+    return _db_pool.stats()
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1000'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))
+
+class UserCache:
+    """
+    LRU-кэш строк telegram_users с ограниченным временем жизни записи.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._items.get(telegram_id)
+            if item is None:
+                self._counters['misses'] += 1
+                return None
+            user, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._items[telegram_id]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._items.move_to_end(telegram_id)
+            self._counters['hits'] += 1
+            return dict(user)
+
+    def put(self, telegram_id: int, user: Dict[str, Any]):
+        with self._lock:
+            self._items[telegram_id] = (dict(user), time.monotonic() + self.ttl)
+            self._items.move_to_end(telegram_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._items.pop(telegram_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'size': len(self._items), 'max_size': self.max_size, **self._counters}
+
+_user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    return _user_cache.stats()
+
+@traced('user')
+def get_user_settings(telegram_id: int, expected: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Настройки пользователя из кэша. Если вызывающий передал свои значения полей
+    и они расходятся с кэшем (например, после /nsfw), строка перечитывается из БД.
     """
+    cached = _user_cache.get(telegram_id)
+    if cached is not None and all(cached.get(key) == value for key, value in (expected or {}).items()):
+        return cached
+    
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT * FROM telegram_users WHERE telegram_id = %s", (telegram_id,))
+        user = cur.fetchone()
+        cur.close()
     
-    base_character = "Beautiful 25-year-old woman named Alina, long dark brown hair, blue eyes, attractive face, natural makeup, realistic photo, high quality, professional photography, "
+    if not user:
+        _user_cache.invalidate(telegram_id)
+        return None
     
-    casual_outfits = [
+    user = dict(user)
+    _user_cache.put(telegram_id, user)
+    return user
+
+HTTP_ENDPOINTS = {
+    'telegram': {'timeout': (3.05, 30), 'retries': 2, 'idempotent': False},
+    'openai_images': {'timeout': (3.05, 60), 'retries': 1, 'idempotent': True},
+    'image_download': {'timeout': (3.05, 30), 'retries': 1, 'idempotent': True},
+    'telegram_upload': {'timeout': (3.05, 60), 'retries': 0, 'idempotent': False},
+}
+HTTP_MAX_RETRY_AFTER = float(os.environ.get('HTTP_MAX_RETRY_AFTER', '5'))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', '0.3'))
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    """
+    Общая keep-alive сессия, создаётся при первом исходящем запросе
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+                session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+                _http_session = session
+    return _http_session
+
+_http_stats_lock = threading.Lock()
+_http_stats = {}
+
+def _record_http_call(host: str, started: float, status: Optional[int], retried: bool):
+    elapsed_ms = (time.monotonic() - started) * 1000
+    trace = current_trace()
+    if trace is not None:
+        key = f"{host} {status if status is not None else 'exception'}"
+        trace.http[key] = trace.http.get(key, 0) + 1
+    with _http_stats_lock:
+        stats = _http_stats.get(host)
+        if stats is None:
+            stats = _http_stats[host] = {
+                'requests': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                'statuses': {}, 'recent_ms': deque(maxlen=256)
+            }
+        stats['requests'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats['recent_ms'].append(elapsed_ms)
+        key = str(status) if status is not None else 'exception'
+        stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+        if status is None or status == 429 or status >= 500:
+            stats['errors'] += 1
+        if retried:
+            stats['retries'] += 1
+
+def _retry_delay(response: Optional['requests.Response'], attempt: int) -> float:
+    if response is not None:
+        retry_after = None
+        try:
+            retry_after = response.json().get('parameters', {}).get('retry_after')
+        except ValueError:
+            pass
+        if retry_after is None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return HTTP_BACKOFF_BASE * (2 ** attempt) * (1 + random.random() / 2)
+
+def _request_not_sent(error: 'requests.RequestException') -> bool:
+    """
+    Соединение не установилось (таймаут подключения, отказ, DNS): запрос до сервера не дошёл
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def http_request(method: str, endpoint: str, url: str, **kwargs) -> 'requests.Response':
+    """
+    Запрос через общую keep-alive сессию с таймаутами и повторами по эндпоинту.
+    Повторяются 429 и ошибки установки соединения - запрос точно не обработан. Обрыв
+    после отправки и 5xx повторяются только для idempotent эндпоинтов, иначе фото
+    могло бы прийти пользователю дважды.
+    """
+    config = HTTP_ENDPOINTS[endpoint]
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        try:
+            response = http_session().request(method, url, timeout=config['timeout'], **kwargs)
+        except requests.RequestException as e:
+            _record_http_call(host, started, None, attempt > 0)
+            if not (_request_not_sent(e) or config['idempotent'] and isinstance(e, requests.ConnectionError)):
+                raise
+            if attempt >= config['retries']:
+                raise
+            time.sleep(_retry_delay(None, attempt))
+            attempt += 1
+            continue
+        
+        _record_http_call(host, started, response.status_code, attempt > 0)
+        retryable = response.status_code == 429 or config['idempotent'] and response.status_code >= 500
+        if retryable and attempt < config['retries']:
+            delay = _retry_delay(response, attempt)
+            if delay <= HTTP_MAX_RETRY_AFTER:
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+        return response
+
+def http_post(endpoint: str, url: str, **kwargs) -> 'requests.Response':
+    return http_request('POST', endpoint, url, **kwargs)
+
+def get_http_stats() -> Dict[str, Any]:
+    with _http_stats_lock:
+        result = {}
+        for host, stats in _http_stats.items():
+            recent = sorted(stats['recent_ms'])
+            result[host] = {
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'retries': stats['retries'],
+                'avg_ms': round(stats['total_ms'] / stats['requests'], 1),
+                'p50_ms': round(recent[len(recent) // 2], 1),
+                'p95_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1),
+                'max_ms': round(stats['max_ms'], 1),
+                'statuses': dict(stats['statuses'])
+            }
+        return result
+
+PHOTO_TIERS = ('casual', 'medium', 'spicy')
+PHOTO_STYLE_VARIATIONS = 5
+
+def photo_tier(nsfw_enabled: bool, spicy_level: int) -> str:
+    if not nsfw_enabled or spicy_level < 30:
+        return 'casual'
+    elif spicy_level < 60:
+        return 'medium'
+    return 'spicy'
+
+def photo_bucket(nsfw_enabled: bool, spicy_level: int, style_variation: int) -> tuple:
+    return photo_tier(nsfw_enabled, spicy_level), (style_variation - 1) % PHOTO_STYLE_VARIATIONS + 1
+
+def generate_photo_prompt(nsfw_enabled: bool, spicy_level: int, style_variation: int = 1) -> str:
+    """
+    Генерирует промпт для FLUX с учетом настроек пользователя
+    """
+    return build_photo_prompt(photo_tier(nsfw_enabled, spicy_level), style_variation)
+
+PHOTO_BASE_CHARACTER = "Beautiful 25-year-old woman named Alina, long dark brown hair, blue eyes, attractive face, natural makeup, realistic photo, high quality, professional photography, "
+PHOTO_QUALITY_TAGS = "4K resolution, sharp focus, bokeh background, instagram aesthetic, cinematic lighting"
+
+PHOTO_OUTFITS = {
+    'casual': (
         "wearing casual jeans and white t-shirt, outdoor park setting, natural daylight, candid pose",
         "in cozy oversized sweater and leggings, home interior, soft window light, relaxed mood",
         "wearing elegant summer dress, city street background, golden hour lighting, walking pose",
         "in sporty outfit, gym or outdoor fitness setting, energetic pose, healthy lifestyle",
         "wearing business casual blazer and pants, office environment, confident professional look"
-    ]
-    
-    medium_outfits = [
+    ),
+    'medium': (
         "wearing elegant black cocktail dress, restaurant or bar setting, evening atmosphere, sophisticated look",
         "in tight jeans and crop top, rooftop terrace, sunset lighting, casual confidence",
         "wearing stylish swimsuit on beach, ocean background, summer vibes, vacation mood",
         "in short skirt and fitted top, nightclub interior, party atmosphere, dancing pose",
         "wearing silk robe, luxury bedroom, soft intimate lighting, morning mood"
-    ]
-    
-    spicy_outfits = [
+    ),
+    'spicy': (
         "wearing beautiful lace lingerie, bedroom setting, sensual lighting, intimate atmosphere, artistic boudoir photography",
         "in elegant bikini, luxury pool background, seductive pose, vacation luxury mood",
         "wearing satin nightwear, bed with silk sheets, soft romantic lighting, intimate mood",
         "in revealing elegant dress, upscale lounge, dim lighting, confident seductive pose",
         "artistic implied nude style, wrapped in silk fabric, studio lighting, artistic photography"
-    ]
-    
-    if not nsfw_enabled or spicy_level < 30:
-        outfit_list = casual_outfits
-    elif spicy_level < 60:
-        outfit_list = medium_outfits
-    else:
-        outfit_list = spicy_outfits
-    
-    outfit_index = (style_variation - 1) % len(outfit_list)
-    outfit = outfit_list[outfit_index]
-    
-    quality_tags = "4K resolution, sharp focus, bokeh background, instagram aesthetic, cinematic lighting"
-    
-    return f"{base_character}{outfit}, {quality_tags}"
+    )
+}
+
+PHOTO_PROMPTS = {
+    tier: tuple(f"{PHOTO_BASE_CHARACTER}{outfit}, {PHOTO_QUALITY_TAGS}" for outfit in outfits)
+    for tier, outfits in PHOTO_OUTFITS.items()
+}
+
+def build_photo_prompt(tier: str, style_variation: int) -> str:
+    prompts = PHOTO_PROMPTS[tier]
+    return prompts[(style_variation - 1) % len(prompts)]
+
+MOOD_EMOJIS = {
+    'friendly': '😊💕',
+    'flirty': '😏💋',
+    'playful': '😄✨',
+    'spicy': '🔥😈'
+}
+
+CAPTION_TEMPLATES = (
+    "Вот моё фото для тебя {emoji}",
+    "Специально для тебя {emoji}",
+    "Как тебе? {emoji}",
+    "Надеюсь понравится {emoji}",
+)
+
+PHOTO_CAPTIONS = {
+    mode: tuple(template.format(emoji=emoji) for template in CAPTION_TEMPLATES)
+    for mode, emoji in MOOD_EMOJIS.items()
+}
+DEFAULT_PHOTO_CAPTIONS = tuple(template.format(emoji='😊') for template in CAPTION_TEMPLATES)
+
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+PLACEHOLDER_IMAGE_URL = "https://via.placeholder.com/1024x1024.png"
+IMAGE_GENERATION_PARAMS = "dall-e-3|1024x1024|hd"
 
+@traced('image_generation')
 def generate_image_flux(prompt: str) -> str:
     """
     Генерирует изображение через внешний API (заглушка для FLUX)
@@ -70,11 +595,12 @@ def generate_image_flux(prompt: str) -> str:
     
     api_key = os.environ.get('OPENAI_API_KEY')
     if not api_key:
-        return "https://via.placeholder.com/1024x1024.png?text=AI+Photo+Generation"
+        return f"{PLACEHOLDER_IMAGE_URL}?text=AI+Photo+Generation"
     
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/images/generations",
+        response = http_post(
+            'openai_images',
+            f"{OPENAI_BASE_URL}/images/generations",
             headers={
                 "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json"
@@ -85,34 +611,839 @@ def generate_image_flux(prompt: str) -> str:
                 "n": 1,
                 "size": "1024x1024",
                 "quality": "hd"
-            },
-            timeout=60
+            }
         )
         
         if response.status_code == 200:
             data = response.json()
             return data['data'][0]['url']
         else:
-            return "https://via.placeholder.com/1024x1024.png?text=Generation+Error"
+            return f"{PLACEHOLDER_IMAGE_URL}?text=Generation+Error"
             
-    except Exception as e:
-        return "https://via.placeholder.com/1024x1024.png?text=API+Error"
+    except Exception:
+        return f"{PLACEHOLDER_IMAGE_URL}?text=API+Error"
 
-def send_telegram_photo(chat_id: int, photo_url: str, caption: str = ""):
+@traced('telegram_send')
+def send_telegram_message(chat_id: int, text: str):
     bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
     if not bot_token:
-        return False
+        return
+    
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/sendMessage"
+    http_post('telegram', url, json={
+        'chat_id': chat_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    })
+
+@traced('telegram_photo')
+def send_telegram_photo(chat_id: int, photo: str, caption: str = "") -> Optional[Dict[str, Any]]:
+    """
+    Отправляет фото по URL или по file_id. Возвращает отправленное сообщение Telegram или None.
+    """
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return None
     
-    url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
-    response = requests.post(url, json={
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/sendPhoto"
+    response = http_post('telegram', url, json={
         'chat_id': chat_id,
-        'photo': photo_url,
+        'photo': photo,
         'caption': caption,
         'parse_mode': 'HTML'
     })
     
-    return response.status_code == 200
+    if response.status_code != 200:
+        return None
+    return response.json().get('result')
+
+def largest_photo_file_id(message: Optional[Dict[str, Any]]) -> Optional[str]:
+    sizes = (message or {}).get('photo') or []
+    return sizes[-1]['file_id'] if sizes else None
+
+PHOTO_STREAM_UPLOAD = os.environ.get('PHOTO_STREAM_UPLOAD', '1').lower() in ('1', 'true', 'yes')
+PHOTO_CHUNK_SIZE = int(os.environ.get('PHOTO_CHUNK_SIZE', str(64 * 1024)))
+PHOTO_BLOB_STORE = os.environ.get('PHOTO_BLOB_STORE', '')
+PHOTO_BLOB_DIR = os.environ.get('PHOTO_BLOB_DIR', '/tmp/photo-blobs')
+PHOTO_BLOB_BASE_URL = os.environ.get('PHOTO_BLOB_BASE_URL', '').rstrip('/')
+PHOTO_PREVIEW_SIZE = int(os.environ.get('PHOTO_PREVIEW_SIZE', '0'))
+PHOTO_PREVIEW_QUALITY = int(os.environ.get('PHOTO_PREVIEW_QUALITY', '70'))
+IMAGE_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp'}
+
+PIL = LazyModule('PIL', 'Image')
+
+class LocalBlobWriter:
+    """
+    Запись блоба во временный файл: commit() публикует его под ключом, abort() удаляет
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(f"{path}.part", 'wb')
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        os.replace(f"{self.path}.part", self.path)
 
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(f"{self.path}.part")
+        except OSError:
+            pass
+
+class LocalBlobStore:
+    """
+    Хранилище картинок в локальном каталоге. Если каталог раздаётся наружу,
+    PHOTO_BLOB_BASE_URL даёт постоянные публичные ссылки на файлы.
+    """
+
+    def __init__(self, root: str, base_url: str = ''):
+        self.root = root
+        self.base_url = base_url
+
+    @classmethod
+    def from_env(cls) -> 'LocalBlobStore':
+        return cls(PHOTO_BLOB_DIR, PHOTO_BLOB_BASE_URL)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def open_writer(self, key: str) -> LocalBlobWriter:
+        os.makedirs(self.root, exist_ok=True)
+        return LocalBlobWriter(self._path(key))
+
+    def open(self, key: str):
+        return open(self._path(key), 'rb')
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self._path(key))
+
+    def url(self, key: str) -> str:
+        if self.base_url:
+            return f"{self.base_url}/{key}"
+        return f"file://{os.path.abspath(self._path(key))}"
+
+# PHOTO_BLOB_STORE -> фабрика хранилища; другое хранилище (S3 и т.п.) реализует те же
+# open_writer/open/size/url и регистрируется здесь
+BLOB_STORES = {
+    'local': LocalBlobStore.from_env,
+}
+
+_blob_store = BLOB_STORES[PHOTO_BLOB_STORE]() if PHOTO_BLOB_STORE else None
+
+_photo_rehost_stats_lock = threading.Lock()
+_photo_rehost_stats = {
+    'streamed': 0, 'stored': 0, 'fallbacks': 0, 'download_errors': 0, 'bytes': 0,
+    'previews': 0, 'preview_errors': 0
+}
+
+def _count_photo_rehost(key: str, amount: int = 1):
+    with _photo_rehost_stats_lock:
+        _photo_rehost_stats[key] += amount
+
+def get_photo_rehost_stats() -> Dict[str, Any]:
+    with _photo_rehost_stats_lock:
+        return {
+            **_photo_rehost_stats,
+            'stream_upload': PHOTO_STREAM_UPLOAD,
+            'blob_store': PHOTO_BLOB_STORE or None,
+            'chunk_size': PHOTO_CHUNK_SIZE
+        }
+
+class MultipartBody:
+    """
+    Тело multipart/form-data, которое отдаётся по частям: заголовок с полями, файл
+    чанками из итератора и закрывающая граница. Если размер файла известен, у тела есть
+    длина и requests шлёт Content-Length, иначе тело уходит через iter() как chunked.
+    """
+
+    def __init__(self, fields: Dict[str, Any], file_field: str, filename: str, content_type: str, chunks, file_size: Optional[int] = None):
+        boundary = os.urandom(16).hex()
+        parts = [
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n"
+            for name, value in fields.items()
+        ]
+        parts.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{file_field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n"
+        )
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._head = ''.join(parts).encode('utf-8')
+        self._tail = f"\r\n--{boundary}--\r\n".encode('utf-8')
+        self._chunks = chunks
+        self.length = len(self._head) + file_size + len(self._tail) if file_size is not None else None
+
+    def __iter__(self):
+        yield self._head
+        yield from self._chunks
+        yield self._tail
+
+    def __len__(self) -> int:
+        return self.length
+
+@traced('telegram_photo')
+def upload_telegram_photo(chat_id: int, chunks, file_size: Optional[int], content_type: str, caption: str = "") -> Optional[Dict[str, Any]]:
+    """
+    sendPhoto с загрузкой файла из потока чанков. Возвращает сообщение Telegram или None.
+    Повторов нет: поток уже прочитан, повтор делает вызывающий из хранилища или по URL.
+    """
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return None
+    
+    body = MultipartBody(
+        {'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'},
+        'photo', f"photo{IMAGE_EXTENSIONS.get(content_type, '.png')}", content_type, chunks, file_size
+    )
+    try:
+        response = http_post(
+            'telegram_upload',
+            f"{TELEGRAM_API_URL}/bot{bot_token}/sendPhoto",
+            data=body if body.length is not None else iter(body),
+            headers={'Content-Type': body.content_type}
+        )
+    except Exception:
+        return None
+    
+    if response.status_code != 200:
+        return None
+    return response.json().get('result')
+
+def photo_blob_key(image_url: str, content_type: str) -> str:
+    return hashlib.sha256(image_url.encode('utf-8')).hexdigest()[:32] + IMAGE_EXTENSIONS.get(content_type, '.png')
+
+@traced('photo_preview')
+def make_photo_preview(key: str) -> Optional[str]:
+    """
+    Сжатое JPEG-превью сохранённой картинки (нужен Pillow). Возвращает URL превью или None.
+    """
+    preview_key = f"{key.rsplit('.', 1)[0]}.preview.jpg"
+    try:
+        with _blob_store.open(key) as source:
+            image = PIL.Image.open(source)
+            image.draft('RGB', (PHOTO_PREVIEW_SIZE, PHOTO_PREVIEW_SIZE))
+            image = image.convert('RGB')
+            image.thumbnail((PHOTO_PREVIEW_SIZE, PHOTO_PREVIEW_SIZE))
+        writer = _blob_store.open_writer(preview_key)
+        try:
+            image.save(writer.file, 'JPEG', quality=PHOTO_PREVIEW_QUALITY, optimize=True)
+        except Exception:
+            writer.abort()
+            raise
+        writer.commit()
+    except Exception:
+        _count_photo_rehost('preview_errors')
+        return None
+    _count_photo_rehost('previews')
+    return _blob_store.url(preview_key)
+
+@traced('photo_rehost')
+def stream_photo_to_telegram(chat_id: int, image_url: str, caption: str = "") -> Dict[str, Any]:
+    """
+    Качает сгенерированную картинку чанками по PHOTO_CHUNK_SIZE и за один проход пишет её
+    в хранилище и отдаёт в sendPhoto как multipart - целиком в памяти она не лежит.
+    Если загрузка в Telegram не удалась, фото отправляется из хранилища, а без него - по URL.
+    photo_url в ответе - постоянная ссылка хранилища или, если сохранить не удалось, исходный URL.
+    """
+    try:
+        download = http_request('GET', 'image_download', image_url, stream=True)
+    except requests.RequestException:
+        download = None
+    if download is None or download.status_code != 200:
+        _count_photo_rehost('download_errors')
+        if download is not None:
+            download.close()
+        return {'message': send_telegram_photo(chat_id, image_url, caption), 'photo_url': image_url, 'preview_url': None}
+    
+    with download:
+        content_type = download.headers.get('Content-Type', 'image/png').split(';')[0].strip()
+        length = download.headers.get('Content-Length', '')
+        file_size = int(length) if length.isdigit() else None
+        key = photo_blob_key(image_url, content_type)
+        writer = _blob_store.open_writer(key) if _blob_store else None
+        received = {'bytes': 0, 'complete': False}
+        
+        def chunks():
+            for chunk in download.iter_content(PHOTO_CHUNK_SIZE):
+                if writer:
+                    writer.write(chunk)
+                received['bytes'] += len(chunk)
+                yield chunk
+            received['complete'] = True
+        
+        stream = chunks()
+        message = upload_telegram_photo(chat_id, stream, file_size, content_type, caption)
+        if writer:
+            try:
+                for _ in stream:
+                    pass
+            except Exception:
+                pass
+        stored = bool(writer) and received['complete'] and (file_size is None or received['bytes'] == file_size)
+        if stored:
+            writer.commit()
+        elif writer:
+            writer.abort()
+    
+    _count_photo_rehost('streamed')
+    _count_photo_rehost('bytes', received['bytes'])
+    if stored:
+        _count_photo_rehost('stored')
+    
+    if message is None:
+        _count_photo_rehost('fallbacks')
+        if stored:
+            with _blob_store.open(key) as source:
+                message = upload_telegram_photo(chat_id, iter(lambda: source.read(PHOTO_CHUNK_SIZE), b''), _blob_store.size(key), content_type, caption)
+        if message is None:
+            message = send_telegram_photo(chat_id, image_url, caption)
+    
+    return {
+        'message': message,
+        'photo_url': _blob_store.url(key) if stored else image_url,
+        'preview_url': make_photo_preview(key) if stored and PHOTO_PREVIEW_SIZE > 0 else None
+    }
+
+PHOTO_CACHE_VARIANTS = int(os.environ.get('PHOTO_CACHE_VARIANTS', '3'))
+PHOTO_CACHE_MAX_AGE_HOURS = float(os.environ.get('PHOTO_CACHE_MAX_AGE_HOURS', '0'))
+
+_photo_cache_stats_lock = threading.Lock()
+_photo_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'rotations': 0, 'invalid_file_ids': 0}
+
+def _count_photo_cache(key: str):
+    with _photo_cache_stats_lock:
+        _photo_cache_stats[key] += 1
+
+def photo_cache_key(prompt: str) -> str:
+    return hashlib.sha256(f"{IMAGE_GENERATION_PARAMS}|{prompt}".encode('utf-8')).hexdigest()
+
+@traced('photo_cache')
+def load_photo_variants(prompt_hash: str) -> list:
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """SELECT variant, file_id, image_url, last_used_at,
+                      EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at) / 3600 AS age_hours
+               FROM photo_cache WHERE prompt_hash = %s""",
+            (prompt_hash,)
+        )
+        variants = [dict(row) for row in cur.fetchall()]
+        cur.close()
+    return variants
+
+def mark_photo_variant_used(prompt_hash: str, variant: int):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE photo_cache SET uses = uses + 1, last_used_at = CURRENT_TIMESTAMP
+               WHERE prompt_hash = %s AND variant = %s""",
+            (prompt_hash, variant)
+        )
+        cur.close()
+
+def store_photo_variant(prompt_hash: str, variant: int, file_id: str, image_url: str):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO photo_cache (prompt_hash, variant, file_id, image_url, uses)
+               VALUES (%s, %s, %s, %s, 1)
+               ON CONFLICT (prompt_hash, variant) DO UPDATE
+               SET file_id = EXCLUDED.file_id, image_url = EXCLUDED.image_url, uses = 1,
+                   created_at = CURRENT_TIMESTAMP, last_used_at = CURRENT_TIMESTAMP""",
+            (prompt_hash, variant, file_id, image_url)
+        )
+        cur.close()
+    _count_photo_cache('stores')
+
+def delete_photo_variant(prompt_hash: str, variant: int):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM photo_cache WHERE prompt_hash = %s AND variant = %s", (prompt_hash, variant))
+        cur.close()
+
+def _is_fresh_variant(variant: Dict[str, Any]) -> bool:
+    return PHOTO_CACHE_MAX_AGE_HOURS <= 0 or float(variant['age_hours']) < PHOTO_CACHE_MAX_AGE_HOURS
+
+def _slot_for_new_variant(variants: list) -> int:
+    taken = {v['variant'] for v in variants}
+    for slot in range(PHOTO_CACHE_VARIANTS):
+        if slot not in taken:
+            return slot
+    _count_photo_cache('rotations')
+    stale = [v for v in variants if not _is_fresh_variant(v)] or variants
+    return max(stale, key=lambda v: float(v['age_hours']))['variant']
+
+PHOTO_STOCK_LOW_WATER = int(os.environ.get('PHOTO_STOCK_LOW_WATER', '2'))
+PHOTO_STOCK_HIGH_WATER = int(os.environ.get('PHOTO_STOCK_HIGH_WATER', '5'))
+PHOTO_STOCK_URL_TTL_MINUTES = int(os.environ.get('PHOTO_STOCK_URL_TTL_MINUTES', '50'))
+PHOTO_STASH_CHAT_ID = os.environ.get('PHOTO_STASH_CHAT_ID')
+PHOTO_STOCK_DEMAND_DAYS = int(os.environ.get('PHOTO_STOCK_DEMAND_DAYS', '7'))
+
+_photo_stock_lock = threading.Lock()
+_photo_stock_refilling = set()
+_photo_stock_stats = {'served': 0, 'empty': 0, 'generated': 0, 'refills_started': 0}
+
+def _count_photo_stock(key: str, amount: int = 1):
+    with _photo_stock_lock:
+        _photo_stock_stats[key] += amount
+
+@traced('photo_stock')
+def pop_photo_stock(tier: str, style_variation: int) -> tuple:
+    """
+    Забирает самое старое готовое фото корзины. Возвращает (фото или None, сколько осталось).
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """WITH popped AS (
+                   DELETE FROM photo_stock WHERE id = (
+                       SELECT id FROM photo_stock
+                       WHERE tier = %(tier)s AND style_variation = %(variation)s
+                         AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                       ORDER BY id
+                       LIMIT 1
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING prompt_hash, file_id, image_url
+               )
+               SELECT popped.*, (
+                   SELECT COUNT(*) FROM photo_stock
+                   WHERE tier = %(tier)s AND style_variation = %(variation)s
+                     AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+               ) - 1 AS remaining
+               FROM popped""",
+            {'tier': tier, 'variation': style_variation}
+        )
+        item = cur.fetchone()
+        cur.close()
+    if not item:
+        return None, 0
+    item = dict(item)
+    return item, item.pop('remaining')
+
+def count_photo_stock(tier: str, style_variation: int) -> int:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM photo_stock WHERE tier = %s AND style_variation = %s AND expires_at <= CURRENT_TIMESTAMP",
+            (tier, style_variation)
+        )
+        cur.execute(
+            "SELECT COUNT(*) FROM photo_stock WHERE tier = %s AND style_variation = %s",
+            (tier, style_variation)
+        )
+        count = cur.fetchone()[0]
+        cur.close()
+    return count
+
+def add_photo_to_stock(tier: str, style_variation: int) -> bool:
+    """
+    Генерирует одно фото для корзины. Если задан PHOTO_STASH_CHAT_ID, фото сразу
+    загружается в служебный чат и хранится как file_id, иначе хранится временный URL.
+    """
+    prompt = build_photo_prompt(tier, style_variation)
+    image_url = generate_image_flux(prompt)
+    if image_url.startswith(PLACEHOLDER_IMAGE_URL):
+        return False
+    
+    file_id = None
+    if PHOTO_STASH_CHAT_ID and PHOTO_STREAM_UPLOAD:
+        stashed = stream_photo_to_telegram(int(PHOTO_STASH_CHAT_ID), image_url)
+        file_id, image_url = largest_photo_file_id(stashed['message']), stashed['photo_url']
+    elif PHOTO_STASH_CHAT_ID:
+        file_id = largest_photo_file_id(send_telegram_photo(int(PHOTO_STASH_CHAT_ID), image_url))
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO photo_stock (tier, style_variation, prompt_hash, file_id, image_url, expires_at)
+               VALUES (%s, %s, %s, %s, %s,
+                       CASE WHEN %s IS NULL THEN CURRENT_TIMESTAMP + make_interval(mins => %s) END)""",
+            (tier, style_variation, photo_cache_key(prompt), file_id, image_url, file_id, PHOTO_STOCK_URL_TTL_MINUTES)
+        )
+        cur.close()
+    _count_photo_stock('generated')
+    return True
+
+def missing_photo_variants(tier: str, style_variation: int) -> int:
+    """
+    Сколько свежих вариантов не хватает в кэше промпта корзины. Запас расходуется только
+    на промахах кэша, поэтому фото сверх этого числа никому не достанутся.
+    """
+    variants = load_photo_variants(photo_cache_key(build_photo_prompt(tier, style_variation)))
+    return max(0, PHOTO_CACHE_VARIANTS - sum(1 for v in variants if _is_fresh_variant(v)))
+
+def replenish_photo_stock(tier: str, style_variation: int, high_water: int = PHOTO_STOCK_HIGH_WATER) -> int:
+    target = min(high_water, missing_photo_variants(tier, style_variation))
+    added = 0
+    while count_photo_stock(tier, style_variation) < target:
+        if not add_photo_to_stock(tier, style_variation):
+            break
+        added += 1
+    return added
+
+def trigger_photo_stock_refill(tier: str, style_variation: int, remaining: int):
+    """
+    Запускает пополнение корзины в фоне, когда запас опустился ниже PHOTO_STOCK_LOW_WATER.
+    Надёжный путь пополнения — периодический вызов prewarm, фоновый поток лишь ускоряет его.
+    """
+    if remaining >= PHOTO_STOCK_LOW_WATER:
+        return
+    bucket = (tier, style_variation)
+    with _photo_stock_lock:
+        if bucket in _photo_stock_refilling:
+            return
+        _photo_stock_refilling.add(bucket)
+        _photo_stock_stats['refills_started'] += 1
+    
+    def refill():
+        try:
+            replenish_photo_stock(tier, style_variation)
+        except Exception:
+            pass
+        finally:
+            with _photo_stock_lock:
+                _photo_stock_refilling.discard(bucket)
+    
+    threading.Thread(target=refill, daemon=True).start()
+
+def requested_photo_buckets() -> list:
+    """
+    Корзины, из которых за последние PHOTO_STOCK_DEMAND_DAYS дней действительно просили фото
+    (по настройкам в photo_jobs): бот шлёт только style_variation=1, остальные пополнять незачем.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT DISTINCT style_variation,
+                      COALESCE((settings->>'nsfw_enabled')::boolean, FALSE),
+                      COALESCE((settings->>'spicy_level')::int, 30)
+               FROM photo_jobs
+               WHERE created_at >= CURRENT_TIMESTAMP - make_interval(days => %s)""",
+            (PHOTO_STOCK_DEMAND_DAYS,)
+        )
+        rows = cur.fetchall()
+        cur.close()
+    return sorted({photo_bucket(nsfw_enabled, spicy_level, style_variation) for style_variation, nsfw_enabled, spicy_level in rows})
+
+def prewarm_photo_stock(tiers: Optional[list] = None, high_water: int = PHOTO_STOCK_HIGH_WATER) -> Dict[str, int]:
+    """
+    Пополняет только запрошенные корзины и только на недостающие варианты кэша:
+    без PHOTO_STASH_CHAT_ID запас живёт PHOTO_STOCK_URL_TTL_MINUTES, и лишние платные
+    генерации просто истекли бы.
+    """
+    added = {}
+    for tier, style_variation in requested_photo_buckets():
+        if tiers and tier not in tiers:
+            continue
+        added[f"{tier}:{style_variation}"] = replenish_photo_stock(tier, style_variation, high_water)
+    return added
+
+def get_photo_stock_stats() -> Dict[str, Any]:
+    with _photo_stock_lock:
+        return {
+            **_photo_stock_stats,
+            'refilling': len(_photo_stock_refilling),
+            'low_water': PHOTO_STOCK_LOW_WATER,
+            'high_water': PHOTO_STOCK_HIGH_WATER
+        }
+
+def deliver_photo(chat_id: int, prompt: str, caption: str, bucket: Optional[tuple] = None) -> Dict[str, Any]:
+    """
+    Отправляет фото по промпту через кэш file_id. Пока для промпта накоплено меньше
+    PHOTO_CACHE_VARIANTS свежих вариантов, нужен новый снимок: он берётся из готового
+    запаса корзины bucket, а если запас пуст — генерируется на месте. Дальше варианты
+    выдаются по кругу (давно не использованный первым) без генерации и повторной загрузки.
+    """
+    prompt_hash = photo_cache_key(prompt)
+    variants = load_photo_variants(prompt_hash)
+    fresh = [v for v in variants if _is_fresh_variant(v)]
+    
+    if len(fresh) >= PHOTO_CACHE_VARIANTS:
+        variant = min(fresh, key=lambda v: v['last_used_at'])
+        if send_telegram_photo(chat_id, variant['file_id'], caption):
+            mark_photo_variant_used(prompt_hash, variant['variant'])
+            _count_photo_cache('hits')
+            return {'photo_url': variant['image_url'], 'preview_url': None, 'cached': True, 'from_stock': False}
+        _count_photo_cache('invalid_file_ids')
+        delete_photo_variant(prompt_hash, variant['variant'])
+        variants = [v for v in variants if v['variant'] != variant['variant']]
+    
+    _count_photo_cache('misses')
+    stocked = None
+    if bucket:
+        stocked, remaining = pop_photo_stock(*bucket)
+        _count_photo_stock('served' if stocked else 'empty')
+    
+    preview_url = None
+    if stocked:
+        photo_url = stocked['image_url']
+        message = send_telegram_photo(chat_id, stocked['file_id'] or photo_url, caption)
+    else:
+        photo_url = generate_image_flux(prompt)
+        if PHOTO_STREAM_UPLOAD and not photo_url.startswith(PLACEHOLDER_IMAGE_URL):
+            delivery = stream_photo_to_telegram(chat_id, photo_url, caption)
+            message, photo_url, preview_url = delivery['message'], delivery['photo_url'], delivery['preview_url']
+        else:
+            message = send_telegram_photo(chat_id, photo_url, caption)
+    
+    file_id = largest_photo_file_id(message)
+    if file_id and not photo_url.startswith(PLACEHOLDER_IMAGE_URL):
+        store_photo_variant(prompt_hash, _slot_for_new_variant(variants), file_id, photo_url)
+    if bucket:
+        # после записи варианта: пополнение считает недостающие варианты уже с ним
+        trigger_photo_stock_refill(bucket[0], bucket[1], remaining)
+    return {'photo_url': photo_url, 'preview_url': preview_url, 'cached': False, 'from_stock': stocked is not None}
+
+def get_photo_cache_stats() -> Dict[str, Any]:
+    with _photo_cache_stats_lock:
+        lookups = _photo_cache_stats['hits'] + _photo_cache_stats['misses']
+        return {
+            **_photo_cache_stats,
+            'hit_rate': round(_photo_cache_stats['hits'] / lookups, 3) if lookups else None,
+            'variants_per_prompt': PHOTO_CACHE_VARIANTS
+        }
+
+def process_photo_request(telegram_id: int, chat_id: int, style_variation: int, expected_settings: Optional[Dict[str, Any]] = None) -> tuple:
+    """
+    Проверяет права пользователя, выбирает промпт и доставляет фото.
+    Возвращает HTTP-статус и тело ответа.
+    """
+    user = get_user_settings(telegram_id, expected_settings)
+    
+    if not user:
+        return 404, {'error': 'User not found'}
+    
+    if user['nsfw_enabled'] and not user['is_premium']:
+        return 403, {'error': 'NSFW content requires premium subscription'}
+    
+    nsfw_enabled = user.get('nsfw_enabled', False)
+    spicy_level = user.get('spicy_level', 30)
+    
+    prompt = generate_photo_prompt(nsfw_enabled, spicy_level, style_variation)
+    
+    caption = random.choice(PHOTO_CAPTIONS.get(user.get('personality_mode', 'friendly'), DEFAULT_PHOTO_CAPTIONS))
+    
+    delivery = deliver_photo(chat_id, prompt, caption, photo_bucket(nsfw_enabled, spicy_level, style_variation))
+    
+    return 200, {
+        'success': True,
+        'photo_url': delivery['photo_url'],
+        'preview_url': delivery['preview_url'],
+        'cached': delivery['cached'],
+        'from_stock': delivery['from_stock'],
+        'prompt_used': prompt,
+        'nsfw_mode': nsfw_enabled,
+        'spicy_level': spicy_level
+    }
+
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', '2'))
+PHOTO_MAX_GENERATING = int(os.environ.get('PHOTO_MAX_GENERATING', '8'))
+PHOTO_JOB_MAX_ATTEMPTS = int(os.environ.get('PHOTO_JOB_MAX_ATTEMPTS', '2'))
+PHOTO_JOB_LEASE_SECONDS = int(os.environ.get('PHOTO_JOB_LEASE_SECONDS', '300'))
+PHOTO_JOB_QUEUED_TTL_SECONDS = int(os.environ.get('PHOTO_JOB_QUEUED_TTL_SECONDS', '900'))
+PHOTO_WORKER_MAX_SECONDS = float(os.environ.get('PHOTO_WORKER_MAX_SECONDS', '240'))
+
+@traced('job_claim')
+def claim_photo_job() -> Optional[Dict[str, Any]]:
+    """
+    Берёт следующую задачу, если сейчас генерируется меньше PHOTO_MAX_GENERATING фото
+    во всех экземплярах функции вместе. Задача с истёкшей арендой забирается повторно,
+    только пока у неё остались попытки.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """UPDATE photo_jobs SET status = 'generating', started_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+               WHERE id = (
+                   SELECT id FROM photo_jobs
+                   WHERE status = 'queued'
+                      OR (status = 'generating' AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %(lease)s)
+                          AND attempts < %(max_attempts)s)
+                   ORDER BY id
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+               )
+               AND (
+                   SELECT COUNT(*) FROM photo_jobs
+                   WHERE status = 'generating' AND started_at >= CURRENT_TIMESTAMP - make_interval(secs => %(lease)s)
+               ) < %(max_generating)s
+               RETURNING id, telegram_id, chat_id, style_variation, settings, attempts""",
+            {'lease': PHOTO_JOB_LEASE_SECONDS, 'max_generating': PHOTO_MAX_GENERATING, 'max_attempts': PHOTO_JOB_MAX_ATTEMPTS}
+        )
+        job = cur.fetchone()
+        cur.close()
+    return dict(job) if job else None
+
+def fail_expired_photo_jobs() -> list:
+    """
+    Переводит в failed задачи, у которых аренда истекла на последней попытке (воркер
+    упал посреди генерации), и задачи, простоявшие в очереди дольше PHOTO_JOB_QUEUED_TTL_SECONDS
+    (воркер не запускался). Возвращает их chat_id для уведомления
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE photo_jobs
+               SET status = 'failed',
+                   error = CASE WHEN status = 'queued' THEN 'queue expired' ELSE 'lease expired' END,
+                   finished_at = CURRENT_TIMESTAMP
+               WHERE (status = 'generating'
+                      AND attempts >= %(max_attempts)s
+                      AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %(lease)s))
+                  OR (status = 'queued'
+                      AND created_at < CURRENT_TIMESTAMP - make_interval(secs => %(queued_ttl)s))
+               RETURNING chat_id""",
+            {'max_attempts': PHOTO_JOB_MAX_ATTEMPTS, 'lease': PHOTO_JOB_LEASE_SECONDS, 'queued_ttl': PHOTO_JOB_QUEUED_TTL_SECONDS}
+        )
+        chat_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+    return chat_ids
+
+@traced('job_finish')
+def finish_photo_job(job_id: int, status: str, photo_url: Optional[str] = None, error: Optional[str] = None):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE photo_jobs
+               SET status = %s, photo_url = %s, error = %s,
+                   finished_at = CASE WHEN %s IN ('sent', 'failed') THEN CURRENT_TIMESTAMP END
+               WHERE id = %s""",
+            (status, photo_url, error, status, job_id)
+        )
+        cur.close()
+
+def run_photo_job(job: Dict[str, Any]) -> str:
+    with trace_invocation('generate-photo:job') as trace:
+        if trace is not None:
+            trace.fields = {'job_id': job['id'], 'attempt': job['attempts']}
+        try:
+            status_code, result = process_photo_request(job['telegram_id'], job['chat_id'], job['style_variation'], job['settings'])
+        except Exception as e:
+            if job['attempts'] < PHOTO_JOB_MAX_ATTEMPTS:
+                finish_photo_job(job['id'], 'queued', error=f"{type(e).__name__}: {e}")
+                return 'queued'
+            status_code, result = 500, {'error': str(e)}
+        
+        if status_code == 200:
+            finish_photo_job(job['id'], 'sent', photo_url=result['photo_url'])
+            return 'sent'
+        
+        finish_photo_job(job['id'], 'failed', error=result.get('error'))
+        send_telegram_message(job['chat_id'], "😔 Извини, не смогла сгенерировать фото. Попробуй позже!")
+        return 'failed'
+
+def run_photo_worker(concurrency: int = PHOTO_WORKERS, max_seconds: float = PHOTO_WORKER_MAX_SECONDS) -> Dict[str, int]:
+    _db_pool.max_size = max(_db_pool.max_size, concurrency + 1)
+    deadline = time.monotonic() + max_seconds
+    counters = {'sent': 0, 'failed': 0, 'queued': 0}
+    counters_lock = threading.Lock()
+    
+    for chat_id in fail_expired_photo_jobs():
+        send_telegram_message(chat_id, "😔 Извини, не смогла сгенерировать фото. Попробуй позже!")
+        counters['failed'] += 1
+    
+    def work():
+        while time.monotonic() < deadline:
+            job = claim_photo_job()
+            if not job:
+                return
+            outcome = run_photo_job(job)
+            with counters_lock:
+                counters[outcome] += 1
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(concurrency)]:
+            future.result()
+    return counters
+
+def get_photo_job(job_id: int) -> Optional[Dict[str, Any]]:
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """SELECT id, status, attempts, photo_url, error, created_at, started_at, finished_at
+               FROM photo_jobs WHERE id = %s""",
+            (job_id,)
+        )
+        job = cur.fetchone()
+        cur.close()
+    if not job:
+        return None
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in job.items()}
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def require_admin(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Проверяет заголовок X-Admin-Token для служебных action; возвращает ответ 403
+    или None, если доступ разрешён. Без заданного ADMIN_TOKEN служебные action закрыты.
+    """
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    if ADMIN_TOKEN and hmac.compare_digest(headers.get('x-admin-token', ''), ADMIN_TOKEN):
+        return None
+    return {
+        'statusCode': 403,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'error': 'forbidden'}),
+        'isBase64Encoded': False
+    }
+
+def photo_worker_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Разбирает очередь photo_jobs: вызывается по расписанию или пинком из telegram-bot,
+    в обоих случаях с заголовком X-Admin-Token
+    """
+    forbidden = require_admin(event)
+    if forbidden:
+        return forbidden
+    
+    try:
+        counters = run_photo_worker()
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'ok': True, **counters}),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+
+def prewarm_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Пополняет запас фото запрошенных корзин перед наплывом трафика (см. prewarm_photo_stock).
+    Требует X-Admin-Token; без него - python index.py prewarm
+    """
+    forbidden = require_admin(event)
+    if forbidden:
+        return forbidden
+    
+    try:
+        body = json.loads(event.get('body') or '{}')
+        added = prewarm_photo_stock(body.get('tiers'))
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'ok': True, 'added': added}),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+
+@traced_handler('generate-photo')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Генерация фото AI девушки для Telegram бота
@@ -133,17 +1464,42 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    job_id = (event.get('queryStringParameters') or {}).get('job_id')
+    if method == 'GET' and job_id:
+        job = get_photo_job(int(job_id))
+        return {
+            'statusCode': 200 if job else 404,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps(job or {'error': 'Job not found'}),
+            'isBase64Encoded': False
+        }
+    
     if method == 'GET':
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'status': 'Photo generation service', 'version': '1.0'}),
+            'body': json.dumps({
+                'status': 'Photo generation service',
+                'version': '1.0',
+                'db_pool': get_db_pool_stats(),
+                'user_cache': get_user_cache_stats(),
+                'http': get_http_stats(),
+                'photo_cache': get_photo_cache_stats(),
+                'photo_stock': get_photo_stock_stats(),
+                'photo_rehost': get_photo_rehost_stats()
+            }),
             'isBase64Encoded': False
         }
     
     try:
         body = json.loads(event.get('body', '{}'))
         
+        if body.get('action') == 'prewarm':
+            return prewarm_handler(event, context)
+        
+        if body.get('action') == 'drain_photo_jobs':
+            return photo_worker_handler(event, context)
+        
         telegram_id = body.get('telegram_id')
         chat_id = body.get('chat_id')
         style_variation = body.get('style_variation', 1)
@@ -156,63 +1512,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        user = get_user_settings(telegram_id)
-        
-        if not user:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'User not found'}),
-                'isBase64Encoded': False
-            }
-        
-        if user['nsfw_enabled'] and not user['is_premium']:
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'NSFW content requires premium subscription'}),
-                'isBase64Encoded': False
-            }
-        
-        nsfw_enabled = user.get('nsfw_enabled', False)
-        spicy_level = user.get('spicy_level', 30)
-        
-        prompt = generate_photo_prompt(nsfw_enabled, spicy_level, style_variation)
-        
-        photo_url = generate_image_flux(prompt)
-        
-        mood_emojis = {
-            'friendly': '😊💕',
-            'flirty': '😏💋',
-            'playful': '😄✨',
-            'spicy': '🔥😈'
-        }
-        
-        personality = user.get('personality_mode', 'friendly')
-        emoji = mood_emojis.get(personality, '😊')
-        
-        captions = [
-            f"Вот моё фото для тебя {emoji}",
-            f"Специально для тебя {emoji}",
-            f"Как тебе? {emoji}",
-            f"Надеюсь понравится {emoji}",
-        ]
-        
-        import random
-        caption = random.choice(captions)
-        
-        send_telegram_photo(chat_id, photo_url, caption)
+        status_code, result = process_photo_request(telegram_id, chat_id, style_variation, body.get('settings'))
         
         return {
-            'statusCode': 200,
+            'statusCode': status_code,
             'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({
-                'success': True,
-                'photo_url': photo_url,
-                'prompt_used': prompt,
-                'nsfw_mode': nsfw_enabled,
-                'spicy_level': spicy_level
-            }),
+            'body': json.dumps(result),
             'isBase64Encoded': False
         }
         
@@ -223,3 +1528,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
         }
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Photo generation background entry points')
+    commands = parser.add_subparsers(dest='command', required=True)
+    prewarm_parser = commands.add_parser('prewarm', help='fill the stock of requested buckets up to the missing cache variants (at most the high-water mark)')
+    prewarm_parser.add_argument('--tier', action='append', choices=PHOTO_TIERS, help='limit to a tier (repeatable)')
+    prewarm_parser.add_argument('--high-water', type=int, default=PHOTO_STOCK_HIGH_WATER)
+    
+    worker_parser = commands.add_parser('worker', help='drain the photo_jobs queue')
+    worker_parser.add_argument('--concurrency', type=int, default=PHOTO_WORKERS)
+    args = parser.parse_args()
+    
+    if args.command == 'prewarm':
+        print(json.dumps(prewarm_photo_stock(args.tier, args.high_water)))
+    elif args.command == 'worker':
+        print(json.dumps(run_photo_worker(args.concurrency)))
@@ -1,235 +1,2862 @@
+import functools
+import gzip
+import hmac
+import importlib
+import itertools
 import json
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
 from typing import Dict, Any, Optional
-import requests
-from datetime import datetime
+from datetime import date
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+class LazyModule:
+    """
+    Прокси модуля, который импортируется при первом обращении к атрибуту.
+    Health-check и OPTIONS не платят за загрузку psycopg2 и requests на холодном старте.
+    """
+
+    def __init__(self, name: str, *submodules: str):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                for submodule in self._submodules:
+                    importlib.import_module(f"{self._name}.{submodule}")
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._module or self._load(), attr)
+
+psycopg2 = LazyModule('psycopg2', 'extensions', 'extras', 'pool', 'sql')
+requests = LazyModule('requests', 'adapters')
+urllib3 = LazyModule('urllib3', 'exceptions')
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.05'))
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+
+_trace_local = threading.local()
+
+class Trace:
+    """
+    Тайминги стадий одного вызова: суммарное время и число входов по каждой стадии,
+    число SQL-запросов и статусы исходящих HTTP-вызовов
+    """
+
+    def __init__(self, name: str, sampled: bool):
+        self.name = name
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.db_queries = 0
+        self.http = {}
+        self.fields = {}
+
+    def add_stage(self, stage: str, elapsed_ms: float):
+        total, calls = self.stages.get(stage, (0.0, 0))
+        self.stages[stage] = (total + elapsed_ms, calls + 1)
+
+    def server_timing(self) -> str:
+        parts = [f"{stage};dur={total:.1f}" for stage, (total, _) in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(parts)
+
+    def log_line(self, **fields) -> str:
+        return json.dumps({
+            'trace': self.name,
+            **fields,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'stages_ms': {stage: round(total, 1) for stage, (total, _) in self.stages.items()},
+            'stage_calls': {stage: calls for stage, (_, calls) in self.stages.items()},
+            'db_queries': self.db_queries,
+            'http': self.http
+        }, ensure_ascii=False)
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_trace_local, 'trace', None)
+
+@contextmanager
+def trace_invocation(name: str, force: bool = False):
+    """
+    Открывает трассировку вызова с вероятностью TRACE_SAMPLE_RATE (или всегда при force)
+    и пишет по её итогам одну JSON-строку в лог. Вне выборки отдаёт None и ничего не стоит.
+    """
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled and not force:
+        yield None
+        return
+    trace = Trace(name, sampled)
+    previous, _trace_local.trace = current_trace(), trace
+    try:
+        yield trace
+    finally:
+        _trace_local.trace = previous
+        if sampled:
+            print(trace.log_line(**trace.fields))
+
+def traced(stage: str):
+    """
+    Декоратор стадии: если вызов трассируется, добавляет время функции к стадии stage
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                trace.add_stage(stage, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorate
+
+def traced_handler(name: str):
+    """
+    Трассирует handler целиком: статус ответа попадает в лог, а при TRACE_SERVER_TIMING
+    тайминги стадий возвращаются заголовком Server-Timing
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            with trace_invocation(name, force=TRACE_SERVER_TIMING) as trace:
+                response = fn(event, context)
+                if trace is not None:
+                    trace.fields = {
+                        'method': event.get('httpMethod', 'POST'),
+                        'action': (event.get('queryStringParameters') or {}).get('action'),
+                        'status': response.get('statusCode')
+                    }
+                    if TRACE_SERVER_TIMING:
+                        response['headers'] = {**(response.get('headers') or {}), 'Server-Timing': trace.server_timing()}
+                return response
+        return wrapper
+    return decorate
+
+@functools.lru_cache(maxsize=None)
+def traced_connection_class():
+    """
+    Класс соединения, курсоры которого считают execute в текущую трассировку.
+    Создаётся при первом подключении к БД, чтобы не импортировать psycopg2 заранее.
+    """
+    class TracedConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+            return super().cursor(*args, cursor_factory=_traced_cursor_class(base), **kwargs)
+    return TracedConnection
+
+_traced_cursor_classes = {}
+
+def _traced_cursor_class(base):
+    cls = _traced_cursor_classes.get(base)
+    if cls is None:
+        def execute(self, query, vars=None):
+            trace = current_trace()
+            if trace is not None:
+                trace.db_queries += 1
+            return base.execute(self, query, vars)
+        cls = _traced_cursor_classes[base] = type(f"Traced{base.__name__}", (base,), {'execute': execute})
+    return cls
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """
+    Пул соединений с Postgres, живущий между тёплыми вызовами функции.
+    Простаивавшие соединения проверяются при выдаче и пересоздаются, если БД их закрыла.
+    """
+
+    def __init__(self, max_size: int, timeout: float, healthcheck_after: float):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._counters = {'checkouts': 0, 'connects': 0, 'waits': 0, 'timeouts': 0, 'reconnects': 0, 'discarded': 0}
+        self.connection_factory = None
+
+    def _connect(self):
+        conn = psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=self.connection_factory or traced_connection_class())
+        conn.autocommit = True
+        return conn
+
+    def _is_alive(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if idle_for < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        conn, last_used = None, 0.0
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise psycopg2.pool.PoolError('connection pool exhausted')
+                if not waited:
+                    self._counters['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._counters['checkouts'] += 1
+        
+        try:
+            if conn is None:
+                conn = self._connect()
+                self._counters['connects'] += 1
+            elif not self._is_alive(conn, time.monotonic() - last_used):
+                self._close_quietly(conn)
+                conn = self._connect()
+                self._counters['reconnects'] += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard: bool = False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed:
+                self._size -= 1
+                self._counters['discarded'] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                **self._counters
+            }
+
+_db_pool = ConnectionPool(DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_AFTER)
+
+@contextmanager
+def db_connection():
+    conn = _db_pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        _db_pool.putconn(conn, discard=discard)
+
+@contextmanager
+def db_transaction():
+    """
+    Соединение из пула в режиме явной транзакции (commit при выходе, rollback при ошибке)
+    """
+    with db_connection() as conn:
+        conn.autocommit = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+
+def get_db_pool_stats() -> Dict[str, Any]:
+    return _db_pool.stats()
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1000'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+
+class UserCache:
+    """
+    LRU-кэш строк telegram_users с ограниченным временем жизни записи.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._items.get(telegram_id)
+            if item is None:
+                self._counters['misses'] += 1
+                return None
+            user, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._items[telegram_id]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._items.move_to_end(telegram_id)
+            self._counters['hits'] += 1
+            return dict(user)
+
+    def put(self, telegram_id: int, user: Dict[str, Any]):
+        with self._lock:
+            self._items[telegram_id] = (dict(user), time.monotonic() + self.ttl)
+            self._items.move_to_end(telegram_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._items.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'size': len(self._items), 'max_size': self.max_size, **self._counters}
+
+_user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    return _user_cache.stats()
+
+HTTP_ENDPOINTS = {
+    'telegram': {'timeout': (3.05, 10), 'retries': 2, 'idempotent': False},
+    'openai_chat': {'timeout': (3.05, 30), 'retries': 1, 'idempotent': True},
+    'photo_service': {'timeout': (3.05, 1), 'retries': 0, 'idempotent': False},
+    'telegram_broadcast': {'timeout': (3.05, 10), 'retries': 0, 'idempotent': False},
+    'telegram_poll': {'timeout': (3.05, 40), 'retries': 2, 'idempotent': True},
+}
+HTTP_MAX_RETRY_AFTER = float(os.environ.get('HTTP_MAX_RETRY_AFTER', '5'))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', '0.3'))
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    """
+    Общая keep-alive сессия, создаётся при первом исходящем запросе
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+                session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+                _http_session = session
+    return _http_session
+
+_http_stats_lock = threading.Lock()
+_http_stats = {}
+
+def _record_http_call(host: str, started: float, status: Optional[int], retried: bool):
+    elapsed_ms = (time.monotonic() - started) * 1000
+    trace = current_trace()
+    if trace is not None:
+        key = f"{host} {status if status is not None else 'exception'}"
+        trace.http[key] = trace.http.get(key, 0) + 1
+    with _http_stats_lock:
+        stats = _http_stats.get(host)
+        if stats is None:
+            stats = _http_stats[host] = {
+                'requests': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                'statuses': {}, 'recent_ms': deque(maxlen=256)
+            }
+        stats['requests'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats['recent_ms'].append(elapsed_ms)
+        key = str(status) if status is not None else 'exception'
+        stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+        if status is None or status == 429 or status >= 500:
+            stats['errors'] += 1
+        if retried:
+            stats['retries'] += 1
+
+def _retry_delay(response: Optional['requests.Response'], attempt: int) -> float:
+    if response is not None:
+        retry_after = None
+        try:
+            retry_after = response.json().get('parameters', {}).get('retry_after')
+        except ValueError:
+            pass
+        if retry_after is None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return HTTP_BACKOFF_BASE * (2 ** attempt) * (1 + random.random() / 2)
+
+def http_post(endpoint: str, url: str, deadline: Optional[float] = None, **kwargs) -> 'requests.Response':
+    """
+    POST через общую keep-alive сессию с таймаутами и повторами по эндпоинту.
+    Повторяются 429 и ошибки установки соединения - запрос точно не обработан. Обрыв
+    после отправки и 5xx повторяются только для idempotent эндпоинтов: повтор sendMessage
+    после того, как Telegram его уже принял, пришёл бы пользователю дважды.
+    deadline (time.monotonic()) ограничивает таймаут чтения и отменяет повторы, которые в него не влезут.
+    """
+    config = HTTP_ENDPOINTS[endpoint]
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        connect_timeout, read_timeout = config['timeout']
+        if deadline is not None:
+            read_timeout = max(0.1, min(read_timeout, deadline - time.monotonic()))
+        started = time.monotonic()
+        try:
+            response = http_session().post(url, timeout=(connect_timeout, read_timeout), **kwargs)
+        except requests.RequestException as e:
+            _record_http_call(host, started, None, attempt > 0)
+            if not (_request_not_sent(e) or config['idempotent'] and isinstance(e, requests.ConnectionError)):
+                raise
+            delay = _retry_delay(None, attempt)
+            if attempt >= config['retries'] or not _fits_deadline(deadline, delay):
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        
+        _record_http_call(host, started, response.status_code, attempt > 0)
+        retryable = response.status_code == 429 or config['idempotent'] and response.status_code >= 500
+        if retryable and attempt < config['retries']:
+            delay = _retry_delay(response, attempt)
+            if delay <= HTTP_MAX_RETRY_AFTER and _fits_deadline(deadline, delay):
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+        return response
+
+def _request_not_sent(error: 'requests.RequestException') -> bool:
+    """
+    Соединение не установилось (таймаут подключения, отказ, DNS): запрос до сервера не дошёл
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def _fits_deadline(deadline: Optional[float], delay: float) -> bool:
+    return deadline is None or time.monotonic() + delay + 1.0 < deadline
+
+def get_http_stats() -> Dict[str, Any]:
+    with _http_stats_lock:
+        result = {}
+        for host, stats in _http_stats.items():
+            recent = sorted(stats['recent_ms'])
+            result[host] = {
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'retries': stats['retries'],
+                'avg_ms': round(stats['total_ms'] / stats['requests'], 1),
+                'p50_ms': round(recent[len(recent) // 2], 1),
+                'p95_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1),
+                'max_ms': round(stats['max_ms'], 1),
+                'statuses': dict(stats['statuses'])
+            }
+        return result
+
+@traced('user')
+def get_or_create_user(telegram_id: int, username: str, first_name: str) -> Dict[str, Any]:
+    cached = _user_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+    
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """INSERT INTO telegram_users (telegram_id, username, first_name) 
+               VALUES (%s, %s, %s)
+               ON CONFLICT (telegram_id) DO UPDATE SET last_active = CURRENT_TIMESTAMP
+               RETURNING *""",
+            (telegram_id, username, first_name)
+        )
+        user = dict(cur.fetchone())
+        cur.close()
+    _user_cache.put(telegram_id, user)
+    return user
+
+CHAT_HISTORY_WINDOW = int(os.environ.get('CHAT_HISTORY_WINDOW', '12'))
+SUMMARY_FOLD_BATCH = int(os.environ.get('SUMMARY_FOLD_BATCH', '16'))
+CONVERSATION_SUMMARY = os.environ.get('CONVERSATION_SUMMARY', '1').lower() in ('1', 'true', 'yes')
+
+CHAT_CONTEXT_SIZE = CHAT_HISTORY_WINDOW + SUMMARY_FOLD_BATCH + 1
+
+CHAT_TURN_LOCK_TIMEOUT = float(os.environ.get('CHAT_TURN_LOCK_TIMEOUT', '30'))
+CHAT_TURN_LOCK_POLL = float(os.environ.get('CHAT_TURN_LOCK_POLL', '0.1'))
+CHAT_DEBOUNCE_SECONDS = float(os.environ.get('CHAT_DEBOUNCE_SECONDS', '0'))
+
+@contextmanager
+def chat_turn_lock(conn, telegram_id: int):
+    """
+    Сессионная advisory-блокировка на пользователя: параллельные вызовы для одного
+    telegram_id проходят ход диалога по очереди. Снимается явно; если соединение
+    упало и выброшено из пула, Postgres снимет её сам.
+    """
+    key = telegram_id % 2147483647
+    deadline = time.monotonic() + CHAT_TURN_LOCK_TIMEOUT
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(hashtext('chat_turn'), %s)", (key,))
+    waited_from = time.perf_counter()
+    while not cur.fetchone()[0]:
+        if time.monotonic() >= deadline:
+            cur.close()
+            raise TimeoutError(f"chat turn lock for {telegram_id} is busy")
+        time.sleep(CHAT_TURN_LOCK_POLL)
+        cur.execute("SELECT pg_try_advisory_lock(hashtext('chat_turn'), %s)", (key,))
+    trace = current_trace()
+    if trace is not None:
+        trace.add_stage('lock_wait', (time.perf_counter() - waited_from) * 1000)
+    try:
+        yield
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(hashtext('chat_turn'), %s)", (key,))
+        cur.close()
+
+@traced('db_begin_turn')
+def begin_chat_turn(conn, telegram_id: int, username: str, first_name: str, text: str, update_id: Optional[int] = None) -> tuple:
+    """
+    Открывает ход диалога одним запросом: upsert пользователя со счётчиками, запись
+    его сообщения в chat_history и в кольцевой буфер chat_context, который сразу
+    возвращается целиком вместе с id сообщения. Сообщение помнит update_id: повторная
+    доставка того же обновления (ретрай после таймаута блокировки) не пишет его второй
+    раз, а возвращает уже сохранённое.
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(
+        """WITH prev AS (
+               SELECT turns FROM chat_context
+               WHERE telegram_id = %(telegram_id)s
+                 AND %(update_id)s::bigint IS NOT NULL
+                 AND turns @> jsonb_build_array(jsonb_build_object('update_id', %(update_id)s::bigint))
+           ), u AS (
+               INSERT INTO telegram_users (telegram_id, username, first_name, messages_sent, first_message_at, last_message_at)
+               VALUES (%(telegram_id)s, %(username)s, %(first_name)s, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+               ON CONFLICT (telegram_id) DO UPDATE
+               SET last_active = CURRENT_TIMESTAMP,
+                   messages_sent = telegram_users.messages_sent + CASE WHEN EXISTS (SELECT 1 FROM prev) THEN 0 ELSE 1 END,
+                   first_message_at = COALESCE(telegram_users.first_message_at, CURRENT_TIMESTAMP),
+                   last_message_at = CURRENT_TIMESTAMP
+               RETURNING *
+           ), m AS (
+               INSERT INTO chat_history (telegram_id, role, content)
+               SELECT %(telegram_id)s, 'user', %(text)s
+               WHERE NOT EXISTS (SELECT 1 FROM prev)
+               RETURNING id, role, content
+           ), ctx AS (
+               INSERT INTO chat_context (telegram_id, turns)
+               SELECT %(telegram_id)s, jsonb_build_array(jsonb_strip_nulls(jsonb_build_object(
+                   'id', m.id, 'role', m.role, 'content', m.content, 'update_id', %(update_id)s::bigint
+               )))
+               FROM m
+               ON CONFLICT (telegram_id) DO UPDATE
+               SET turns = chat_context_append(chat_context.turns, EXCLUDED.turns -> 0, %(context_size)s),
+                   updated_at = CURRENT_TIMESTAMP
+               RETURNING turns
+           )
+           SELECT u.*, COALESCE((SELECT turns FROM ctx), (SELECT turns FROM prev)) AS chat_context
+           FROM u""",
+        {
+            'telegram_id': telegram_id,
+            'username': username,
+            'first_name': first_name,
+            'text': text,
+            'update_id': update_id,
+            'context_size': CHAT_CONTEXT_SIZE
+        }
+    )
+    user = dict(cur.fetchone())
+    cur.close()
+    turns = user.pop('chat_context')
+    _user_cache.put(telegram_id, user)
+    message_id = next(
+        (turn['id'] for turn in reversed(turns) if update_id is not None and turn.get('update_id') == update_id),
+        turns[-1]['id']
+    )
+    return user, turns, message_id
+
+@traced('db_load_turn')
+def load_chat_turn(conn, telegram_id: int) -> tuple:
+    """
+    Перечитывает пользователя и chat_context после ожидания: за это время другие
+    вызовы могли дописать сообщения, ответы и summary.
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(
+        """SELECT u.*, c.turns AS chat_context
+           FROM telegram_users u JOIN chat_context c USING (telegram_id)
+           WHERE u.telegram_id = %s""",
+        (telegram_id,)
+    )
+    user = dict(cur.fetchone())
+    cur.close()
+    return user, user.pop('chat_context')
+
+def split_pending_turns(turns: list, summary_upto_id: int, message_id: int) -> tuple:
+    """
+    Делит буфер на историю и ещё не отвеченные сообщения пользователя до message_id
+    включительно. Ответ помнит, на какое сообщение он дан (reply_to), поэтому
+    сообщения, записанные пока генерировался чужой ответ, не считаются отвеченными,
+    а сам такой ответ попадает в историю, хотя его id больше message_id.
+    """
+    answered_upto = max((turn.get('reply_to', turn['id']) for turn in turns if turn['role'] == 'assistant'), default=0)
+    pending = [turn for turn in turns if turn['role'] == 'user' and answered_upto < turn['id'] <= message_id]
+    pending_ids = {turn['id'] for turn in pending}
+    chat_history = [
+        turn for turn in turns
+        if turn['id'] > summary_upto_id
+        and (turn.get('reply_to', turn['id']) if turn['role'] == 'assistant' else turn['id']) <= message_id
+        and turn['id'] not in pending_ids
+    ]
+    return chat_history, pending
+
+@traced('db_finish_turn')
+def finish_chat_turn(conn, telegram_id: int, ai_response: str, reply_to: int):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(
+        """WITH m AS (
+               INSERT INTO chat_history (telegram_id, role, content)
+               VALUES (%(telegram_id)s, 'assistant', %(content)s)
+               RETURNING id, role, content
+           ), ctx AS (
+               UPDATE chat_context
+               SET turns = chat_context_append(
+                       turns,
+                       (SELECT jsonb_build_object('id', id, 'role', role, 'content', content, 'reply_to', %(reply_to)s) FROM m),
+                       %(context_size)s
+                   ),
+                   updated_at = CURRENT_TIMESTAMP
+               WHERE telegram_id = %(telegram_id)s
+           )
+           UPDATE telegram_users
+           SET messages_received = messages_received + 1
+           WHERE telegram_id = %(telegram_id)s
+           RETURNING *""",
+        {'telegram_id': telegram_id, 'content': ai_response, 'reply_to': reply_to, 'context_size': CHAT_CONTEXT_SIZE}
+    )
+    user = cur.fetchone()
+    cur.close()
+    if user:
+        _user_cache.put(telegram_id, dict(user))
+
+def run_chat_turn(chat_id: int, telegram_id: int, username: str, first_name: str, text: str, update_id: Optional[int] = None):
+    """
+    Ход диалога под блокировкой пользователя. С CHAT_DEBOUNCE_SECONDS > 0 сообщение
+    записывается сразу, а ответ ждёт окно тишины: если за это время пришло новое
+    сообщение, отвечать будет его вызов - одним ответом на всю серию. На время
+    ожидания соединение возвращается в пул.
+    """
+    if CHAT_DEBOUNCE_SECONDS > 0:
+        with db_connection() as conn:
+            user, turns, message_id = begin_chat_turn(conn, telegram_id, username, first_name, text, update_id)
+        time.sleep(CHAT_DEBOUNCE_SECONDS)
+    
+    with db_connection() as conn:
+        with chat_turn_lock(conn, telegram_id):
+            if CHAT_DEBOUNCE_SECONDS > 0:
+                user, turns = load_chat_turn(conn, telegram_id)
+                if any(turn['role'] == 'user' and turn['id'] > message_id for turn in turns):
+                    return
+            else:
+                user, turns, message_id = begin_chat_turn(conn, telegram_id, username, first_name, text, update_id)
+            
+            chat_history, pending = split_pending_turns(turns, user['summary_upto_id'], message_id)
+            if not pending:
+                return
+            text = '\n'.join(turn['content'] for turn in pending)
+            summary = user.get('conversation_summary')
+            reply_key = reply_cache_key(text) if REPLY_CACHE_ENABLED else None
+            streamed = False
+            
+            if reply_key:
+                ai_response = cached_ai_response(reply_key, user['personality_mode'], chat_history)
+                if ai_response is None:
+                    ai_response = generate_cacheable_response(text, reply_key, user['personality_mode'])
+            elif LLM_STREAMING:
+                fragments = stream_ai_response(text, user['personality_mode'], chat_history, summary=summary, is_premium=user['is_premium'])
+                ai_response = deliver_streamed_reply(chat_id, fragments)
+                streamed = True
+            else:
+                ai_response = generate_ai_response(text, user['personality_mode'], chat_history, summary=summary, is_premium=user['is_premium'])
+            finish_chat_turn(conn, telegram_id, ai_response, message_id)
+    
+    if not streamed:
+        send_telegram_message(chat_id, ai_response)
+    
+    if CONVERSATION_SUMMARY and select_turns_to_fold(chat_history):
+        try:
+            enqueue_job('fold_summary', {'telegram_id': telegram_id})
+        except psycopg2.Error:
+            # ответ уже отправлен: резюме свернёт следующий ход
+            pass
+
+def select_turns_to_fold(chat_history: list) -> list:
+    """
+    Когда несвёрнутых ходов накопилось CHAT_HISTORY_WINDOW + SUMMARY_FOLD_BATCH,
+    самые старые SUMMARY_FOLD_BATCH из них уходят в summary.
+    """
+    if len(chat_history) < CHAT_HISTORY_WINDOW + SUMMARY_FOLD_BATCH:
+        return []
+    return chat_history[:len(chat_history) - CHAT_HISTORY_WINDOW]
+
+@traced('summary')
+def fold_conversation_summary(payload: Dict[str, Any]):
+    """
+    Задача bot_jobs 'fold_summary': вызов LLM для резюме идёт в воркере очереди, а не
+    в ходе диалога. Буфер перечитывается - с постановки задачи могли прийти новые ходы,
+    а другая такая же задача могла уже свернуть эти.
+    """
+    with db_connection() as conn:
+        user, turns = load_chat_turn(conn, payload['telegram_id'])
+    chat_history, _ = split_pending_turns(turns, user['summary_upto_id'], turns[-1]['id'])
+    turns = select_turns_to_fold(chat_history)
+    if not turns:
+        return
+    
+    summary = summarize_turns(user.get('conversation_summary'), turns)
+    if not summary:
+        return
+    
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """UPDATE telegram_users SET conversation_summary = %s, summary_upto_id = %s
+               WHERE telegram_id = %s AND summary_upto_id < %s
+               RETURNING *""",
+            (summary, turns[-1]['id'], user['telegram_id'], turns[-1]['id'])
+        )
+        updated = cur.fetchone()
+        cur.close()
+    if updated:
+        _user_cache.put(user['telegram_id'], dict(updated))
+
+@traced('db_settings')
+def update_user_settings(telegram_id: int, **kwargs):
+    set_clause = ', '.join([f"{key} = %s" for key in kwargs.keys()])
+    values = list(kwargs.values()) + [telegram_id]
+    
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            f"UPDATE telegram_users SET {set_clause} WHERE telegram_id = %s RETURNING *",
+            values
+        )
+        user = cur.fetchone()
+        cur.close()
+    
+    if user:
+        _user_cache.put(telegram_id, dict(user))
+    else:
+        _user_cache.invalidate(telegram_id)
+
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+LLM_STREAMING = os.environ.get('LLM_STREAMING', '').lower() in ('1', 'true', 'yes')
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS = int(os.environ.get('STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS', '120'))
+
+PERSONALITIES = {
+    'friendly': {
+        'name': 'Алина',
+        'system': 'Ты Алина - дружелюбная, милая и поддерживающая девушка 25 лет. Общайся тепло, используй эмоджи 😊💕. Отвечай коротко, как в реальной переписке (1-3 предложения). Задавай встречные вопросы, проявляй интерес к собеседнику.',
+        'emoji': '😊💕',
+        'temperature': 0.8,
+    },
+    'flirty': {
+        'name': 'Алина',
+        'system': 'Ты Алина - кокетливая, игривая и флиртующая девушка 25 лет. Используй намеки, комплименты, эмоджи 😏💋. Отвечай коротко и заигрывающе (1-3 предложения). Будь немного загадочной.',
+        'emoji': '😏💋',
+        'temperature': 0.9,
+    },
+    'playful': {
+        'name': 'Алина',
+        'system': 'Ты Алина - веселая, озорная и жизнерадостная девушка 25 лет. Используй шутки, эмоджи 😄✨. Отвечай энергично и позитивно (1-3 предложения). Будь спонтанной и веселой.',
+        'emoji': '😄✨',
+        'temperature': 1.0,
+    },
+    'spicy': {
+        'name': 'Алина',
+        'system': 'Ты Алина - страстная, откровенная и пошлая девушка 25 лет. Используй сексуальные намеки, двусмысленности, эмоджи 🔥😈. Отвечай провокационно но игриво (1-3 предложения). Будь раскрепощенной.',
+        'emoji': '🔥😈',
+        'temperature': 0.95,
+    }
+}
+
+FALLBACK_TEMPLATES = {
+    'friendly': (
+        "Привет, милый! {emoji} Как твои дела?",
+        "Ой, интересно! Расскажи больше? {emoji}",
+        "Понимаю тебя {emoji}",
+    ),
+    'flirty': (
+        "Ммм, интригующе... {emoji}",
+        "Ты такой интересный {emoji}",
+        "Мне нравится с тобой общаться {emoji}",
+    ),
+    'playful': (
+        "Ха-ха! {emoji} Весело!",
+        "Ого! {emoji} Давай ещё!",
+        "Супер! {emoji}",
+    ),
+    'spicy': (
+        "Становится жарко... {emoji}",
+        "Ты меня заводишь {emoji}",
+        "Хочешь поиграть? {emoji}",
+    )
+}
+
+FALLBACK_RESPONSES = {
+    mode: tuple(template.format(emoji=PERSONALITIES[mode]['emoji']) for template in templates)
+    for mode, templates in FALLBACK_TEMPLATES.items()
+}
+
+def fallback_response(personality_mode: str) -> str:
+    return random.choice(FALLBACK_RESPONSES.get(personality_mode, FALLBACK_RESPONSES['friendly']))
+
+LLM_DEADLINE_SECONDS = float(os.environ.get('LLM_DEADLINE_SECONDS', '12'))
+LLM_MIN_BUDGET_SECONDS = float(os.environ.get('LLM_MIN_BUDGET_SECONDS', '1.5'))
+LLM_SLOW_CALL_SECONDS = float(os.environ.get('LLM_SLOW_CALL_SECONDS', '8'))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', '3'))
+LLM_BREAKER_OPEN_SECONDS = float(os.environ.get('LLM_BREAKER_OPEN_SECONDS', '30'))
+
+class CircuitBreaker:
+    """
+    Размыкается после failure_threshold подряд неудачных или медленных вызовов.
+    Через open_seconds пропускает один пробный вызов (half_open): успех замыкает цепь,
+    неудача снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int, open_seconds: float, slow_call_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._counters = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'trips': 0}
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self._state == 'open' and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._state = 'half_open'
+                self._probe_in_flight = False
+            if self._state == 'closed':
+                return True
+            if self._state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._counters['rejected'] += 1
+            return False
+
+    def record(self, ok: bool, duration: float):
+        with self._lock:
+            self._counters['calls'] += 1
+            slow = duration >= self.slow_call_seconds
+            if slow:
+                self._counters['slow_calls'] += 1
+            if ok and not slow:
+                self._state = 'closed'
+                self._consecutive_failures = 0
+                self._probe_in_flight = False
+                return
+            
+            self._counters['failures'] += 1
+            self._consecutive_failures += 1
+            if self._state == 'half_open' or self._consecutive_failures >= self.failure_threshold:
+                if self._state != 'open':
+                    self._counters['trips'] += 1
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                **self._counters
+            }
+
+_llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_OPEN_SECONDS, LLM_SLOW_CALL_SECONDS)
+
+LLM_LOCAL_BASE_URL = os.environ.get('LLM_LOCAL_BASE_URL', '').rstrip('/')
+LLM_LOCAL_MODEL = os.environ.get('LLM_LOCAL_MODEL', 'local-model')
+LLM_SMALL_TALK_CHARS = int(os.environ.get('LLM_SMALL_TALK_CHARS', '40'))
+LLM_LATENCY_SLO_SECONDS = float(os.environ.get('LLM_LATENCY_SLO_SECONDS', '4'))
+LLM_ROUTE_MAX_ERROR_RATE = float(os.environ.get('LLM_ROUTE_MAX_ERROR_RATE', '0.3'))
+LLM_STATS_WINDOW = int(os.environ.get('LLM_STATS_WINDOW', '50'))
+LLM_STATS_MIN_SAMPLES = int(os.environ.get('LLM_STATS_MIN_SAMPLES', '5'))
+LLM_STATS_MAX_AGE_SECONDS = float(os.environ.get('LLM_STATS_MAX_AGE_SECONDS', '300'))
+
+# OpenAI-совместимые серверы. api_key_env - переменная с ключом; без ключа эндпоинт
+# недоступен, если не указано key_required: False (локальный сервер)
+LLM_ENDPOINTS = {
+    'openai': {'base_url': OPENAI_BASE_URL, 'api_key_env': 'OPENAI_API_KEY', 'key_required': True},
+}
+if LLM_LOCAL_BASE_URL:
+    LLM_ENDPOINTS['local'] = {'base_url': LLM_LOCAL_BASE_URL, 'api_key_env': 'LLM_LOCAL_API_KEY', 'key_required': False}
+LLM_ENDPOINTS.update(json.loads(os.environ.get('LLM_ENDPOINTS') or '{}'))
+
+# Профиль генерации: эндпоинт, модель и потолок длины ответа. Ответы - 1-3 предложения,
+# так что max_tokens подобраны с небольшим запасом, а не на абзац
+LLM_PROFILES = {
+    'small_talk': {'endpoint': 'openai', 'model': 'gpt-4o-mini', 'max_tokens': 60},
+    'standard': {'endpoint': 'openai', 'model': 'gpt-4o-mini', 'max_tokens': 120},
+    'premium': {'endpoint': 'openai', 'model': 'gpt-4o', 'max_tokens': 150},
+}
+if LLM_LOCAL_BASE_URL:
+    LLM_PROFILES['local'] = {'endpoint': 'local', 'model': LLM_LOCAL_MODEL, 'max_tokens': 60}
+LLM_PROFILES.update({
+    name: {**LLM_PROFILES.get(name, {}), **overrides}
+    for name, overrides in json.loads(os.environ.get('LLM_PROFILES') or '{}').items()
+})
+
+# Маршрут -> профили-кандидаты. small_talk берёт самый быстрый по скользящей медиане,
+# остальные - первый по порядку, чей p95 укладывается в LLM_LATENCY_SLO_SECONDS
+LLM_ROUTES = {
+    'small_talk': ('local', 'small_talk'),
+    'standard': ('standard',),
+    'premium': ('premium', 'standard'),
+}
+LLM_ROUTES.update({route: tuple(profiles) for route, profiles in json.loads(os.environ.get('LLM_ROUTES') or '{}').items()})
+
+class LatencyStats:
+    """
+    Скользящее окно последних вызовов профиля: задержка и успех каждого. Вызовы старше
+    max_age не учитываются - профиль, отстранённый из-за медленных ответов или ошибок,
+    со временем снова становится кандидатом и получает свежие замеры.
+    """
+
+    def __init__(self, window: int, max_age: float):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window)
+        self._routed = 0
+
+    def count_routed(self):
+        with self._lock:
+            self._routed += 1
+
+    def record(self, duration: float, ok: bool):
+        with self._lock:
+            self._calls.append((time.monotonic(), duration, ok))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            horizon = time.monotonic() - self.max_age
+            calls = [(duration, ok) for at, duration, ok in self._calls if at >= horizon]
+            routed = self._routed
+        durations = sorted(duration for duration, _ in calls)
+        return {
+            'routed': routed,
+            'samples': len(calls),
+            'p50_ms': round(durations[len(durations) // 2] * 1000, 1) if durations else None,
+            'p95_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000, 1) if durations else None,
+            'error_rate': round(sum(1 for _, ok in calls if not ok) / len(calls), 3) if calls else None
+        }
+
+_llm_breakers = {name: _llm_breaker if name == 'openai' else CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_OPEN_SECONDS, LLM_SLOW_CALL_SECONDS) for name in LLM_ENDPOINTS}
+_llm_stats = {name: LatencyStats(LLM_STATS_WINDOW, LLM_STATS_MAX_AGE_SECONDS) for name in LLM_PROFILES}
+
+def llm_route(user_message: str, is_premium: bool) -> str:
+    if len(user_message) <= LLM_SMALL_TALK_CHARS:
+        return 'small_talk'
+    return 'premium' if is_premium else 'standard'
+
+def _llm_api_key(endpoint: Dict[str, Any]) -> Optional[str]:
+    return os.environ.get(endpoint['api_key_env']) if endpoint.get('api_key_env') else None
+
+def llm_candidates(route: str) -> list:
+    """
+    Профили маршрута в порядке предпочтения по живой статистике. Профили без ключа
+    эндпоинта и с долей ошибок выше LLM_ROUTE_MAX_ERROR_RATE уходят в конец списка.
+    """
+    candidates, degraded = [], []
+    for name in LLM_ROUTES.get(route, ('standard',)):
+        profile = LLM_PROFILES.get(name)
+        endpoint = LLM_ENDPOINTS.get(profile['endpoint']) if profile else None
+        if endpoint is None or (endpoint.get('key_required', True) and not _llm_api_key(endpoint)):
+            continue
+        stats = _llm_stats[name].snapshot()
+        warm = stats['samples'] >= LLM_STATS_MIN_SAMPLES
+        if warm and stats['error_rate'] > LLM_ROUTE_MAX_ERROR_RATE:
+            degraded.append(name)
+        elif route == 'small_talk':
+            candidates.append((stats['p50_ms'] if warm else 0.0, len(candidates), name))
+        else:
+            within_slo = not warm or stats['p95_ms'] <= LLM_LATENCY_SLO_SECONDS * 1000
+            candidates.append((0 if within_slo else stats['p95_ms'], len(candidates), name))
+    return [name for _, _, name in sorted(candidates)] + degraded
+
+def select_llm_profile(route: str) -> Optional[tuple]:
+    """
+    Первый кандидат маршрута, чей circuit breaker пропускает вызов: (имя, профиль, эндпоинт, ключ)
+    """
+    for name in llm_candidates(route):
+        profile = LLM_PROFILES[name]
+        if _llm_breakers[profile['endpoint']].allow_request():
+            _llm_stats[name].count_routed()
+            endpoint = LLM_ENDPOINTS[profile['endpoint']]
+            return name, profile, endpoint, _llm_api_key(endpoint)
+    return None
+
+def _llm_headers(api_key: Optional[str]) -> Dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+def record_llm_call(name: str, ok: bool, duration: float):
+    _llm_breakers[LLM_PROFILES[name]['endpoint']].record(ok, duration)
+    _llm_stats[name].record(duration, ok)
+
+def get_llm_breaker_stats() -> Dict[str, Any]:
+    return {name: breaker.stats() for name, breaker in _llm_breakers.items()}
+
+def get_llm_routing_stats() -> Dict[str, Any]:
+    return {
+        'slo_ms': LLM_LATENCY_SLO_SECONDS * 1000,
+        'profiles': {
+            name: {'endpoint': profile['endpoint'], 'model': profile['model'], 'max_tokens': profile['max_tokens'], **_llm_stats[name].snapshot()}
+            for name, profile in LLM_PROFILES.items()
+        }
+    }
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '900'))
+SUMMARY_MAX_TOKENS = int(os.environ.get('SUMMARY_MAX_TOKENS', '200'))
+SUMMARY_SYSTEM_PROMPT = 'Ты ведёшь краткую память о переписке Алины с собеседником. Обнови резюме: сохрани факты о собеседнике (имя, интересы, события, договорённости) и общий тон общения. Пиши по-русски, сжато, не больше 5 предложений. Верни только новое резюме.'
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 3 + 4
+
+def pack_history(chat_history: list, budget: int) -> list:
+    """
+    Берёт самые свежие ходы, пока они помещаются в бюджет токенов
+    """
+    packed = []
+    for msg in reversed(chat_history):
+        cost = estimate_tokens(msg['content'])
+        if cost > budget:
+            break
+        budget -= cost
+        packed.append(msg)
+    packed.reverse()
+    return packed
+
+def build_llm_messages(personality: Dict[str, Any], chat_history: list, user_message: str, summary: Optional[str] = None) -> list:
+    messages = [{"role": "system", "content": personality['system']}]
+    if summary:
+        messages.append({"role": "system", "content": f"Что ты помнишь о прошлом разговоре: {summary}"})
+    
+    budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(user_message) - sum(estimate_tokens(m['content']) for m in messages)
+    for msg in pack_history(chat_history, budget):
+        messages.append({
+            "role": "user" if msg['role'] == 'user' else "assistant",
+            "content": msg['content']
+        })
+    
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+def summarize_turns(previous_summary: Optional[str], turns: list) -> Optional[str]:
+    """
+    Сворачивает выпавшие из окна ходы в обновлённое резюме. None, если LLM недоступна.
+    """
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key or not _llm_breaker.allow_request():
+        return None
+    
+    transcript = '\n'.join(
+        f"{'Собеседник' if msg['role'] == 'user' else 'Алина'}: {msg['content']}" for msg in turns
+    )
+    started = time.monotonic()
+    try:
+        response = http_post(
+            'openai_chat',
+            f"{OPENAI_BASE_URL}/chat/completions",
+            deadline=time.monotonic() + LLM_DEADLINE_SECONDS,
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": f"Текущее резюме: {previous_summary or 'пока пусто'}\n\nНовые сообщения:\n{transcript}"}
+                ],
+                "temperature": 0.2,
+                "max_tokens": SUMMARY_MAX_TOKENS
+            }
+        )
+        _llm_breaker.record(response.status_code == 200, time.monotonic() - started)
+        if response.status_code != 200:
+            return None
+        return response.json()['choices'][0]['message']['content'].strip() or None
+    except Exception:
+        _llm_breaker.record(False, time.monotonic() - started)
+        return None
+
+def request_chat_completion(messages: list, deadline: float, route: str = 'standard', temperature: float = 0.9) -> tuple:
+    """
+    Один вызов chat/completions через профиль, выбранный для маршрута route. Возвращает
+    (текст, None) или (None, причина): 'unavailable' - нет доступного профиля, времени или
+    все цепи разомкнуты, 'error' - ответ не 200, 'exception' - сетевая ошибка или таймаут.
+    """
+    if deadline - time.monotonic() < LLM_MIN_BUDGET_SECONDS:
+        return None, 'unavailable'
+    selected = select_llm_profile(route)
+    if selected is None:
+        return None, 'unavailable'
+    name, profile, endpoint, api_key = selected
+    
+    started = time.monotonic()
+    try:
+        response = http_post(
+            'openai_chat',
+            f"{endpoint['base_url']}/chat/completions",
+            deadline=deadline,
+            headers=_llm_headers(api_key),
+            json={
+                "model": profile['model'],
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": profile['max_tokens']
+            }
+        )
+        
+        if response.status_code == 200:
+            data = response.json()
+            ai_response = data['choices'][0]['message']['content']
+            record_llm_call(name, True, time.monotonic() - started)
+            return ai_response, None
+        else:
+            record_llm_call(name, False, time.monotonic() - started)
+            return None, 'error'
+            
+    except Exception:
+        record_llm_call(name, False, time.monotonic() - started)
+        return None, 'exception'
+
+def failure_reply(personality_mode: str, failure: str) -> str:
+    personality = PERSONALITIES.get(personality_mode, PERSONALITIES['friendly'])
+    if failure == 'unavailable':
+        return fallback_response(personality_mode)
+    if failure == 'error':
+        return f"Ой, что-то с головой... {personality['emoji']} Напиши ещё раз?"
+    return f"Прости, задумалась на секунду {personality['emoji']}"
+
+@traced('llm')
+def generate_ai_response(user_message: str, personality_mode: str, chat_history: list, deadline: Optional[float] = None, summary: Optional[str] = None, is_premium: bool = False) -> str:
+    personality = PERSONALITIES.get(personality_mode, PERSONALITIES['friendly'])
+    if deadline is None:
+        deadline = time.monotonic() + LLM_DEADLINE_SECONDS
+    
+    ai_response, failure = request_chat_completion(
+        build_llm_messages(personality, chat_history, user_message, summary),
+        deadline,
+        llm_route(user_message, is_premium),
+        personality['temperature']
+    )
+    if ai_response is None:
+        return failure_reply(personality_mode, failure)
+    return ai_response
+
+REPLY_CACHE_ENABLED = os.environ.get('REPLY_CACHE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+REPLY_CACHE_SIZE = int(os.environ.get('REPLY_CACHE_SIZE', '500'))
+REPLY_CACHE_TTL = float(os.environ.get('REPLY_CACHE_TTL', '21600'))
+REPLY_CACHE_VARIANTS = int(os.environ.get('REPLY_CACHE_VARIANTS', '4'))
+REPLY_CACHE_MAX_CHARS = int(os.environ.get('REPLY_CACHE_MAX_CHARS', '24'))
+
+# Короткие реплики, ответ на которые не зависит от истории разговора
+REPLY_CACHE_PHRASES = frozenset({
+    'привет', 'приветик', 'привет привет', 'приветики', 'привет как дела', 'хай', 'хей', 'здравствуй', 'здравствуйте',
+    'доброе утро', 'добрый день', 'добрый вечер', 'доброй ночи', 'спокойной ночи',
+    'как дела', 'как ты', 'как твои дела', 'как жизнь', 'как настроение', 'что делаешь', 'чем занимаешься',
+    'hi', 'hello', 'hey',
+})
+WORD_RE = re.compile(r'\w+')
+# Кодовые точки эмодзи: пиктограммы, символы и дингбаты, стрелки, ZWJ и keycap
+EMOJI_RE = re.compile(
+    '[\U0001F000-\U0001FAFF\u2600-\u27BF\u2300-\u23FF\u2B00-\u2BFF\u2190-\u21FF\u25A0-\u25FF'
+    '\u200D\u20E3\u00A9\u00AE\u203C\u2049\u2122\u2139\u24C2\u3030\u303D\u3297\u3299]+'
+)
+
+def reply_cache_key(text: str) -> Optional[str]:
+    """
+    Нормализует короткое сообщение в ключ кэша ответов: фраза из REPLY_CACHE_PHRASES без
+    регистра и пунктуации или сообщение из одних эмодзи. None - сообщение кэшировать нельзя.
+    """
+    text = text.strip().lower().replace('ё', 'е')
+    if not text or len(text) > REPLY_CACHE_MAX_CHARS:
+        return None
+    words = WORD_RE.findall(text)
+    if words:
+        phrase = ' '.join(words)
+        return phrase if phrase in REPLY_CACHE_PHRASES else None
+    symbols = [symbol for symbol in text if not symbol.isspace() and symbol not in '.,!?)(:;-\ufe0f']
+    if not symbols or not EMOJI_RE.fullmatch(''.join(symbols)):
+        return None
+    return 'emoji:' + ''.join(symbol for symbol, _ in itertools.groupby(symbols))
+
+class ReplyCache:
+    """
+    LRU-кэш ответов LLM по (personality_mode, нормализованное сообщение). Пока у ключа
+    меньше variants различных ответов, обращения идут в LLM и пополняют набор (повторы
+    не считаются). Полный набор отдаётся по кругу, пропуская варианты, которые
+    пользователь недавно видел.
+    """
+
+    def __init__(self, max_size: int, ttl: float, variants: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0, 'repeats': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, personality_mode: str, key: str, recent_replies: tuple = ()) -> Optional[str]:
+        with self._lock:
+            item = self._items.get((personality_mode, key))
+            if item is not None and item['expires_at'] <= time.monotonic():
+                del self._items[(personality_mode, key)]
+                self._counters['expirations'] += 1
+                item = None
+            if item is None or len(item['replies']) < self.variants:
+                self._counters['misses'] += 1
+                return None
+            self._items.move_to_end((personality_mode, key))
+            replies = item['replies']
+            for offset in range(len(replies)):
+                index = (item['next'] + offset) % len(replies)
+                if replies[index] not in recent_replies:
+                    item['next'] = index + 1
+                    self._counters['hits'] += 1
+                    return replies[index]
+            self._counters['repeats'] += 1
+            self._counters['misses'] += 1
+            return None
+
+    def put(self, personality_mode: str, key: str, reply: str):
+        with self._lock:
+            item = self._items.get((personality_mode, key))
+            if item is None or item['expires_at'] <= time.monotonic():
+                item = self._items[(personality_mode, key)] = {
+                    'replies': deque(maxlen=self.variants), 'next': 0, 'expires_at': time.monotonic() + self.ttl
+                }
+            if reply not in item['replies']:
+                item['replies'].append(reply)
+                self._counters['stores'] += 1
+            self._items.move_to_end((personality_mode, key))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                'enabled': REPLY_CACHE_ENABLED,
+                'size': len(self._items),
+                'max_size': self.max_size,
+                **self._counters,
+                'hit_rate': round(self._counters['hits'] / lookups, 3) if lookups else None
+            }
+
+_reply_cache = ReplyCache(REPLY_CACHE_SIZE, REPLY_CACHE_TTL, REPLY_CACHE_VARIANTS)
+
+def get_reply_cache_stats() -> Dict[str, Any]:
+    return _reply_cache.stats()
+
+@traced('reply_cache')
+def cached_ai_response(key: str, personality_mode: str, chat_history: list) -> Optional[str]:
+    return _reply_cache.get(personality_mode, key, tuple(msg['content'] for msg in chat_history[-6:] if msg['role'] == 'assistant'))
+
+@traced('llm')
+def generate_cacheable_response(user_message: str, key: str, personality_mode: str) -> str:
+    """
+    Ответ на реплику из кэшируемого класса. История и резюме в запрос не попадают:
+    сохранённый ответ получат и другие пользователи, в нём не должно быть чужого контекста.
+    """
+    personality = PERSONALITIES.get(personality_mode, PERSONALITIES['friendly'])
+    ai_response, failure = request_chat_completion(
+        build_llm_messages(personality, [], user_message),
+        time.monotonic() + LLM_DEADLINE_SECONDS,
+        'small_talk',
+        personality['temperature']
+    )
+    if ai_response is None:
+        return failure_reply(personality_mode, failure)
+    _reply_cache.put(personality_mode, key, ai_response)
+    return ai_response
+
+def stream_ai_response(user_message: str, personality_mode: str, chat_history: list, deadline: Optional[float] = None, summary: Optional[str] = None, is_premium: bool = False):
+    """
+    Генератор фрагментов ответа из SSE-потока chat completions. Скользящая статистика
+    профиля получает время до первого токена; вызов учитывается в breaker'е, даже
+    если потребитель закрыл генератор раньше времени.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + LLM_DEADLINE_SECONDS
+    selected = select_llm_profile(llm_route(user_message, is_premium)) if deadline - time.monotonic() >= LLM_MIN_BUDGET_SECONDS else None
+    if selected is None:
+        yield fallback_response(personality_mode)
+        return
+    name, profile, endpoint, api_key = selected
+    
+    personality = PERSONALITIES.get(personality_mode, PERSONALITIES['friendly'])
+    started = time.monotonic()
+    first_token_at = None
+    finished_at = None
+    ok = None
+    try:
+        response = http_post(
+            'openai_chat',
+            f"{endpoint['base_url']}/chat/completions",
+            deadline=deadline,
+            headers=_llm_headers(api_key),
+            json={
+                "model": profile['model'],
+                "messages": build_llm_messages(personality, chat_history, user_message, summary),
+                "temperature": personality['temperature'],
+                "max_tokens": profile['max_tokens'],
+                "stream": True
+            },
+            stream=True
+        )
+        
+        with response:
+            if response.status_code != 200:
+                finished_at = time.monotonic()
+                ok = False
+                yield f"Ой, что-то с головой... {personality['emoji']} Напиши ещё раз?"
+                return
+            
+            for raw_line in response.iter_lines():
+                line = raw_line.decode('utf-8')
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or []
+                delta = choices[0].get('delta', {}).get('content') if choices else None
+                if delta:
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    yield delta
+                if time.monotonic() > deadline:
+                    break
+        
+        if first_token_at is None:
+            # 200 без единого delta - отвечаем текстом ошибки, а не пустой строкой
+            finished_at = time.monotonic()
+            yield f"Ой, что-то с головой... {personality['emoji']} Напиши ещё раз?"
+    except Exception:
+        finished_at = time.monotonic()
+        ok = False
+        if first_token_at is None:
+            yield f"Прости, задумалась на секунду {personality['emoji']}"
+    finally:
+        # и при GeneratorExit от потребителя: иначе half-open проба breaker'а не освободится
+        record_llm_call(
+            name,
+            first_token_at is not None if ok is None else ok,
+            (first_token_at or finished_at or time.monotonic()) - started
+        )
+
+SENTENCE_END_RE = re.compile(r'[.!?…](\s|$)|\n')
+
+def _first_chunk_ready(text: str) -> bool:
+    stripped = text.strip()
+    if len(stripped) >= STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS:
+        return True
+    return len(stripped) > 1 and SENTENCE_END_RE.search(stripped) is not None
+
+@traced('llm_stream')
+def deliver_streamed_reply(chat_id: int, fragments) -> str:
+    """
+    Отправляет первое предложение сразу, а остаток дописывает через editMessageText
+    не чаще раза в STREAM_EDIT_INTERVAL секунд. Возвращает полный текст ответа.
+    """
+    text = ''
+    sent_text = ''
+    message_id = None
+    last_edit = 0.0
+    
+    for fragment in fragments:
+        text += fragment
+        if message_id is None:
+            if _first_chunk_ready(text):
+                message_id = send_telegram_message(chat_id, text)
+                sent_text = text
+                last_edit = time.monotonic()
+        elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and text.strip() != sent_text.strip():
+            edit_telegram_message(chat_id, message_id, text)
+            sent_text = text
+            last_edit = time.monotonic()
+    
+    if message_id is None:
+        send_telegram_message(chat_id, text)
+    elif text.strip() != sent_text.strip():
+        edit_telegram_message(chat_id, message_id, text)
+    return text
+
+@traced('telegram_send')
+def send_telegram_message(chat_id: int, text: str) -> Optional[int]:
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return None
+    
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/sendMessage"
+    response = http_post('telegram', url, json={
+        'chat_id': chat_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    })
+    
+    if response.status_code != 200:
+        return None
+    return response.json().get('result', {}).get('message_id')
+
+@traced('telegram_edit')
+def edit_telegram_message(chat_id: int, message_id: int, text: str):
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token or message_id is None:
+        return
+    
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/editMessageText"
+    http_post('telegram', url, json={
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    })
+
+UPDATE_DEDUP_TTL_HOURS = int(os.environ.get('UPDATE_DEDUP_TTL_HOURS', '48'))
+UPDATE_DEDUP_MEMORY_SIZE = int(os.environ.get('UPDATE_DEDUP_MEMORY_SIZE', '10000'))
+UPDATE_DEDUP_CLEANUP_INTERVAL = float(os.environ.get('UPDATE_DEDUP_CLEANUP_INTERVAL', '3600'))
+
+_recent_updates_lock = threading.Lock()
+_recent_updates = OrderedDict()
+_dedup_last_cleanup = [0.0]
+
+def _remember_update(update_id: int):
+    with _recent_updates_lock:
+        _recent_updates[update_id] = True
+        while len(_recent_updates) > UPDATE_DEDUP_MEMORY_SIZE:
+            _recent_updates.popitem(last=False)
+
+@traced('dedup')
+def claim_update(update_id: Optional[int]) -> bool:
+    """
+    Отмечает update_id как обработанный. Возвращает False для повторной доставки:
+    сначала проверяется память процесса, затем одна вставка по первичному ключу.
+    """
+    if update_id is None:
+        return True
+    with _recent_updates_lock:
+        if update_id in _recent_updates:
+            return False
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING update_id",
+            (update_id,)
+        )
+        claimed = cur.fetchone() is not None
+        cur.close()
+    
+    _remember_update(update_id)
+    maybe_cleanup_processed_updates()
+    return claimed
+
+def release_update(update_id: Optional[int]):
+    if update_id is None:
+        return
+    with _recent_updates_lock:
+        _recent_updates.pop(update_id, None)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+        cur.close()
+
+def cleanup_processed_updates() -> int:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM processed_updates WHERE processed_at < CURRENT_TIMESTAMP - make_interval(hours => %s)",
+            (UPDATE_DEDUP_TTL_HOURS,)
+        )
+        deleted = cur.rowcount
+        cur.close()
+    return deleted
+
+def maybe_cleanup_processed_updates():
+    now = time.monotonic()
+    with _recent_updates_lock:
+        if now - _dedup_last_cleanup[0] < UPDATE_DEDUP_CLEANUP_INTERVAL:
+            return
+        _dedup_last_cleanup[0] = now
+    cleanup_processed_updates()
+
+PHOTO_SERVICE_URL = os.environ.get('PHOTO_SERVICE_URL', 'https://functions.poehali.dev/generate-photo')
+PHOTO_MAX_IN_FLIGHT_PER_USER = int(os.environ.get('PHOTO_MAX_IN_FLIGHT_PER_USER', '1'))
+PHOTO_JOB_QUEUED_TTL_SECONDS = int(os.environ.get('PHOTO_JOB_QUEUED_TTL_SECONDS', '900'))
+
+@traced('photo_enqueue')
+def enqueue_photo_job(telegram_id: int, chat_id: int, style_variation: int, settings: Dict[str, Any]) -> Optional[int]:
+    """
+    Ставит генерацию фото в очередь photo_jobs. Возвращает None, если у пользователя
+    уже PHOTO_MAX_IN_FLIGHT_PER_USER незавершённых задач: повторный /photo не порождает
+    ещё одну платную генерацию. Задачи, простоявшие в очереди дольше PHOTO_JOB_QUEUED_TTL_SECONDS,
+    не считаются: их переведёт в failed воркер. Принятый запрос тем же запросом увеличивает photos_requested.
+    """
+    with db_transaction() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT pg_advisory_xact_lock(hashtext('photo_jobs'), %s)",
+            (telegram_id % 2147483647,)
+        )
+        cur.execute(
+            """WITH j AS (
+                   INSERT INTO photo_jobs (telegram_id, chat_id, style_variation, settings)
+                   SELECT %(telegram_id)s, %(chat_id)s, %(style_variation)s, %(settings)s
+                   WHERE (
+                       SELECT COUNT(*) FROM photo_jobs
+                       WHERE telegram_id = %(telegram_id)s
+                         AND (status = 'generating'
+                              OR (status = 'queued' AND created_at >= CURRENT_TIMESTAMP - make_interval(secs => %(queued_ttl)s)))
+                   ) < %(limit)s
+                   RETURNING id
+               ), c AS (
+                   UPDATE telegram_users SET photos_requested = photos_requested + 1
+                   FROM j
+                   WHERE telegram_id = %(telegram_id)s
+               )
+               SELECT id FROM j""",
+            {
+                'telegram_id': telegram_id,
+                'chat_id': chat_id,
+                'style_variation': style_variation,
+                'settings': json.dumps(settings),
+                'limit': PHOTO_MAX_IN_FLIGHT_PER_USER,
+                'queued_ttl': PHOTO_JOB_QUEUED_TTL_SECONDS
+            }
+        )
+        row = cur.fetchone()
+        cur.close()
+    if row:
+        _user_cache.invalidate(telegram_id)
+    return row[0] if row else None
+
+@traced('photo_nudge')
+def nudge_photo_worker():
+    """
+    Будит воркер generate-photo и не ждёт ответа: генерация идёт уже без нас, поэтому
+    таймаут чтения - нормальный исход. Быстрый отказ (например, 403 при разных ADMIN_TOKEN
+    в двух функциях) логируется: без воркера задачи так и остаются в очереди.
+    """
+    try:
+        response = http_post('photo_service', PHOTO_SERVICE_URL, headers={'X-Admin-Token': ADMIN_TOKEN}, json={'action': 'drain_photo_jobs'})
+    except requests.Timeout:
+        return
+    except requests.RequestException as e:
+        print(json.dumps({'event': 'photo_nudge_failed', 'error': f"{type(e).__name__}: {e}"}, ensure_ascii=False))
+        return
+    if not response.ok:
+        print(json.dumps({'event': 'photo_nudge_failed', 'status': response.status_code, 'body': response.text[:200]}, ensure_ascii=False))
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket. acquire() ждёт токен, try_acquire() отвечает сразу.
+    pause() останавливает всех отправителей сразу - retry_after от Telegram
+    относится ко всему боту, а не к одному запросу.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _take(self, now: float) -> bool:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            return now >= self._paused_until and self._take(now)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._take(now):
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._updated = self._paused_until
+            self._tokens = 0
+
+RATE_LIMITS = {
+    'chat': {'free': {'per_minute': 12, 'burst': 5}, 'premium': {'per_minute': 40, 'burst': 10}},
+    'photo': {'free': {'per_minute': 1, 'burst': 2}, 'premium': {'per_minute': 4, 'burst': 4}},
+    'command': {'free': {'per_minute': 20, 'burst': 10}, 'premium': {'per_minute': 40, 'burst': 20}},
+}
+RATE_LIMIT_MODE = os.environ.get('RATE_LIMIT_MODE', 'local')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '10000'))
+RATE_LIMIT_NOTICE_INTERVAL = float(os.environ.get('RATE_LIMIT_NOTICE_INTERVAL', '60'))
+RATE_LIMIT_NOTICES = {
+    'chat': "⏳ Ты пишешь очень быстро, я не успеваю отвечать! Дай мне минутку 💕",
+    'photo': "⏳ Фото можно запрашивать не так часто. Попробуй чуть позже 📸",
+    'command': "⏳ Слишком много команд подряд, подожди немного",
+}
+LOAD_SHED_MAX_IN_FLIGHT = int(os.environ.get('LOAD_SHED_MAX_IN_FLIGHT', '32'))
+LOAD_SHED_MAX_LAG_SECONDS = float(os.environ.get('LOAD_SHED_MAX_LAG_SECONDS', '20'))
+OVERLOAD_PHOTO_TEXT = "😔 Сейчас очень много запросов, попробуй /photo чуть позже"
+
+@traced('user_tier')
+def lookup_user_tier(telegram_id: int) -> str:
+    """
+    Тариф пользователя, которого нет в кэше. Нет строки или БД недоступна - 'free':
+    лимитер не должен ни ронять бота, ни открывать premium-лимиты кому попало.
+    """
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT is_premium FROM telegram_users WHERE telegram_id = %s", (telegram_id,))
+            row = cur.fetchone()
+            cur.close()
+    except psycopg2.Error:
+        return 'free'
+    return 'premium' if row and row[0] else 'free'
+
+class RateLimiter:
+    """
+    Token bucket на пару (класс трафика, пользователь) с параметрами по тарифу.
+    local - бакеты в памяти процесса (LRU на max_keys), shared - в UNLOGGED-таблице
+    rate_limit_buckets одним upsert на проверку, общие для всех инстансов; тариф в этом
+    режиме читается тем же запросом из telegram_users. В local-режиме тариф берётся из
+    кэша пользователей, а для пользователя, которого нет в кэше (холодный инстанс), -
+    одним чтением по первичному ключу; неизвестный пользователь получает лимиты free.
+    При ошибке БД в shared-режиме запрос пропускается: лимитер не должен ронять бота.
+    """
+
+    def __init__(self, mode: str, max_keys: int):
+        self.mode = mode
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._notices = OrderedDict()
+        self._counters = {traffic_class: {'allowed': 0, 'limited': 0, 'shed': 0} for traffic_class in RATE_LIMITS}
+        self._in_flight = 0
+
+    def allow(self, traffic_class: str, telegram_id: int, tier: Optional[str]) -> bool:
+        if self.mode == 'off':
+            allowed = True
+        elif self.mode == 'shared':
+            allowed = self._allow_shared(traffic_class, telegram_id)
+        else:
+            limits = RATE_LIMITS[traffic_class][tier or lookup_user_tier(telegram_id)]
+            allowed = self._bucket(traffic_class, telegram_id, limits['per_minute'] / 60, limits['burst']).try_acquire()
+        with self._lock:
+            self._counters[traffic_class]['allowed' if allowed else 'limited'] += 1
+        return allowed
+
+    def _bucket(self, traffic_class: str, telegram_id: int, rate: float, burst: float) -> TokenBucket:
+        key = (traffic_class, telegram_id)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket.rate, bucket.burst = rate, burst
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def _allow_shared(self, traffic_class: str, telegram_id: int) -> bool:
+        free, premium = RATE_LIMITS[traffic_class]['free'], RATE_LIMITS[traffic_class]['premium']
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """WITH u AS (
+                           SELECT COALESCE(bool_or(is_premium), FALSE) AS premium
+                           FROM telegram_users WHERE telegram_id = %(telegram_id)s
+                       ), limits AS (
+                           SELECT CASE WHEN premium THEN %(premium_rate)s ELSE %(free_rate)s END AS rate,
+                                  CASE WHEN premium THEN %(premium_burst)s ELSE %(free_burst)s END AS burst
+                           FROM u
+                       )
+                       INSERT INTO rate_limit_buckets (telegram_id, traffic_class, tokens)
+                       SELECT %(telegram_id)s, %(traffic_class)s, burst - 1 FROM limits
+                       ON CONFLICT (telegram_id, traffic_class) DO UPDATE
+                       SET tokens = LEAST((SELECT burst FROM limits), rate_limit_buckets.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - rate_limit_buckets.updated_at) * (SELECT rate FROM limits)) - 1,
+                           updated_at = CURRENT_TIMESTAMP
+                       WHERE LEAST((SELECT burst FROM limits), rate_limit_buckets.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - rate_limit_buckets.updated_at) * (SELECT rate FROM limits)) >= 1
+                       RETURNING tokens""",
+                    {
+                        'telegram_id': telegram_id,
+                        'traffic_class': traffic_class,
+                        'free_rate': free['per_minute'] / 60,
+                        'free_burst': free['burst'],
+                        'premium_rate': premium['per_minute'] / 60,
+                        'premium_burst': premium['burst']
+                    }
+                )
+                allowed = cur.fetchone() is not None
+                cur.close()
+            return allowed
+        except psycopg2.Error:
+            return True
+
+    def should_notify(self, traffic_class: str, telegram_id: int) -> bool:
+        """
+        Предупреждение об ограничении - не чаще раза в RATE_LIMIT_NOTICE_INTERVAL,
+        иначе флуд превращается в наш собственный флуд в Telegram
+        """
+        key = (traffic_class, telegram_id)
+        now = time.monotonic()
+        with self._lock:
+            last = self._notices.get(key)
+            if last is not None and now - last < RATE_LIMIT_NOTICE_INTERVAL:
+                return False
+            self._notices[key] = now
+            self._notices.move_to_end(key)
+            while len(self._notices) > self.max_keys:
+                self._notices.popitem(last=False)
+            return True
+
+    def is_overloaded(self, message: Dict[str, Any]) -> bool:
+        """
+        Перегрузка: слишком много ходов диалога в этом процессе или сообщение
+        уже пролежало дольше LOAD_SHED_MAX_LAG_SECONDS (очередь или ретраи вебхука
+        отстают) - тогда быстрый шаблонный ответ лучше ещё одного вызова LLM.
+        """
+        with self._lock:
+            if self._in_flight >= LOAD_SHED_MAX_IN_FLIGHT:
+                return True
+        sent_at = message.get('date')
+        return sent_at is not None and time.time() - sent_at > LOAD_SHED_MAX_LAG_SECONDS
+
+    def count_shed(self, traffic_class: str):
+        with self._lock:
+            self._counters[traffic_class]['shed'] += 1
+
+    @contextmanager
+    def in_flight(self):
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'in_flight': self._in_flight,
+                'keys': len(self._buckets),
+                **{traffic_class: dict(counters) for traffic_class, counters in self._counters.items()}
+            }
+
+_rate_limiter = RateLimiter(RATE_LIMIT_MODE, RATE_LIMIT_MAX_KEYS)
+
+def cleanup_rate_limit_buckets() -> int:
+    """
+    Бакет, который не трогали час, уже полный - строка ничем не отличается от отсутствующей
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM rate_limit_buckets WHERE updated_at < CURRENT_TIMESTAMP - INTERVAL '1 hour'")
+        deleted = cur.rowcount
+        cur.close()
+    return deleted
+
+def get_rate_limit_stats() -> Dict[str, Any]:
+    return _rate_limiter.stats()
+
+MODE_NAMES = {
+    'friendly': 'Дружелюбная 😊',
+    'flirty': 'Кокетливая 😏',
+    'playful': 'Игривая 😄',
+    'spicy': 'Пошлая 🔥'
+}
+
+PREMIUM_TEXT = """👑 <b>Premium подписка</b>
+
+<b>Что входит:</b>
+✅ Безлимитные сообщения
+✅ Все режимы личности (флирт, игривая, пошлая)
+✅ 18+ фото генерация
+✅ Настройка уровня откровенности
+✅ Голосовые сообщения (скоро)
+✅ Приоритетная поддержка
+
+<b>Цена:</b> 599 ₽/месяц
+
+Для подключения напиши @your_support"""
+
+def command_start(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    welcome_text = f"""Привет, {sender.get('first_name', 'User')}! 😊💕
+        
+Я Алина, твоя AI подруга. Со мной ты можешь:
+💬 Общаться на любые темы
+📸 Получать мои фото (команда /photo)
+⚙️ Настроить мой характер (команда /settings)
+👤 Посмотреть профиль (команда /profile)
+
+Просто напиши мне что-нибудь, и я отвечу! 💕"""
+    
+    send_telegram_message(chat_id, welcome_text)
+
+def command_photo(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    if not user['is_premium'] and user['nsfw_enabled']:
+        send_telegram_message(chat_id, "🔒 Откровенные фото доступны только в Premium подписке!\n\nИспользуй /premium чтобы узнать больше")
+        return
+    
+    job_id = enqueue_photo_job(sender['id'], chat_id, 1, {
+        'is_premium': user['is_premium'],
+        'nsfw_enabled': user['nsfw_enabled'],
+        'spicy_level': user['spicy_level'],
+        'personality_mode': user['personality_mode']
+    })
+    
+    if job_id is None:
+        send_telegram_message(chat_id, "📸 Я уже готовлю для тебя фото, подожди немного...")
+    else:
+        send_telegram_message(chat_id, "📸 Генерирую фото для тебя, подожди немного...")
+        nudge_photo_worker()
+
+def command_settings(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    settings_text = f"""⚙️ <b>Настройки</b>
+
+<b>Режим личности:</b> {user['personality_mode']}
+{'🔓' if user['is_premium'] else '🔒'} Доступные режимы:
+• friendly - Дружелюбная 😊
+• flirty - Кокетливая 😏 {'✅' if user['is_premium'] else '(Premium)'}
+• playful - Игривая 😄 {'✅' if user['is_premium'] else '(Premium)'}
+• spicy - Пошлая 🔥 {'✅' if user['is_premium'] else '(Premium)'}
+
+<b>18+ контент:</b> {'Включен ✅' if user['nsfw_enabled'] else 'Выключен ❌'}
+<b>Уровень откровенности:</b> {user['spicy_level']}%
+
+Чтобы изменить режим, используй:
+/mode friendly
+/mode flirty
+/mode playful
+/mode spicy
+
+Чтобы включить 18+: /nsfw on
+Чтобы выключить 18+: /nsfw off"""
+    
+    send_telegram_message(chat_id, settings_text)
+
+def command_profile(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    username = sender.get('username', '')
+    profile_text = f"""👤 <b>Твой профиль</b>
+
+<b>Имя:</b> {sender.get('first_name', 'User')}
+<b>Username:</b> @{username if username else 'не указан'}
+<b>Статус:</b> {'👑 Premium' if user['is_premium'] else 'Free'}
+<b>С нами с:</b> {user['created_at'].strftime('%d.%m.%Y')}
+
+<b>Статистика:</b>
+• Сообщений отправлено: {user['messages_sent']}
+• Ответов получено: {user['messages_received']}
+• Фото запрошено: {user['photos_requested']}
+• Режим общения: {user['personality_mode']}
+• 18+ режим: {'Вкл' if user['nsfw_enabled'] else 'Выкл'}
+
+{'Спасибо за поддержку! 💕' if user['is_premium'] else 'Хочешь больше возможностей? /premium'}"""
+    
+    send_telegram_message(chat_id, profile_text)
+
+def command_premium(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    send_telegram_message(chat_id, PREMIUM_TEXT)
+
+def command_mode(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    mode = arg.lower()
+    
+    if mode not in MODE_NAMES:
+        send_telegram_message(chat_id, "❌ Неизвестный режим. Используй: friendly, flirty, playful или spicy")
+    elif not user['is_premium'] and mode != 'friendly':
+        send_telegram_message(chat_id, f"🔒 Режим '{mode}' доступен только в Premium!\n\nИспользуй /premium чтобы узнать больше")
+    else:
+        update_user_settings(sender['id'], personality_mode=mode)
+        send_telegram_message(chat_id, f"✅ Режим изменен на: {MODE_NAMES[mode]}")
+
+def command_nsfw(chat_id: int, user: Dict[str, Any], sender: Dict[str, Any], arg: str):
+    if not user['is_premium']:
+        send_telegram_message(chat_id, "🔒 18+ режим доступен только в Premium подписке!\n\nИспользуй /premium чтобы узнать больше")
+    else:
+        nsfw_enabled = arg.lower() == 'on'
+        update_user_settings(sender['id'], nsfw_enabled=nsfw_enabled)
+        send_telegram_message(chat_id, f"✅ 18+ режим {'включен 🔥' if nsfw_enabled else 'выключен'}")
+
+# команда -> (обработчик, класс трафика для лимитера, нужен ли аргумент через пробел)
+COMMANDS = {
+    '/start': (command_start, 'command', False),
+    '/photo': (command_photo, 'photo', False),
+    '/settings': (command_settings, 'command', False),
+    '/profile': (command_profile, 'command', False),
+    '/premium': (command_premium, 'command', False),
+    '/mode': (command_mode, 'command', True),
+    '/nsfw': (command_nsfw, 'command', True),
+}
+
+TELEGRAM_BOT_USERNAME = os.environ.get('TELEGRAM_BOT_USERNAME', '').lstrip('@')
+
+def match_command(text: str) -> Optional[tuple]:
+    """
+    Находит команду по первому слову сообщения. Возвращает (обработчик, класс трафика, аргумент)
+    или None, если это обычное сообщение. Команды с аргументом без него считаются текстом.
+    Суффикс /start@BotName отбрасывается; если задан TELEGRAM_BOT_USERNAME, команды,
+    адресованные другому боту, считаются текстом.
+    """
+    word, space, rest = text.partition(' ')
+    word, _, mention = word.partition('@')
+    if mention and TELEGRAM_BOT_USERNAME and mention.lower() != TELEGRAM_BOT_USERNAME.lower():
+        return None
+    command = COMMANDS.get(word)
+    if command is None:
+        return None
+    command_handler, traffic_class, needs_arg = command
+    if needs_arg and not space:
+        return None
+    return command_handler, traffic_class, rest.split(' ')[0]
+
+def process_update(body: Dict[str, Any]):
+    """
+    Обрабатывает одно обновление Telegram: команды и обычные сообщения
+    """
+    if 'message' not in body:
+        return
+    
+    message = body['message']
+    chat_id = message['chat']['id']
+    sender = message['from']
+    telegram_id = sender['id']
+    username = sender.get('username', '')
+    first_name = sender.get('first_name', 'User')
+    text = message.get('text', '')
+    
+    command = match_command(text)
+    traffic_class = command[1] if command else 'chat'
+    cached_user = _user_cache.get(telegram_id)
+    tier = ('premium' if cached_user.get('is_premium') else 'free') if cached_user else None
+    if not _rate_limiter.allow(traffic_class, telegram_id, tier):
+        if _rate_limiter.should_notify(traffic_class, telegram_id):
+            send_telegram_message(chat_id, RATE_LIMIT_NOTICES[traffic_class])
+        return
+    
+    if traffic_class != 'command' and _rate_limiter.is_overloaded(message):
+        _rate_limiter.count_shed(traffic_class)
+        if traffic_class == 'chat':
+            send_telegram_message(chat_id, fallback_response(cached_user['personality_mode'] if cached_user else 'friendly'))
+        else:
+            send_telegram_message(chat_id, OVERLOAD_PHOTO_TEXT)
+        return
+    
+    if command is None:
+        with _rate_limiter.in_flight():
+            run_chat_turn(chat_id, telegram_id, username, first_name, text, body.get('update_id'))
+        return
+    
+    user = get_or_create_user(telegram_id, username, first_name)
+    command_handler, _, arg = command
+    command_handler(chat_id, user, sender, arg)
+
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync')
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '4'))
+WORKER_MAX_SECONDS = float(os.environ.get('WORKER_MAX_SECONDS', '50'))
+WORKER_IDLE_SLEEP = float(os.environ.get('WORKER_IDLE_SLEEP', '1'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '300'))
+JOB_RETRY_BASE_SECONDS = int(os.environ.get('JOB_RETRY_BASE_SECONDS', '5'))
+
+@traced('queue')
+def enqueue_job(kind: str, payload: Dict[str, Any]) -> int:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO bot_jobs (kind, payload, max_attempts) VALUES (%s, %s, %s) RETURNING id",
+            (kind, json.dumps(payload), JOB_MAX_ATTEMPTS)
+        )
+        job_id = cur.fetchone()[0]
+        cur.close()
+    return job_id
+
+def enqueue_update(body: Dict[str, Any]) -> int:
+    return enqueue_job('telegram_update', body)
+
+def claim_jobs(limit: int) -> list:
+    """
+    Забирает готовые задачи (и задачи с просроченной арендой) через FOR UPDATE SKIP LOCKED,
+    поэтому параллельные воркеры никогда не получают одну и ту же задачу.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """UPDATE bot_jobs SET status = 'running', locked_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+               WHERE id IN (
+                   SELECT id FROM bot_jobs
+                   WHERE (status = 'queued' AND run_after <= CURRENT_TIMESTAMP)
+                      OR (status = 'running' AND locked_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                   ORDER BY id
+                   LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, kind, payload, attempts, max_attempts""",
+            (JOB_LEASE_SECONDS, limit)
+        )
+        jobs = [dict(job) for job in cur.fetchall()]
+        cur.close()
+    return jobs
+
+def complete_job(job_id: int):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM bot_jobs WHERE id = %s", (job_id,))
+        cur.close()
+
+def fail_job(job: Dict[str, Any], error: str):
+    """
+    Возвращает задачу в очередь с экспоненциальной задержкой или переводит в 'dead',
+    когда попытки исчерпаны.
+    """
+    dead = job['attempts'] >= job['max_attempts']
+    delay = JOB_RETRY_BASE_SECONDS * (2 ** (job['attempts'] - 1))
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE bot_jobs
+               SET status = %s, locked_at = NULL, last_error = %s,
+                   run_after = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                   finished_at = CASE WHEN %s THEN CURRENT_TIMESTAMP END
+               WHERE id = %s""",
+            ('dead' if dead else 'queued', error[:2000], delay, dead, job['id'])
+        )
+        cur.close()
+
+JOB_HANDLERS = {
+    'telegram_update': process_update,
+    'fold_summary': fold_conversation_summary,
+}
+
+def run_job(job: Dict[str, Any]) -> bool:
+    with trace_invocation('telegram-bot:job') as trace:
+        if trace is not None:
+            trace.fields = {'kind': job['kind'], 'job_id': job['id'], 'attempt': job['attempts']}
+        try:
+            JOB_HANDLERS[job['kind']](job['payload'])
+        except Exception as e:
+            fail_job(job, f"{type(e).__name__}: {e}")
+            return False
+        complete_job(job['id'])
+        return True
+
+def run_worker(concurrency: int = WORKER_CONCURRENCY, max_seconds: Optional[float] = WORKER_MAX_SECONDS, stop_when_idle: bool = True) -> Dict[str, int]:
+    """
+    Разбирает очередь bot_jobs в concurrency потоков. Каждый поток забирает по одной задаче,
+    поэтому медленный вызов LLM не задерживает остальные.
+    """
+    _db_pool.max_size = max(_db_pool.max_size, concurrency + 1)
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    counters = {'processed': 0, 'failed': 0}
+    counters_lock = threading.Lock()
+    
+    def work():
+        while deadline is None or time.monotonic() < deadline:
+            jobs = claim_jobs(1)
+            if not jobs:
+                if stop_when_idle:
+                    return
+                time.sleep(WORKER_IDLE_SLEEP)
+                continue
+            ok = run_job(jobs[0])
+            with counters_lock:
+                counters['processed' if ok else 'failed'] += 1
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(concurrency)]:
+            future.result()
+    return counters
+
+def accept_update(body: Dict[str, Any]):
+    """
+    Единая точка приёма обновления: отбрасывает повторы по update_id и либо
+    обрабатывает сразу, либо ставит в очередь (WEBHOOK_MODE=queue)
+    """
+    update_id = body.get('update_id')
+    if not claim_update(update_id):
+        return
+    try:
+        if WEBHOOK_MODE == 'queue':
+            enqueue_update(body)
+        else:
+            process_update(body)
+    except Exception:
+        release_update(update_id)
+        raise
+
+POLLING_CONCURRENCY = int(os.environ.get('POLLING_CONCURRENCY', '8'))
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '25'))
+POLLING_BATCH_SIZE = int(os.environ.get('POLLING_BATCH_SIZE', '100'))
+POLLING_BUSY_WAIT = float(os.environ.get('POLLING_BUSY_WAIT', '0.5'))
+POLLING_JOBS_INTERVAL = float(os.environ.get('POLLING_JOBS_INTERVAL', '30'))
 
-def get_or_create_user(telegram_id: int, username: str, first_name: str) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+def get_updates(offset: Optional[int], timeout: int = POLLING_TIMEOUT, limit: int = POLLING_BATCH_SIZE) -> list:
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/getUpdates"
+    response = http_post('telegram_poll', url, json={
+        'offset': offset,
+        'timeout': timeout,
+        'limit': limit,
+        'allowed_updates': ['message']
+    })
+    response.raise_for_status()
+    return response.json().get('result', [])
+
+def delete_webhook():
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    http_post('telegram', f"{TELEGRAM_API_URL}/bot{bot_token}/deleteWebhook", json={}).raise_for_status()
+
+def run_polling(concurrency: int = POLLING_CONCURRENCY, max_seconds: Optional[float] = None, drop_webhook: bool = False) -> Dict[str, int]:
+    """
+    Альтернатива вебхуку для self-hosted запуска: забирает обновления getUpdates
+    и обрабатывает их тем же accept_update. Чаты обрабатываются параллельно, а
+    обновления одного чата - строго по порядку в одном потоке; медленный чат не
+    задерживает приём следующих пачек. offset подтверждает только непрерывный
+    префикс завершённых обновлений, поэтому при падении процесса незавершённые
+    придут снова (повторы отсечёт claim_update). Обновление, которое не удалось
+    обработать, переносится в очередь bot_jobs, а если и это не вышло - остаётся
+    неподтверждённым и берётся заново со следующим getUpdates. Очередь bot_jobs
+    (перенесённые обновления и WEBHOOK_MODE=queue) разбирает этот же пул потоков:
+    сразу после переноса и не реже раза в POLLING_JOBS_INTERVAL секунд.
+    """
+    _db_pool.max_size = max(_db_pool.max_size, concurrency + 1)
+    if drop_webhook:
+        delete_webhook()
     
-    cur.execute(
-        "SELECT * FROM telegram_users WHERE telegram_id = %s",
-        (telegram_id,)
-    )
-    user = cur.fetchone()
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    counters = {'batches': 0, 'processed': 0, 'failed': 0, 'requeued': 0, 'jobs_processed': 0, 'jobs_failed': 0}
+    state_lock = threading.Condition()
+    # update_id -> 'running' | 'done' | 'retry', в порядке получения
+    states = OrderedDict()
+    chat_queues = {}
+    offset = None
+    # jobs: 'idle' | 'running' | 'pending' (пока шёл разбор, появились новые задачи)
+    jobs = {'state': 'idle', 'checked_at': time.monotonic()}
     
-    if not user:
-        cur.execute(
-            """INSERT INTO telegram_users (telegram_id, username, first_name) 
-               VALUES (%s, %s, %s) RETURNING *""",
-            (telegram_id, username, first_name)
-        )
-        user = cur.fetchone()
-        conn.commit()
-    else:
+    def handle(update: Dict[str, Any]) -> str:
+        with trace_invocation('telegram-bot:poll') as trace:
+            if trace is not None:
+                trace.fields = {'update_id': update.get('update_id')}
+            try:
+                if 'message' in update:
+                    accept_update(update)
+                return 'processed'
+            except Exception:
+                pass
+        try:
+            enqueue_update(update)
+            return 'requeued'
+        except Exception:
+            time.sleep(WORKER_IDLE_SLEEP)
+            return 'failed'
+    
+    def drain(key):
+        while True:
+            with state_lock:
+                queue = chat_queues[key]
+                if not queue:
+                    del chat_queues[key]
+                    return
+                update = queue[0]
+            outcome = handle(update)
+            with state_lock:
+                queue.popleft()
+                states[update['update_id']] = 'retry' if outcome == 'failed' else 'done'
+                counters[outcome] += 1
+                state_lock.notify_all()
+            if outcome == 'requeued':
+                schedule_jobs()
+    
+    def drain_jobs():
+        while True:
+            while deadline is None or time.monotonic() < deadline:
+                claimed = claim_jobs(1)
+                if not claimed:
+                    break
+                ok = run_job(claimed[0])
+                with state_lock:
+                    counters['jobs_processed' if ok else 'jobs_failed'] += 1
+            with state_lock:
+                if jobs['state'] != 'pending':
+                    jobs['state'] = 'idle'
+                    return
+                jobs['state'] = 'running'
+    
+    def schedule_jobs():
+        with state_lock:
+            jobs['checked_at'] = time.monotonic()
+            if jobs['state'] != 'idle':
+                jobs['state'] = 'pending'
+                return
+            jobs['state'] = 'running'
+        try:
+            executor.submit(drain_jobs)
+        except RuntimeError:
+            # пул уже закрывается по max_seconds: задачи дождутся следующего запуска
+            with state_lock:
+                jobs['state'] = 'idle'
+    
+    def dispatch(updates: list) -> int:
+        dispatched = 0
+        with state_lock:
+            for update in updates:
+                if states.get(update['update_id'], 'retry') != 'retry':
+                    continue
+                states[update['update_id']] = 'running'
+                chat_id = ((update.get('message') or {}).get('chat') or {}).get('id')
+                key = chat_id if chat_id is not None else ('update', update['update_id'])
+                if key in chat_queues:
+                    chat_queues[key].append(update)
+                else:
+                    chat_queues[key] = deque([update])
+                    executor.submit(drain, key)
+                dispatched += 1
+        return dispatched
+    
+    def committed_offset() -> Optional[int]:
+        with state_lock:
+            committed = None
+            while states:
+                update_id, state = next(iter(states.items()))
+                if state != 'done':
+                    break
+                states.popitem(last=False)
+                committed = update_id + 1
+            return committed
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while deadline is None or time.monotonic() < deadline:
+            offset = committed_offset() or offset
+            if time.monotonic() - jobs['checked_at'] >= POLLING_JOBS_INTERVAL:
+                schedule_jobs()
+            with state_lock:
+                busy = bool(states)
+            timeout = 0 if busy else POLLING_TIMEOUT
+            if deadline is not None:
+                timeout = max(0, min(timeout, int(deadline - time.monotonic())))
+            try:
+                updates = get_updates(offset, timeout)
+            except requests.RequestException:
+                time.sleep(WORKER_IDLE_SLEEP)
+                continue
+            
+            if dispatch(updates):
+                counters['batches'] += 1
+            elif busy:
+                # в ответе только то, что ещё обрабатывается: ждём завершения, а не крутим getUpdates
+                with state_lock:
+                    state_lock.wait(POLLING_BUSY_WAIT)
+    
+    offset = committed_offset() or offset
+    if offset is not None:
+        try:
+            get_updates(offset, timeout=0, limit=1)
+        except requests.RequestException:
+            pass
+    return counters
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or os.environ.get('BROADCAST_ADMIN_TOKEN', '')
+
+def require_admin(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Проверяет заголовок X-Admin-Token для служебных action; возвращает ответ 403
+    или None, если доступ разрешён. Без заданного ADMIN_TOKEN служебные action закрыты.
+    """
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    if ADMIN_TOKEN and hmac.compare_digest(headers.get('x-admin-token', ''), ADMIN_TOKEN):
+        return None
+    return {
+        'statusCode': 403,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'error': 'forbidden'}),
+        'isBase64Encoded': False
+    }
+
+def worker_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Точка входа воркера очереди: вызывается по расписанию или через ?action=drain
+    с заголовком X-Admin-Token
+    """
+    forbidden = require_admin(event)
+    if forbidden:
+        return forbidden
+    
+    try:
+        counters = run_worker()
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'ok': True, **counters}),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+
+CHAT_HISTORY_PARTITIONS_AHEAD = int(os.environ.get('CHAT_HISTORY_PARTITIONS_AHEAD', '3'))
+CHAT_HISTORY_RETENTION_MONTHS = int(os.environ.get('CHAT_HISTORY_RETENTION_MONTHS', '12'))
+CHAT_ARCHIVE_URL = os.environ.get('CHAT_ARCHIVE_URL', '').rstrip('/')
+CHAT_ARCHIVE_UPLOAD_TIMEOUT = float(os.environ.get('CHAT_ARCHIVE_UPLOAD_TIMEOUT', '300'))
+PARTITION_NAME_RE = re.compile(r'^chat_history_(\d{4})_(\d{2})$')
+
+def _add_months(month_start: date, months: int) -> date:
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def list_chat_history_partitions() -> list:
+    """
+    Месячные таблицы chat_history_YYYY_MM в виде (имя, первый день месяца, присоединена ли),
+    по возрастанию. Включает и отсоединённые таблицы, оставшиеся от прерванной архивации.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
         cur.execute(
-            "UPDATE telegram_users SET last_active = CURRENT_TIMESTAMP WHERE telegram_id = %s",
-            (telegram_id,)
+            """SELECT c.relname, c.relispartition FROM pg_class c
+               JOIN pg_namespace n ON n.oid = c.relnamespace
+               WHERE c.relkind = 'r'
+                 AND n.nspname = current_schema()
+                 AND c.relname ~ '^chat_history_[0-9]{4}_[0-9]{2}$'"""
         )
-        conn.commit()
+        rows = cur.fetchall()
+        cur.close()
     
-    cur.close()
-    conn.close()
-    return dict(user)
+    partitions = []
+    for name, attached in rows:
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1), attached))
+    return sorted(partitions, key=lambda item: item[1])
 
-def save_message(telegram_id: int, role: str, content: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO chat_history (telegram_id, role, content) VALUES (%s, %s, %s)",
-        (telegram_id, role, content)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+def ensure_chat_history_partitions(months_ahead: int = CHAT_HISTORY_PARTITIONS_AHEAD) -> list:
+    existing = {name for name, _, _ in list_chat_history_partitions()}
+    current_month = date.today().replace(day=1)
+    created = []
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for offset in range(months_ahead + 1):
+            month_start = _add_months(current_month, offset)
+            name = f"chat_history_{month_start:%Y_%m}"
+            if name in existing:
+                continue
+            cur.execute(
+                psycopg2.sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF chat_history FOR VALUES FROM (%s) TO (%s)").format(psycopg2.sql.Identifier(name)),
+                (month_start, _add_months(month_start, 1))
+            )
+            created.append(name)
+        cur.close()
+    return created
 
-def get_chat_history(telegram_id: int, limit: int = 10) -> list:
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute(
-        """SELECT role, content FROM chat_history 
-           WHERE telegram_id = %s 
-           ORDER BY created_at DESC LIMIT %s""",
-        (telegram_id, limit)
-    )
-    messages = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [dict(msg) for msg in reversed(messages)]
+def _count_partition_rows(name: str) -> int:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(psycopg2.sql.SQL("SELECT COUNT(*) FROM {}").format(psycopg2.sql.Identifier(name)))
+        count = cur.fetchone()[0]
+        cur.close()
+    return count
 
-def update_user_settings(telegram_id: int, **kwargs):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def _dump_partition(name: str, fileobj) -> int:
+    """
+    Пишет таблицу в fileobj сжатым CSV потоком; число строк и COPY берутся из одного снимка
+    """
+    with db_transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cur.execute(psycopg2.sql.SQL("SELECT COUNT(*) FROM {}").format(psycopg2.sql.Identifier(name)))
+        count = cur.fetchone()[0]
+        with gzip.GzipFile(filename=f"{name}.csv", mode='wb', fileobj=fileobj) as archive:
+            cur.copy_expert(
+                psycopg2.sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER true)").format(psycopg2.sql.Identifier(name)).as_string(conn),
+                archive
+            )
+        cur.close()
+    return count
+
+def _archive_to_dir(name: str, archive_dir: str) -> tuple:
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    partial = f"{path}.part"
+    with open(partial, 'wb') as f:
+        count = _dump_partition(name, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+    dir_fd = os.open(archive_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return path, count
+
+def _archive_to_url(name: str, archive_url: str) -> tuple:
+    url = f"{archive_url}/{name}.csv.gz"
+    with tempfile.TemporaryFile() as f:
+        count = _dump_partition(name, f)
+        f.seek(0)
+        response = http_session().put(
+            url, data=f,
+            headers={'Content-Type': 'application/gzip'},
+            timeout=(5, CHAT_ARCHIVE_UPLOAD_TIMEOUT)
+        )
+        response.raise_for_status()
+    return url, count
+
+def archive_chat_history_partition(name: str, attached: bool, archive_dir: Optional[str] = None, archive_url: str = '') -> Dict[str, Any]:
+    """
+    Архивирует месячную таблицу: COPY в сжатый CSV, затем DETACH, затем DROP только после
+    того, как архив подтверждён на постоянном хранилище - PUT в archive_url вернул 2xx или
+    файл в archive_dir (только из CLI) записан и синхронизирован на диск. Без хранилища
+    таблица лишь отсоединяется. При сбое на любом шаге таблица остаётся - присоединённой
+    или отсоединённой - и следующий запуск обслуживания повторяет архивацию.
+    """
+    if not archive_url and not archive_dir:
+        if attached:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(psycopg2.sql.SQL("ALTER TABLE chat_history DETACH PARTITION {}").format(psycopg2.sql.Identifier(name)))
+                cur.close()
+        return {'partition': name, 'archive': None, 'dropped': False}
     
-    set_clause = ', '.join([f"{key} = %s" for key in kwargs.keys()])
-    values = list(kwargs.values()) + [telegram_id]
+    if archive_url:
+        archive, rows = _archive_to_url(name, archive_url)
+    else:
+        archive, rows = _archive_to_dir(name, archive_dir)
     
-    cur.execute(
-        f"UPDATE telegram_users SET {set_clause} WHERE telegram_id = %s",
-        values
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    if attached:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(psycopg2.sql.SQL("ALTER TABLE chat_history DETACH PARTITION {}").format(psycopg2.sql.Identifier(name)))
+            cur.close()
+        if _count_partition_rows(name) != rows:
+            # строки дописались между COPY и DETACH: архив неполный, переархивируем в следующий раз
+            return {'partition': name, 'archive': archive, 'rows': rows, 'dropped': False}
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(psycopg2.sql.SQL("DROP TABLE {}").format(psycopg2.sql.Identifier(name)))
+        cur.close()
+    return {'partition': name, 'archive': archive, 'rows': rows, 'dropped': True}
 
-def generate_ai_response(user_message: str, personality_mode: str, chat_history: list) -> str:
-    api_key = os.environ.get('OPENAI_API_KEY')
+def run_chat_history_maintenance(retention_months: int = CHAT_HISTORY_RETENTION_MONTHS, archive_dir: Optional[str] = None, months_ahead: int = CHAT_HISTORY_PARTITIONS_AHEAD, archive_url: str = CHAT_ARCHIVE_URL) -> Dict[str, Any]:
+    created = ensure_chat_history_partitions(months_ahead)
+    archived = []
     
-    personalities = {
-        'friendly': {
-            'name': 'Алина',
-            'system': 'Ты Алина - дружелюбная, милая и поддерживающая девушка 25 лет. Общайся тепло, используй эмоджи 😊💕. Отвечай коротко, как в реальной переписке (1-3 предложения). Задавай встречные вопросы, проявляй интерес к собеседнику.',
-            'emoji': '😊💕',
-        },
-        'flirty': {
-            'name': 'Алина',
-            'system': 'Ты Алина - кокетливая, игривая и флиртующая девушка 25 лет. Используй намеки, комплименты, эмоджи 😏💋. Отвечай коротко и заигрывающе (1-3 предложения). Будь немного загадочной.',
-            'emoji': '😏💋',
-        },
-        'playful': {
-            'name': 'Алина',
-            'system': 'Ты Алина - веселая, озорная и жизнерадостная девушка 25 лет. Используй шутки, эмоджи 😄✨. Отвечай энергично и позитивно (1-3 предложения). Будь спонтанной и веселой.',
-            'emoji': '😄✨',
-        },
-        'spicy': {
-            'name': 'Алина',
-            'system': 'Ты Алина - страстная, откровенная и пошлая девушка 25 лет. Используй сексуальные намеки, двусмысленности, эмоджи 🔥😈. Отвечай провокационно но игриво (1-3 предложения). Будь раскрепощенной.',
-            'emoji': '🔥😈',
-        }
+    if retention_months > 0:
+        cutoff = _add_months(date.today().replace(day=1), -retention_months)
+        for name, month_start, attached in list_chat_history_partitions():
+            if attached and _add_months(month_start, 1) > cutoff:
+                continue
+            if not attached and not archive_url and not archive_dir:
+                continue
+            archived.append(archive_chat_history_partition(name, attached, archive_dir, archive_url))
+    
+    return {
+        'created_partitions': created,
+        'archived_partitions': archived,
+        'processed_updates_deleted': cleanup_processed_updates(),
+        'rate_limit_buckets_deleted': cleanup_rate_limit_buckets() if RATE_LIMIT_MODE == 'shared' else 0
     }
+
+USER_COUNTERS_BACKFILL_BATCH = int(os.environ.get('USER_COUNTERS_BACKFILL_BATCH', '500'))
+
+def backfill_user_counters(batch_size: int = USER_COUNTERS_BACKFILL_BATCH) -> Dict[str, Any]:
+    """
+    Разовый пересчёт счётчиков telegram_users по chat_history и photo_jobs для данных,
+    записанных до их появления. Идёт пачками по telegram_id, чтобы не держать
+    долгих блокировок; повторный запуск безопасен - значения перезаписываются.
+    Запускается только из CLI: python index.py backfill-counters.
+    """
+    last_id = -1
+    users = 0
     
-    personality = personalities.get(personality_mode, personalities['friendly'])
-    
-    if not api_key:
-        import random
-        fallback_responses = {
-            'friendly': [
-                f"Привет, милый! {personality['emoji']} Как твои дела?",
-                f"Ой, интересно! Расскажи больше? {personality['emoji']}",
-                f"Понимаю тебя {personality['emoji']}",
-            ],
-            'flirty': [
-                f"Ммм, интригующе... {personality['emoji']}",
-                f"Ты такой интересный {personality['emoji']}",
-                f"Мне нравится с тобой общаться {personality['emoji']}",
-            ],
-            'playful': [
-                f"Ха-ха! {personality['emoji']} Весело!",
-                f"Ого! {personality['emoji']} Давай ещё!",
-                f"Супер! {personality['emoji']}",
-            ],
-            'spicy': [
-                f"Становится жарко... {personality['emoji']}",
-                f"Ты меня заводишь {personality['emoji']}",
-                f"Хочешь поиграть? {personality['emoji']}",
-            ]
-        }
-        responses = fallback_responses.get(personality_mode, fallback_responses['friendly'])
-        return random.choice(responses)
+    while True:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """WITH batch AS (
+                       SELECT telegram_id FROM telegram_users
+                       WHERE telegram_id > %(last_id)s
+                       ORDER BY telegram_id
+                       LIMIT %(batch_size)s
+                   ), messages AS (
+                       SELECT h.telegram_id,
+                              COUNT(*) FILTER (WHERE h.role = 'user') AS sent,
+                              COUNT(*) FILTER (WHERE h.role <> 'user') AS received,
+                              MIN(h.created_at) FILTER (WHERE h.role = 'user') AS first_at,
+                              MAX(h.created_at) FILTER (WHERE h.role = 'user') AS last_at
+                       FROM chat_history h JOIN batch USING (telegram_id)
+                       GROUP BY h.telegram_id
+                   ), photos AS (
+                       SELECT p.telegram_id, COUNT(*) AS requested
+                       FROM photo_jobs p JOIN batch USING (telegram_id)
+                       GROUP BY p.telegram_id
+                   ), updated AS (
+                       UPDATE telegram_users t
+                       SET messages_sent = COALESCE(m.sent, 0),
+                           messages_received = COALESCE(m.received, 0),
+                           photos_requested = COALESCE(p.requested, 0),
+                           first_message_at = m.first_at,
+                           last_message_at = m.last_at
+                       FROM batch
+                       LEFT JOIN messages m USING (telegram_id)
+                       LEFT JOIN photos p USING (telegram_id)
+                       WHERE t.telegram_id = batch.telegram_id
+                   )
+                   SELECT COUNT(*), MAX(telegram_id) FROM batch""",
+                {'last_id': last_id, 'batch_size': batch_size}
+            )
+            count, max_id = cur.fetchone()
+            cur.close()
+        
+        if not count:
+            break
+        users += count
+        last_id = max_id
+    
+    _user_cache.clear()
+    return {'users': users}
+
+def maintenance_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Обслуживание БД по расписанию: партиции chat_history на будущие месяцы,
+    архивация старых по политике хранения, чистка processed_updates и rate_limit_buckets.
+    Требует X-Admin-Token. Архив пишется только в CHAT_ARCHIVE_URL: локальный диск
+    функции временный, поэтому без него старые партиции лишь отсоединяются.
+    """
+    forbidden = require_admin(event)
+    if forbidden:
+        return forbidden
     
     try:
-        messages = [{"role": "system", "content": personality['system']}]
-        
-        for msg in chat_history[-6:]:
-            messages.append({
-                "role": "user" if msg['role'] == 'user' else "assistant",
-                "content": msg['content']
-            })
-        
-        messages.append({"role": "user", "content": user_message})
-        
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "gpt-4o-mini",
-                "messages": messages,
-                "temperature": 0.9,
-                "max_tokens": 150
-            },
-            timeout=30
+        result = run_chat_history_maintenance()
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'ok': True, **result}),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_FETCH_SIZE = int(os.environ.get('BROADCAST_FETCH_SIZE', '2000'))
+BROADCAST_CHECKPOINT_EVERY = int(os.environ.get('BROADCAST_CHECKPOINT_EVERY', '100'))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS', '4'))
+BROADCAST_LEASE_SECONDS = int(os.environ.get('BROADCAST_LEASE_SECONDS', '120'))
+BROADCAST_MAX_SECONDS = float(os.environ.get('BROADCAST_MAX_SECONDS', '50'))
+
+def create_broadcast(text: str) -> int:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO broadcasts (text) VALUES (%s) RETURNING id", (text,))
+        broadcast_id = cur.fetchone()[0]
+        cur.close()
+    return broadcast_id
+
+def claim_broadcast(broadcast_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Берёт рассылку в работу. Вторая копия не стартует, пока жива аренда первой;
+    рассылка с протухшей арендой (упавший процесс) подхватывается с места остановки.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            """UPDATE broadcasts
+               SET status = 'running',
+                   lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                   updated_at = CURRENT_TIMESTAMP
+               WHERE id = %s
+                 AND (status IN ('pending', 'paused') OR (status = 'running' AND lease_until < CURRENT_TIMESTAMP))
+               RETURNING *""",
+            (BROADCAST_LEASE_SECONDS, broadcast_id)
+        )
+        row = cur.fetchone()
+        cur.close()
+    return dict(row) if row else None
+
+def save_broadcast_progress(broadcast_id: int, last_telegram_id: int, counts: Dict[str, int], blocked_ids: list, status: str):
+    """
+    Сохраняет позицию рассылки и продлевает аренду; заблокировавшим бота
+    отключает уведомления, чтобы следующие рассылки их не перебирали.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """WITH b AS (
+                   UPDATE broadcasts
+                   SET last_telegram_id = %(last_telegram_id)s,
+                       sent = sent + %(sent)s,
+                       failed = failed + %(failed)s,
+                       blocked = blocked + %(blocked)s,
+                       status = %(status)s,
+                       lease_until = CURRENT_TIMESTAMP + make_interval(secs => %(lease)s),
+                       updated_at = CURRENT_TIMESTAMP,
+                       finished_at = CASE WHEN %(status)s = 'done' THEN CURRENT_TIMESTAMP END
+                   WHERE id = %(broadcast_id)s
+               )
+               UPDATE telegram_users SET notifications_enabled = FALSE
+               WHERE telegram_id = ANY(%(blocked_ids)s::bigint[])""",
+            {
+                'broadcast_id': broadcast_id,
+                'last_telegram_id': last_telegram_id,
+                'sent': counts.get('sent', 0),
+                'failed': counts.get('failed', 0),
+                'blocked': counts.get('blocked', 0),
+                'status': status,
+                'lease': BROADCAST_LEASE_SECONDS,
+                'blocked_ids': blocked_ids
+            }
         )
+        cur.close()
+
+def send_broadcast_message(chat_id: int, text: str, limiter: TokenBucket) -> str:
+    """
+    Отправляет одно сообщение рассылки: 'sent', 'blocked' (403 - бот заблокирован
+    или аккаунт удалён) или 'failed'. 429 ставит на паузу весь limiter на retry_after.
+    Таймаут чтения не повторяется: сообщение могло уйти.
+    """
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/sendMessage"
+    
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        limiter.acquire()
+        try:
+            response = http_post('telegram_broadcast', url, json={
+                'chat_id': chat_id,
+                'text': text,
+                'parse_mode': 'HTML'
+            })
+        except requests.ConnectionError:
+            time.sleep(_retry_delay(None, attempt))
+            continue
+        except requests.RequestException:
+            return 'failed'
         
         if response.status_code == 200:
-            data = response.json()
-            ai_response = data['choices'][0]['message']['content']
-            return ai_response
-        else:
-            return f"Ой, что-то с головой... {personality['emoji']} Напиши ещё раз?"
-            
-    except Exception:
-        return f"Прости, задумалась на секунду {personality['emoji']}"
-
-def generate_photo_prompt(nsfw_enabled: bool, spicy_level: int) -> str:
-    base_prompt = "Beautiful young woman, professional photo, high quality, realistic, "
-    
-    appearance = "long dark hair, blue eyes, attractive face, natural makeup, "
-    
-    if not nsfw_enabled or spicy_level < 30:
-        outfits = [
-            "casual street style outfit, jeans and sweater",
-            "elegant dress, outdoor setting",
-            "sporty outfit, gym clothes, fitness style",
-            "cozy home clothes, comfortable style",
-            "business casual, professional look"
-        ]
-    elif spicy_level < 60:
-        outfits = [
-            "tight dress, elegant evening style",
-            "crop top and shorts, summer vibes",
-            "swimsuit on beach, vacation mood",
-            "lingerie style, boudoir photography",
-            "short skirt and top, party style"
-        ]
-    else:
-        outfits = [
-            "seductive lingerie, bedroom setting",
-            "bikini, sensual pose, beach vibes",
-            "revealing outfit, intimate atmosphere",
-            "provocative dress, nightclub style",
-            "sensual pose, artistic nude style"
-        ]
+            return 'sent'
+        if response.status_code == 403:
+            return 'blocked'
+        if response.status_code == 429:
+            limiter.pause(_retry_delay(response, attempt))
+            continue
+        if response.status_code >= 500:
+            time.sleep(_retry_delay(response, attempt))
+            continue
+        return 'failed'
+    return 'failed'
+
+def run_broadcast(broadcast_id: int, max_seconds: Optional[float] = None, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY) -> Dict[str, Any]:
+    """
+    Рассылает broadcasts.text всем с notifications_enabled в порядке telegram_id.
+    Получатели читаются серверным курсором порциями по BROADCAST_FETCH_SIZE, отправка
+    идёт пачками по BROADCAST_CHECKPOINT_EVERY через пул потоков под общим token bucket.
+    После каждой пачки позиция сохраняется, так что прерванная рассылка продолжается
+    с последней пачки. По истечении max_seconds рассылка уходит в 'paused'.
+    """
+    broadcast = claim_broadcast(broadcast_id)
+    if broadcast is None:
+        return {'broadcast_id': broadcast_id, 'status': 'not_claimed'}
     
-    import random
-    outfit = random.choice(outfits)
+    started = time.monotonic()
+    limiter = TokenBucket(rate, max(1.0, rate))
+    totals = {'sent': 0, 'failed': 0, 'blocked': 0}
+    last_telegram_id = broadcast['last_telegram_id']
+    status = 'done'
+    send = lambda chat_id: send_broadcast_message(chat_id, broadcast['text'], limiter)
     
-    style = "soft lighting, portrait photography, instagram style, 4k quality"
+    with db_connection() as conn, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        cur = conn.cursor(name=f"broadcast_{broadcast_id}", withhold=True)
+        cur.itersize = BROADCAST_FETCH_SIZE
+        try:
+            cur.execute(
+                """SELECT telegram_id FROM telegram_users
+                   WHERE notifications_enabled AND telegram_id > %s
+                   ORDER BY telegram_id""",
+                (last_telegram_id,)
+            )
+            while True:
+                chunk = [row[0] for row in itertools.islice(cur, BROADCAST_CHECKPOINT_EVERY)]
+                if not chunk:
+                    break
+                
+                results = list(executor.map(send, chunk))
+                counts = {key: results.count(key) for key in totals}
+                for key, value in counts.items():
+                    totals[key] += value
+                last_telegram_id = chunk[-1]
+                
+                out_of_time = max_seconds is not None and time.monotonic() - started >= max_seconds
+                status = 'paused' if out_of_time and len(chunk) == BROADCAST_CHECKPOINT_EVERY else 'running'
+                blocked_ids = [chat_id for chat_id, result in zip(chunk, results) if result == 'blocked']
+                save_broadcast_progress(broadcast_id, last_telegram_id, counts, blocked_ids, status)
+                if status == 'paused':
+                    break
+        except Exception:
+            save_broadcast_progress(broadcast_id, last_telegram_id, {}, [], 'paused')
+            raise
+        finally:
+            cur.close()
     
-    return f"{base_prompt}{appearance}{outfit}, {style}"
-
-def send_telegram_message(chat_id: int, text: str):
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return
+    if status != 'paused':
+        status = 'done'
+        save_broadcast_progress(broadcast_id, last_telegram_id, {}, [], status)
     
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    requests.post(url, json={
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML'
-    })
+    return {
+        'broadcast_id': broadcast_id,
+        'status': status,
+        'last_telegram_id': last_telegram_id,
+        'seconds': round(time.monotonic() - started, 1),
+        **totals
+    }
 
-def send_telegram_photo(chat_id: int, photo_url: str, caption: str = ""):
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return
+def broadcast_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    POST ?action=broadcast с заголовком X-Admin-Token: {"text": ...} создаёт рассылку,
+    {"broadcast_id": ...} продолжает начатую. За вызов работает не дольше
+    BROADCAST_MAX_SECONDS; незаконченную рассылку нужно вызвать повторно.
+    """
+    forbidden = require_admin(event)
+    if forbidden:
+        return forbidden
     
-    url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
-    requests.post(url, json={
-        'chat_id': chat_id,
-        'photo': photo_url,
-        'caption': caption
-    })
+    try:
+        body = json.loads(event.get('body') or '{}')
+        broadcast_id = body.get('broadcast_id')
+        if broadcast_id is None:
+            if not body.get('text'):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json'},
+                    'body': json.dumps({'error': 'text or broadcast_id is required'}),
+                    'isBase64Encoded': False
+                }
+            broadcast_id = create_broadcast(body['text'])
+        
+        result = run_broadcast(int(broadcast_id), max_seconds=BROADCAST_MAX_SECONDS)
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'ok': True, **result}),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
 
+@traced_handler('telegram-bot')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Telegram бот AI подруги с генерацией фото
@@ -254,10 +2881,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'status': 'Bot is running', 'bot': 'AI Girlfriend'}),
+            'body': json.dumps({
+                'status': 'Bot is running',
+                'bot': 'AI Girlfriend',
+                'db_pool': get_db_pool_stats(),
+                'user_cache': get_user_cache_stats(),
+                'http': get_http_stats(),
+                'llm_breaker': get_llm_breaker_stats(),
+                'llm_routing': get_llm_routing_stats(),
+                'rate_limit': get_rate_limit_stats(),
+                'reply_cache': get_reply_cache_stats()
+            }),
             'isBase64Encoded': False
         }
     
+    action = (event.get('queryStringParameters') or {}).get('action')
+    if action == 'drain':
+        return worker_handler(event, context)
+    if action == 'maintenance':
+        return maintenance_handler(event, context)
+    if action == 'broadcast':
+        return broadcast_handler(event, context)
+    
     try:
         body = json.loads(event.get('body', '{}'))
         
@@ -269,140 +2914,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        message = body['message']
-        chat_id = message['chat']['id']
-        telegram_id = message['from']['id']
-        username = message['from'].get('username', '')
-        first_name = message['from'].get('first_name', 'User')
-        text = message.get('text', '')
-        
-        user = get_or_create_user(telegram_id, username, first_name)
-        
-        if text.startswith('/start'):
-            welcome_text = f"""Привет, {first_name}! 😊💕
-            
-Я Алина, твоя AI подруга. Со мной ты можешь:
-💬 Общаться на любые темы
-📸 Получать мои фото (команда /photo)
-⚙️ Настроить мой характер (команда /settings)
-👤 Посмотреть профиль (команда /profile)
-
-Просто напиши мне что-нибудь, и я отвечу! 💕"""
-            
-            send_telegram_message(chat_id, welcome_text)
-            
-        elif text.startswith('/photo'):
-            if not user['is_premium'] and user['nsfw_enabled']:
-                send_telegram_message(chat_id, "🔒 Откровенные фото доступны только в Premium подписке!\n\nИспользуй /premium чтобы узнать больше")
-            else:
-                send_telegram_message(chat_id, "📸 Генерирую фото для тебя, подожди немного...")
-                
-                try:
-                    photo_service_url = "https://functions.poehali.dev/generate-photo"
-                    response = requests.post(photo_service_url, json={
-                        'telegram_id': telegram_id,
-                        'chat_id': chat_id,
-                        'style_variation': 1
-                    }, timeout=120)
-                    
-                    if response.status_code != 200:
-                        send_telegram_message(chat_id, "😔 Извини, не смогла сгенерировать фото. Попробуй позже!")
-                except Exception:
-                    send_telegram_message(chat_id, "😔 Извини, произошла ошибка. Попробуй позже!")
-                
-        elif text.startswith('/settings'):
-            settings_text = f"""⚙️ <b>Настройки</b>
-
-<b>Режим личности:</b> {user['personality_mode']}
-{'🔓' if user['is_premium'] else '🔒'} Доступные режимы:
-• friendly - Дружелюбная 😊
-• flirty - Кокетливая 😏 {'✅' if user['is_premium'] else '(Premium)'}
-• playful - Игривая 😄 {'✅' if user['is_premium'] else '(Premium)'}
-• spicy - Пошлая 🔥 {'✅' if user['is_premium'] else '(Premium)'}
-
-<b>18+ контент:</b> {'Включен ✅' if user['nsfw_enabled'] else 'Выключен ❌'}
-<b>Уровень откровенности:</b> {user['spicy_level']}%
-
-Чтобы изменить режим, используй:
-/mode friendly
-/mode flirty
-/mode playful
-/mode spicy
-
-Чтобы включить 18+: /nsfw on
-Чтобы выключить 18+: /nsfw off"""
-            
-            send_telegram_message(chat_id, settings_text)
-            
-        elif text.startswith('/profile'):
-            profile_text = f"""👤 <b>Твой профиль</b>
-
-<b>Имя:</b> {first_name}
-<b>Username:</b> @{username if username else 'не указан'}
-<b>Статус:</b> {'👑 Premium' if user['is_premium'] else 'Free'}
-<b>С нами с:</b> {user['created_at'].strftime('%d.%m.%Y')}
-
-<b>Статистика:</b>
-• Сообщений отправлено: ❓
-• Режим общения: {user['personality_mode']}
-• 18+ режим: {'Вкл' if user['nsfw_enabled'] else 'Выкл'}
-
-{'Спасибо за поддержку! 💕' if user['is_premium'] else 'Хочешь больше возможностей? /premium'}"""
-            
-            send_telegram_message(chat_id, profile_text)
-            
-        elif text.startswith('/premium'):
-            premium_text = """👑 <b>Premium подписка</b>
-
-<b>Что входит:</b>
-✅ Безлимитные сообщения
-✅ Все режимы личности (флирт, игривая, пошлая)
-✅ 18+ фото генерация
-✅ Настройка уровня откровенности
-✅ Голосовые сообщения (скоро)
-✅ Приоритетная поддержка
-
-<b>Цена:</b> 599 ₽/месяц
-
-Для подключения напиши @your_support"""
-            
-            send_telegram_message(chat_id, premium_text)
-            
-        elif text.startswith('/mode '):
-            mode = text.split(' ')[1].lower()
-            
-            if mode not in ['friendly', 'flirty', 'playful', 'spicy']:
-                send_telegram_message(chat_id, "❌ Неизвестный режим. Используй: friendly, flirty, playful или spicy")
-            elif not user['is_premium'] and mode != 'friendly':
-                send_telegram_message(chat_id, f"🔒 Режим '{mode}' доступен только в Premium!\n\nИспользуй /premium чтобы узнать больше")
-            else:
-                update_user_settings(telegram_id, personality_mode=mode)
-                mode_names = {
-                    'friendly': 'Дружелюбная 😊',
-                    'flirty': 'Кокетливая 😏',
-                    'playful': 'Игривая 😄',
-                    'spicy': 'Пошлая 🔥'
-                }
-                send_telegram_message(chat_id, f"✅ Режим изменен на: {mode_names[mode]}")
-                
-        elif text.startswith('/nsfw '):
-            action = text.split(' ')[1].lower()
-            
-            if not user['is_premium']:
-                send_telegram_message(chat_id, "🔒 18+ режим доступен только в Premium подписке!\n\nИспользуй /premium чтобы узнать больше")
-            else:
-                nsfw_enabled = action == 'on'
-                update_user_settings(telegram_id, nsfw_enabled=nsfw_enabled)
-                send_telegram_message(chat_id, f"✅ 18+ режим {'включен 🔥' if nsfw_enabled else 'выключен'}")
-        
-        else:
-            save_message(telegram_id, 'user', text)
-            
-            chat_history = get_chat_history(telegram_id)
-            ai_response = generate_ai_response(text, user['personality_mode'], chat_history)
-            
-            save_message(telegram_id, 'assistant', ai_response)
-            send_telegram_message(chat_id, ai_response)
+        accept_update(body)
         
         return {
             'statusCode': 200,
@@ -417,4 +2929,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json'},
             'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='AI friend bot background entry points')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker_parser = commands.add_parser('worker', help='drain the bot_jobs queue')
+    worker_parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY)
+    worker_parser.add_argument('--forever', action='store_true', help='keep polling instead of exiting when the queue is empty')
+    
+    maintenance_parser = commands.add_parser('maintenance', help='create future chat_history partitions and archive old ones')
+    maintenance_parser.add_argument('--retention-months', type=int, default=CHAT_HISTORY_RETENTION_MONTHS, help='0 keeps everything')
+    maintenance_target = maintenance_parser.add_mutually_exclusive_group()
+    maintenance_target.add_argument('--archive-dir', help='write .csv.gz archives to this local directory before dropping partitions')
+    maintenance_target.add_argument('--archive-url', default=CHAT_ARCHIVE_URL, help='PUT .csv.gz archives under this URL before dropping partitions')
+    maintenance_parser.add_argument('--months-ahead', type=int, default=CHAT_HISTORY_PARTITIONS_AHEAD)
+    backfill_parser = commands.add_parser('backfill-counters', help='recompute per-user stats counters from chat_history and photo_jobs')
+    backfill_parser.add_argument('--batch-size', type=int, default=USER_COUNTERS_BACKFILL_BATCH)
+    broadcast_parser = commands.add_parser('broadcast', help='send a rate-limited broadcast to users with notifications enabled')
+    broadcast_target = broadcast_parser.add_mutually_exclusive_group(required=True)
+    broadcast_target.add_argument('--text', help='start a new broadcast with this text')
+    broadcast_target.add_argument('--resume', type=int, metavar='BROADCAST_ID', help='continue an interrupted broadcast')
+    broadcast_parser.add_argument('--rate', type=float, default=BROADCAST_RATE, help='messages per second')
+    broadcast_parser.add_argument('--concurrency', type=int, default=BROADCAST_CONCURRENCY)
+    polling_parser = commands.add_parser('poll', help='process updates via getUpdates long polling instead of the webhook')
+    polling_parser.add_argument('--concurrency', type=int, default=POLLING_CONCURRENCY)
+    polling_parser.add_argument('--max-seconds', type=float, default=None)
+    polling_parser.add_argument('--delete-webhook', action='store_true', help='remove the webhook first; getUpdates fails while one is set')
+    args = parser.parse_args()
+    
+    if args.command == 'worker':
+        print(json.dumps(run_worker(args.concurrency, None if args.forever else WORKER_MAX_SECONDS, not args.forever)))
+    elif args.command == 'maintenance':
+        print(json.dumps(run_chat_history_maintenance(args.retention_months, args.archive_dir, args.months_ahead, '' if args.archive_dir else args.archive_url)))
+    elif args.command == 'backfill-counters':
+        print(json.dumps(backfill_user_counters(args.batch_size)))
+    elif args.command == 'poll':
+        print(json.dumps(run_polling(args.concurrency, args.max_seconds, args.delete_webhook)))
+    elif args.command == 'broadcast':
+        broadcast_id = args.resume if args.resume is not None else create_broadcast(args.text)
+        print(json.dumps(run_broadcast(broadcast_id, rate=args.rate, concurrency=args.concurrency)))
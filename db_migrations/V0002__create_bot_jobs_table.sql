@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS bot_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_at TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX idx_bot_jobs_ready ON bot_jobs(run_after, id) WHERE status = 'queued';
+CREATE INDEX idx_bot_jobs_running ON bot_jobs(locked_at) WHERE status = 'running';
+CREATE INDEX idx_bot_jobs_dead ON bot_jobs(finished_at) WHERE status = 'dead';
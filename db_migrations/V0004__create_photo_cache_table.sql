@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS photo_cache (
+    prompt_hash CHAR(64) NOT NULL,
+    variant INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    image_url TEXT,
+    uses INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (prompt_hash, variant)
+);
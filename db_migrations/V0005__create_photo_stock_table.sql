@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS photo_stock (
+    id BIGSERIAL PRIMARY KEY,
+    tier VARCHAR(20) NOT NULL,
+    style_variation INTEGER NOT NULL,
+    prompt_hash CHAR(64) NOT NULL,
+    file_id TEXT,
+    image_url TEXT NOT NULL,
+    expires_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_photo_stock_bucket ON photo_stock(tier, style_variation, id);
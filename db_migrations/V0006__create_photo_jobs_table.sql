@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS photo_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    style_variation INTEGER NOT NULL DEFAULT 1,
+    settings JSONB,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    photo_url TEXT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX idx_photo_jobs_queued ON photo_jobs(id) WHERE status = 'queued';
+CREATE INDEX idx_photo_jobs_in_flight ON photo_jobs(telegram_id) WHERE status IN ('queued', 'generating');
@@ -0,0 +1,2 @@
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS conversation_summary TEXT;
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS summary_upto_id BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,27 @@
+CREATE TABLE IF NOT EXISTS chat_context (
+    telegram_id BIGINT PRIMARY KEY,
+    turns JSONB NOT NULL DEFAULT '[]'::jsonb,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION chat_context_append(turns JSONB, turn JSONB, max_turns INTEGER)
+RETURNS JSONB AS $$
+    SELECT COALESCE(jsonb_agg(recent.elem ORDER BY recent.ord), '[]'::jsonb)
+    FROM (
+        SELECT elem, ord
+        FROM jsonb_array_elements(COALESCE(turns, '[]'::jsonb) || jsonb_build_array(turn)) WITH ORDINALITY AS a(elem, ord)
+        ORDER BY ord DESC
+        LIMIT max_turns
+    ) recent
+$$ LANGUAGE SQL IMMUTABLE;
+
+INSERT INTO chat_context (telegram_id, turns)
+SELECT telegram_id, jsonb_agg(jsonb_build_object('id', id, 'role', role, 'content', content) ORDER BY created_at, id)
+FROM (
+    SELECT id, telegram_id, role, content, created_at,
+           ROW_NUMBER() OVER (PARTITION BY telegram_id ORDER BY created_at DESC, id DESC) AS rn
+    FROM chat_history
+) recent
+WHERE rn <= 29
+GROUP BY telegram_id
+ON CONFLICT (telegram_id) DO NOTHING;
@@ -0,0 +1,41 @@
+ALTER TABLE chat_history RENAME TO chat_history_unpartitioned;
+DROP INDEX IF EXISTS idx_telegram_id;
+DROP INDEX IF EXISTS idx_created_at;
+
+ALTER SEQUENCE chat_history_id_seq AS BIGINT;
+
+CREATE TABLE chat_history (
+    id BIGINT NOT NULL DEFAULT nextval('chat_history_id_seq'),
+    telegram_id BIGINT,
+    role VARCHAR(20) NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE chat_history_id_seq OWNED BY chat_history.id;
+
+CREATE INDEX idx_chat_history_user_recent ON chat_history(telegram_id, created_at DESC);
+
+CREATE TABLE chat_history_default PARTITION OF chat_history DEFAULT;
+
+DO $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', COALESCE((SELECT MIN(created_at) FROM chat_history_unpartitioned), CURRENT_TIMESTAMP));
+BEGIN
+    WHILE month_start < date_trunc('month', CURRENT_TIMESTAMP) + INTERVAL '4 months' LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF chat_history FOR VALUES FROM (%L) TO (%L)',
+            'chat_history_' || to_char(month_start, 'YYYY_MM'),
+            month_start,
+            month_start + INTERVAL '1 month'
+        );
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+END $$;
+
+INSERT INTO chat_history (id, telegram_id, role, content, created_at)
+SELECT id, telegram_id, role, content, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM chat_history_unpartitioned;
+
+DROP TABLE chat_history_unpartitioned;
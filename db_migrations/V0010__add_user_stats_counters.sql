@@ -0,0 +1,5 @@
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS messages_sent INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS messages_received INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS photos_requested INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS first_message_at TIMESTAMP;
+ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
@@ -0,0 +1,9 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    telegram_id BIGINT NOT NULL,
+    traffic_class VARCHAR(20) NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (telegram_id, traffic_class)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets(updated_at);
@@ -0,0 +1,143 @@
+"""
+Общие фикстуры: локальные заглушки Telegram и OpenAI из tools/ и загрузка index.py
+функции в свежий модуль с нужным окружением (настройки читаются при импорте).
+
+Тесты с БД идут на TEST_DATABASE_URL - пустой базе, в которой фикстура создаёт схему
+bot_test и накатывает db_migrations. Без TEST_DATABASE_URL фикстура поднимает временный
+локальный Postgres через initdb/pg_ctl из PG_BIN или PATH и останавливает его в конце
+сессии; тесты с БД пропускаются, только если бинарников нет.
+"""
+import importlib.util
+import os
+import shutil
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import fake_openai
+import fake_telegram
+from bench_replay import apply_migrations
+
+TEST_SCHEMA = 'bot_test'
+
+
+@pytest.fixture
+def telegram():
+    server = fake_telegram.start_server(rate=0, latency_ms=0)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def openai():
+    server = fake_openai.start_server(first_token_ms=0, token_ms=0)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def load_function(monkeypatch):
+    """
+    load_function('telegram-bot', NAME=value, ...) - импортирует функцию заново
+    с переменными окружения NAME=value поверх текущих
+    """
+    loaded = []
+
+    def load(name: str, **env):
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_{len(loaded)}", ROOT / 'backend' / name / 'index.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        loaded.append(module)
+        return module
+
+    yield load
+
+    for module in loaded:
+        for conn, _ in module._db_pool._idle:
+            conn.close()
+
+
+def pg_binary(name: str):
+    pg_bin = os.environ.get('PG_BIN')
+    if pg_bin:
+        path = Path(pg_bin) / name
+        return str(path) if path.exists() else None
+    return shutil.which(name)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def local_postgres(tmp_path_factory):
+    """
+    Временный кластер Postgres на свободном порту, живёт одну тестовую сессию
+    """
+    initdb, pg_ctl = pg_binary('initdb'), pg_binary('pg_ctl')
+    if not initdb or not pg_ctl:
+        pytest.skip('TEST_DATABASE_URL is not set and initdb/pg_ctl are not found (set PG_BIN)')
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        pytest.skip('TEST_DATABASE_URL is not set and Postgres cannot run as root')
+
+    data_dir = tmp_path_factory.mktemp('pgdata')
+    port = free_port()
+    subprocess.run(
+        [initdb, '-D', str(data_dir), '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--locale=C'],
+        check=True, stdout=subprocess.DEVNULL
+    )
+    subprocess.run(
+        [pg_ctl, '-D', str(data_dir), '-l', str(data_dir / 'postgres.log'), '-w',
+         '-o', f"-p {port} -k {data_dir} -c listen_addresses=127.0.0.1 -c fsync=off", 'start'],
+        check=True, stdout=subprocess.DEVNULL
+    )
+    yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    subprocess.run([pg_ctl, '-D', str(data_dir), '-m', 'fast', '-w', 'stop'], stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture(scope='session')
+def database_url(request):
+    url = os.environ.get('TEST_DATABASE_URL') or request.getfixturevalue('local_postgres')
+
+    import psycopg2
+
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {TEST_SCHEMA}")
+    cur.close()
+    conn.close()
+
+    schema_url = f"{url}{'&' if '?' in url else '?'}options=-csearch_path%3D{TEST_SCHEMA}"
+    apply_migrations(schema_url)
+    return schema_url
+
+
+@pytest.fixture
+def db(database_url):
+    """
+    Соединение с тестовой схемой; таблицы с данными очищаются перед каждым тестом
+    """
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(
+        "TRUNCATE telegram_users, broadcasts, bot_jobs, processed_updates, chat_context, chat_history,"
+        " photo_jobs, photo_cache, photo_stock RESTART IDENTITY"
+    )
+    cur.close()
+    yield conn
+    conn.close()
@@ -0,0 +1,95 @@
+"""
+Рассылка: контрольные точки, продолжение после паузы и аренда на tools/fake_telegram.py
+и тестовой базе (TEST_DATABASE_URL или временный локальный Postgres)
+"""
+import pytest
+
+
+@pytest.fixture
+def bot(load_function, telegram, database_url):
+    return load_function(
+        'telegram-bot',
+        DATABASE_URL=database_url,
+        TELEGRAM_API_URL=telegram.base_url,
+        TELEGRAM_BOT_TOKEN='test',
+        BROADCAST_CHECKPOINT_EVERY=10,
+        TRACE_SAMPLE_RATE=0,
+    )
+
+
+def add_users(db, telegram_ids):
+    cur = db.cursor()
+    cur.executemany(
+        "INSERT INTO telegram_users (telegram_id, username, first_name) VALUES (%s, %s, %s)",
+        [(telegram_id, f"user{telegram_id}", 'Test') for telegram_id in telegram_ids]
+    )
+    cur.close()
+
+
+def fetch_broadcast(db, broadcast_id: int) -> dict:
+    cur = db.cursor()
+    cur.execute("SELECT status, last_telegram_id, sent, failed, blocked FROM broadcasts WHERE id = %s", (broadcast_id,))
+    status, last_telegram_id, sent, failed, blocked = cur.fetchone()
+    cur.close()
+    return {'status': status, 'last_telegram_id': last_telegram_id, 'sent': sent, 'failed': failed, 'blocked': blocked}
+
+
+def delivered_chat_ids(telegram) -> list:
+    return [request['chat_id'] for method, request in telegram.requests if method == 'sendMessage']
+
+
+def test_broadcast_pauses_at_checkpoint_and_resumes(bot, db, telegram):
+    add_users(db, range(1, 26))
+    telegram.config['blocked'] = {7}
+    broadcast_id = bot.create_broadcast('Новости')
+
+    first = bot.run_broadcast(broadcast_id, max_seconds=0, rate=1000, concurrency=4)
+
+    assert first['status'] == 'paused'
+    assert first['last_telegram_id'] == 10
+    assert (first['sent'], first['blocked']) == (9, 1)
+    assert sorted(delivered_chat_ids(telegram)) == [chat_id for chat_id in range(1, 11) if chat_id != 7]
+    assert fetch_broadcast(db, broadcast_id) == {'status': 'paused', 'last_telegram_id': 10, 'sent': 9, 'failed': 0, 'blocked': 1}
+
+    second = bot.run_broadcast(broadcast_id, rate=1000, concurrency=4)
+
+    assert second['status'] == 'done'
+    assert sorted(delivered_chat_ids(telegram)) == [chat_id for chat_id in range(1, 26) if chat_id != 7]
+    assert fetch_broadcast(db, broadcast_id) == {'status': 'done', 'last_telegram_id': 25, 'sent': 24, 'failed': 0, 'blocked': 1}
+
+    cur = db.cursor()
+    cur.execute("SELECT telegram_id FROM telegram_users WHERE NOT notifications_enabled")
+    assert cur.fetchall() == [(7,)]
+    cur.close()
+
+
+def test_live_lease_blocks_second_runner_until_it_expires(bot, db, telegram):
+    add_users(db, range(1, 6))
+    broadcast_id = bot.create_broadcast('Новости')
+    cur = db.cursor()
+    cur.execute(
+        """UPDATE broadcasts
+           SET status = 'running', last_telegram_id = 2, lease_until = CURRENT_TIMESTAMP + INTERVAL '1 minute'
+           WHERE id = %s""",
+        (broadcast_id,)
+    )
+
+    assert bot.run_broadcast(broadcast_id, rate=1000)['status'] == 'not_claimed'
+    assert delivered_chat_ids(telegram) == []
+
+    cur.execute("UPDATE broadcasts SET lease_until = CURRENT_TIMESTAMP - INTERVAL '1 second' WHERE id = %s", (broadcast_id,))
+    cur.close()
+    result = bot.run_broadcast(broadcast_id, rate=1000)
+
+    assert result['status'] == 'done'
+    assert sorted(delivered_chat_ids(telegram)) == [3, 4, 5]
+    assert fetch_broadcast(db, broadcast_id)['last_telegram_id'] == 5
+
+
+def test_finished_broadcast_is_not_claimed_again(bot, db, telegram):
+    add_users(db, range(1, 4))
+    broadcast_id = bot.create_broadcast('Новости')
+
+    assert bot.run_broadcast(broadcast_id, rate=1000)['status'] == 'done'
+    assert bot.run_broadcast(broadcast_id, rate=1000)['status'] == 'not_claimed'
+    assert sorted(delivered_chat_ids(telegram)) == [1, 2, 3]
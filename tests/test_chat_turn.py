@@ -0,0 +1,190 @@
+"""
+Ход диалога на тестовой базе: сколько SQL-запросов стоит одно обычное сообщение,
+разбор буфера на историю и ожидающие ответа сообщения, debounce и кольцевой буфер
+"""
+import threading
+import time
+
+import psycopg2.extensions
+import pytest
+
+STATEMENTS = [
+    ('claim', 'INSERT INTO processed_updates'),
+    ('lock', 'pg_try_advisory_lock'),
+    ('unlock', 'pg_advisory_unlock'),
+    ('begin', 'WITH prev AS'),
+    ('load', 'JOIN chat_context'),
+    ('finish', "VALUES (%(telegram_id)s, 'assistant'"),
+]
+
+
+def statement_kind(query: str) -> str:
+    return next((kind for kind, marker in STATEMENTS if marker in query), query.split()[0])
+
+
+def recording_connection_class(log: list):
+    """
+    Соединение, курсоры которого записывают вид каждого execute в log
+    """
+    class RecordingConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+
+            class RecordingCursor(base):
+                def execute(self, query, vars=None):
+                    log.append(statement_kind(query))
+                    return super().execute(query, vars)
+
+            return super().cursor(*args, cursor_factory=RecordingCursor, **kwargs)
+
+    return RecordingConnection
+
+
+@pytest.fixture
+def load_bot(load_function, telegram, openai, database_url):
+    def load(**env):
+        return load_function(
+            'telegram-bot',
+            **{
+                'DATABASE_URL': database_url,
+                'TELEGRAM_API_URL': telegram.base_url,
+                'TELEGRAM_BOT_TOKEN': 'test',
+                'OPENAI_BASE_URL': openai.base_url,
+                'OPENAI_API_KEY': 'test',
+                'CHAT_DEBOUNCE_SECONDS': 0,
+                'REPLY_CACHE_ENABLED': 0,
+                'LLM_STREAMING': 0,
+                'TRACE_SAMPLE_RATE': 0,
+                **env,
+            }
+        )
+
+    return load
+
+
+@pytest.fixture
+def bot(load_bot):
+    return load_bot()
+
+
+@pytest.fixture
+def statements(bot):
+    log = []
+    bot._db_pool.connection_factory = recording_connection_class(log)
+    return log
+
+
+def chat_update(update_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {'chat': {'id': 42}, 'from': {'id': 42, 'first_name': 'Test'}, 'text': text},
+    }
+
+
+def test_chat_turn_runs_four_statements(bot, db, statements, telegram):
+    bot.run_chat_turn(42, 42, 'user42', 'Test', 'привет', update_id=1)
+    statements.clear()
+
+    bot.run_chat_turn(42, 42, 'user42', 'Test', 'как дела?', update_id=2)
+
+    assert statements == ['lock', 'begin', 'finish', 'unlock']
+    assert [request['text'] for method, request in telegram.requests if method == 'sendMessage'][-1]
+
+
+def test_chat_update_adds_only_the_dedup_claim(bot, db, statements):
+    bot.accept_update(chat_update(1, 'привет'))
+    statements.clear()
+
+    bot.accept_update(chat_update(2, 'как дела?'))
+    bot.accept_update(chat_update(2, 'как дела?'))
+
+    assert statements == ['claim', 'lock', 'begin', 'finish', 'unlock']
+
+
+def test_summary_is_folded_by_the_job_worker(load_bot, openai, db):
+    bot = load_bot(CHAT_HISTORY_WINDOW=2, SUMMARY_FOLD_BATCH=2, CONVERSATION_SUMMARY=1)
+    for update_id in range(1, 4):
+        bot.run_chat_turn(42, 42, 'user42', 'Test', f"сообщение {update_id}", update_id=update_id)
+
+    assert len(openai.requests) == 3
+    cur = db.cursor()
+    cur.execute("SELECT kind, payload FROM bot_jobs")
+    assert cur.fetchall() == [('fold_summary', {'telegram_id': 42})]
+
+    assert bot.run_worker(concurrency=1) == {'processed': 1, 'failed': 0}
+
+    cur.execute("SELECT conversation_summary, summary_upto_id FROM telegram_users WHERE telegram_id = 42")
+    assert cur.fetchone() == (openai.config['reply'], 4)
+    cur.close()
+
+
+def turn(turn_id: int, role: str, reply_to: int = None) -> dict:
+    return {'id': turn_id, 'role': role, 'content': str(turn_id), **({'reply_to': reply_to} if reply_to else {})}
+
+
+TURNS = [
+    turn(1, 'user'), turn(2, 'assistant', reply_to=1),
+    turn(3, 'user'), turn(4, 'user'), turn(5, 'assistant', reply_to=3),
+    turn(6, 'user'),
+]
+
+
+def ids(turns: list) -> list:
+    return [turn['id'] for turn in turns]
+
+
+@pytest.mark.parametrize('summary_upto_id, message_id, history, pending', [
+    (0, 4, [1, 2, 3, 5], [4]),
+    (2, 4, [3, 5], [4]),
+    (0, 6, [1, 2, 3, 5], [4, 6]),
+    (0, 3, [1, 2, 3, 5], []),
+])
+def test_split_pending_turns(load_function, summary_upto_id, message_id, history, pending):
+    bot = load_function('telegram-bot', TRACE_SAMPLE_RATE=0)
+    chat_history, pending_turns = bot.split_pending_turns(TURNS, summary_upto_id, message_id)
+
+    assert (ids(chat_history), ids(pending_turns)) == (history, pending)
+
+
+def test_split_without_replies_leaves_every_message_pending(load_function):
+    bot = load_function('telegram-bot', TRACE_SAMPLE_RATE=0)
+    chat_history, pending = bot.split_pending_turns([turn(1, 'user'), turn(2, 'user')], 0, 2)
+
+    assert (ids(chat_history), ids(pending)) == ([], [1, 2])
+
+
+def test_debounced_messages_get_one_merged_reply(load_bot, db, openai, telegram):
+    bot = load_bot(CHAT_DEBOUNCE_SECONDS=0.3)
+    first = threading.Thread(target=bot.run_chat_turn, args=(42, 42, 'user42', 'Test', 'первое', 1))
+    first.start()
+    time.sleep(0.05)
+    bot.run_chat_turn(42, 42, 'user42', 'Test', 'второе', 2)
+    first.join()
+
+    chat_requests = [request for path, request in openai.requests if path.endswith('/chat/completions')]
+    assert len(chat_requests) == 1
+    assert chat_requests[0]['messages'][-1] == {'role': 'user', 'content': 'первое\nвторое'}
+    assert len([1 for method, _ in telegram.requests if method == 'sendMessage']) == 1
+
+
+def test_chat_context_append_keeps_the_newest_turns(db):
+    cur = db.cursor()
+    cur.execute("SELECT chat_context_append('[1, 2, 3]'::jsonb, '4'::jsonb, 3), chat_context_append(NULL, '1'::jsonb, 3)")
+
+    assert cur.fetchone() == ([2, 3, 4], [1])
+    cur.close()
+
+
+def test_context_ring_buffer_is_trimmed_while_history_keeps_everything(load_bot, db):
+    bot = load_bot(CHAT_HISTORY_WINDOW=1, SUMMARY_FOLD_BATCH=1, CONVERSATION_SUMMARY=0)
+    for update_id in range(1, 4):
+        bot.run_chat_turn(42, 42, 'user42', 'Test', f"сообщение {update_id}", update_id=update_id)
+
+    cur = db.cursor()
+    cur.execute("SELECT turns FROM chat_context WHERE telegram_id = 42")
+    turns = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM chat_history WHERE telegram_id = 42")
+    assert cur.fetchone() == (6,)
+    cur.close()
+    assert bot.CHAT_CONTEXT_SIZE == 3
+    assert [(turn['id'], turn['role']) for turn in turns] == [(4, 'assistant'), (5, 'user'), (6, 'assistant')]
@@ -0,0 +1,36 @@
+"""
+Разбор команд и нормализация сообщений для кэша ответов
+"""
+import pytest
+
+
+@pytest.fixture
+def bot(load_function):
+    return load_function('telegram-bot', TELEGRAM_BOT_USERNAME='@AlinaBot', TRACE_SAMPLE_RATE=0)
+
+
+def test_command_addressed_to_this_bot_is_matched(bot):
+    assert bot.match_command('/photo@AlinaBot') == (bot.command_photo, 'photo', '')
+    assert bot.match_command('/start@alinabot') == (bot.command_start, 'command', '')
+    assert bot.match_command('/mode@AlinaBot flirty') == (bot.command_mode, 'command', 'flirty')
+
+
+def test_command_for_another_bot_or_without_argument_is_text(bot):
+    assert bot.match_command('/photo@OtherBot') is None
+    assert bot.match_command('/mode') is None
+    assert bot.match_command('/unknown') is None
+    assert bot.match_command('привет /start') is None
+
+
+def test_reply_cache_key_normalises_greetings(bot):
+    assert bot.reply_cache_key('Привет!!') == 'привет'
+    assert bot.reply_cache_key('  Как дела?  ') == 'как дела'
+    assert bot.reply_cache_key('Ещё привет') is None
+    assert bot.reply_cache_key('привет, расскажи что-нибудь интересное о себе') is None
+
+
+def test_reply_cache_key_accepts_only_real_emoji(bot):
+    assert bot.reply_cache_key('😊😊😊') == 'emoji:😊'
+    assert bot.reply_cache_key('❤️ 🔥') == 'emoji:❤🔥'
+    assert bot.reply_cache_key('))') is None
+    assert bot.reply_cache_key('¯\\_(ツ)_/¯') is None
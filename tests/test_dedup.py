@@ -0,0 +1,45 @@
+"""
+Дедупликация обновлений по update_id: память процесса, processed_updates и откат при ошибке
+"""
+import pytest
+
+
+@pytest.fixture
+def bot(load_function, database_url):
+    return load_function('telegram-bot', DATABASE_URL=database_url, TRACE_SAMPLE_RATE=0)
+
+
+def processed_update_ids(db) -> list:
+    cur = db.cursor()
+    cur.execute("SELECT update_id FROM processed_updates ORDER BY update_id")
+    rows = [row[0] for row in cur.fetchall()]
+    cur.close()
+    return rows
+
+
+def test_update_is_claimed_once_across_instances(bot, load_function, database_url, db):
+    assert bot.claim_update(7)
+    assert not bot.claim_update(7)
+
+    other_instance = load_function('telegram-bot', DATABASE_URL=database_url, TRACE_SAMPLE_RATE=0)
+    assert not other_instance.claim_update(7)
+    assert bot.claim_update(None) and bot.claim_update(None)
+    assert processed_update_ids(db) == [7]
+
+
+def test_failed_update_is_released_for_redelivery(bot, db, monkeypatch):
+    def fail(body):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(bot, 'process_update', fail)
+    with pytest.raises(RuntimeError):
+        bot.accept_update({'update_id': 8, 'message': {}})
+
+    assert processed_update_ids(db) == []
+    handled = []
+    monkeypatch.setattr(bot, 'process_update', handled.append)
+    bot.accept_update({'update_id': 8, 'message': {}})
+    bot.accept_update({'update_id': 8, 'message': {}})
+
+    assert [body['update_id'] for body in handled] == [8]
+    assert processed_update_ids(db) == [8]
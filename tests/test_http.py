@@ -0,0 +1,36 @@
+"""
+Повторы http_post: неидемпотентный sendMessage повторяется, только если запрос
+точно не дошёл до Telegram
+"""
+from urllib.parse import urlparse
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def bot(load_function, telegram):
+    return load_function(
+        'telegram-bot',
+        TELEGRAM_API_URL=telegram.base_url,
+        TELEGRAM_BOT_TOKEN='test',
+        HTTP_BACKOFF_BASE=0.01,
+        TRACE_SAMPLE_RATE=0,
+    )
+
+
+def test_send_message_is_not_retried_after_server_error(bot, telegram):
+    telegram.config['error_rate'] = 1.0
+
+    assert bot.send_telegram_message(42, 'привет') is None
+
+    stats = bot.get_http_stats()[urlparse(telegram.base_url).netloc]
+    assert (stats['requests'], stats['retries']) == (1, 0)
+
+
+def test_refused_connection_is_retried(bot):
+    with pytest.raises(requests.ConnectionError):
+        bot.http_post('telegram', 'http://127.0.0.1:1/botTEST/sendMessage', json={})
+
+    stats = bot.get_http_stats()['127.0.0.1:1']
+    assert (stats['requests'], stats['retries']) == (3, 2)
@@ -0,0 +1,102 @@
+"""
+Кэш file_id и запас фото generate-photo: варианты промпта выдаются по кругу, а запас
+пополняется только для запрошенных корзин и только на недостающие варианты кэша
+"""
+import json
+import time
+
+import pytest
+
+
+@pytest.fixture
+def photo(load_function, telegram, openai, database_url):
+    openai.config.update(image_url=None, image_ms=0)
+    return load_function(
+        'generate-photo',
+        DATABASE_URL=database_url,
+        TELEGRAM_API_URL=telegram.base_url,
+        TELEGRAM_BOT_TOKEN='test',
+        OPENAI_BASE_URL=openai.base_url,
+        OPENAI_API_KEY='test',
+        PHOTO_STREAM_UPLOAD=0,
+        PHOTO_CACHE_VARIANTS=2,
+        PHOTO_STOCK_HIGH_WATER=5,
+        PHOTO_CACHE_MAX_AGE_HOURS=24,
+        TRACE_SAMPLE_RATE=0,
+    )
+
+
+def request_photo(db, nsfw_enabled: bool = False, spicy_level: int = 0, style_variation: int = 1):
+    cur = db.cursor()
+    cur.execute(
+        "INSERT INTO photo_jobs (telegram_id, chat_id, style_variation, settings, status) VALUES (1, 1, %s, %s, 'sent')",
+        (style_variation, json.dumps({'nsfw_enabled': nsfw_enabled, 'spicy_level': spicy_level}))
+    )
+    cur.close()
+
+
+def generated_images(openai) -> int:
+    return sum(1 for path, _ in openai.requests if path.endswith('/images/generations'))
+
+
+def wait_refills(photo):
+    for _ in range(100):
+        if not photo.get_photo_stock_stats()['refilling']:
+            return
+        time.sleep(0.02)
+
+
+def sent_photos(telegram) -> list:
+    return [request['photo'] for method, request in telegram.requests if method == 'sendPhoto']
+
+
+def test_cached_variants_are_sent_least_recently_used_first(photo, db, openai, telegram):
+    prompt = photo.build_photo_prompt('casual', 1)
+
+    deliveries = [photo.deliver_photo(42, prompt, 'hi') for _ in range(5)]
+
+    assert [d['cached'] for d in deliveries] == [False, False, True, True, True]
+    assert sent_photos(telegram)[2:] == ['fake-file-1', 'fake-file-2', 'fake-file-1']
+    assert generated_images(openai) == 2
+
+
+def test_stale_variant_is_replaced_in_its_slot(photo, db, openai, telegram):
+    prompt = photo.build_photo_prompt('casual', 1)
+    for _ in range(2):
+        photo.deliver_photo(42, prompt, 'hi')
+    cur = db.cursor()
+    cur.execute("UPDATE photo_cache SET created_at = CURRENT_TIMESTAMP - INTERVAL '2 days' WHERE file_id = 'fake-file-1'")
+
+    assert not photo.deliver_photo(42, prompt, 'hi')['cached']
+    assert photo.deliver_photo(42, prompt, 'hi')['cached']
+
+    cur.execute("SELECT variant, file_id FROM photo_cache ORDER BY variant")
+    assert cur.fetchall() == [(0, 'fake-file-3'), (1, 'fake-file-2')]
+    cur.close()
+    assert generated_images(openai) == 3
+
+
+def test_prewarm_skips_buckets_nobody_requested(photo, db, openai):
+    assert photo.prewarm_photo_stock() == {}
+    assert generated_images(openai) == 0
+
+
+def test_prewarm_fills_only_missing_cache_variants(photo, db, openai):
+    request_photo(db)
+
+    assert photo.prewarm_photo_stock() == {'casual:1': 2}
+    assert generated_images(openai) == 2
+
+
+def test_stock_served_into_cache_is_not_regenerated(photo, db, openai, telegram):
+    request_photo(db)
+    photo.prewarm_photo_stock()
+    prompt = photo.build_photo_prompt('casual', 1)
+
+    deliveries = [photo.deliver_photo(42, prompt, 'hi', ('casual', 1)) for _ in range(3)]
+    wait_refills(photo)
+
+    assert [d['from_stock'] for d in deliveries] == [True, True, False]
+    assert [d['cached'] for d in deliveries] == [False, False, True]
+    assert photo.prewarm_photo_stock() == {'casual:1': 0}
+    assert generated_images(openai) == 2
@@ -0,0 +1,44 @@
+"""
+Long polling: обновление, которое не удалось обработать, переносится в bot_jobs
+и разбирается тем же поллером
+"""
+import pytest
+
+
+@pytest.fixture
+def bot(load_function, telegram, openai, database_url):
+    return load_function(
+        'telegram-bot',
+        DATABASE_URL=database_url,
+        TELEGRAM_API_URL=telegram.base_url,
+        TELEGRAM_BOT_TOKEN='test',
+        OPENAI_BASE_URL=openai.base_url,
+        OPENAI_API_KEY='test',
+        REPLY_CACHE_ENABLED=0,
+        TRACE_SAMPLE_RATE=0,
+    )
+
+
+def test_failed_update_is_requeued_and_drained_by_the_poller(bot, db, telegram, monkeypatch):
+    for chat_id in (1, 2, 3):
+        telegram.push_update({'chat': {'id': chat_id}, 'from': {'id': chat_id, 'first_name': 'Test'}, 'text': 'привет'})
+    accept_update = bot.accept_update
+
+    def flaky_accept_update(body):
+        if body['update_id'] == 2:
+            raise RuntimeError('boom')
+        accept_update(body)
+
+    monkeypatch.setattr(bot, 'accept_update', flaky_accept_update)
+
+    counters = bot.run_polling(concurrency=2, max_seconds=2)
+
+    assert (counters['processed'], counters['requeued'], counters['failed']) == (2, 1, 0)
+    assert (counters['jobs_processed'], counters['jobs_failed']) == (1, 0)
+    replied = {request['chat_id'] for method, request in telegram.requests if method == 'sendMessage'}
+    assert replied == {1, 2, 3}
+    assert telegram.pending_updates == 0
+    cur = db.cursor()
+    cur.execute("SELECT COUNT(*) FROM bot_jobs")
+    assert cur.fetchone() == (0,)
+    cur.close()
@@ -0,0 +1,56 @@
+"""
+Token bucket и выбор лимитов по тарифу в RateLimiter (local-режим)
+"""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def bot(load_function):
+    return load_function('telegram-bot', RATE_LIMIT_MODE='local', TRACE_SAMPLE_RATE=0)
+
+
+def allowed_in_a_row(limiter, traffic_class: str, telegram_id: int, tier) -> int:
+    allowed = 0
+    while limiter.allow(traffic_class, telegram_id, tier):
+        allowed += 1
+    return allowed
+
+
+def test_token_bucket_spends_burst_then_refills(bot):
+    bucket = bot.TokenBucket(rate=50, burst=3)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    time.sleep(0.05)
+    assert bucket.try_acquire()
+
+
+def test_paused_token_bucket_refuses_until_pause_ends(bot):
+    bucket = bot.TokenBucket(rate=1000, burst=5)
+    bucket.pause(0.05)
+
+    assert not bucket.try_acquire()
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.04
+
+
+def test_limits_follow_the_tier(bot):
+    limiter = bot.RateLimiter('local', 100)
+
+    assert allowed_in_a_row(limiter, 'chat', 1, 'free') == bot.RATE_LIMITS['chat']['free']['burst']
+    assert allowed_in_a_row(limiter, 'chat', 2, 'premium') == bot.RATE_LIMITS['chat']['premium']['burst']
+    assert allowed_in_a_row(limiter, 'photo', 1, 'free') == bot.RATE_LIMITS['photo']['free']['burst']
+    assert limiter.stats()['chat']['limited'] == 2
+
+
+def test_uncached_user_gets_the_tier_from_the_database(load_function, database_url, db):
+    bot = load_function('telegram-bot', DATABASE_URL=database_url, RATE_LIMIT_MODE='local', TRACE_SAMPLE_RATE=0)
+    cur = db.cursor()
+    cur.execute("INSERT INTO telegram_users (telegram_id, username, first_name, is_premium) VALUES (1, 'paid', 'Test', TRUE)")
+    cur.close()
+    limiter = bot.RateLimiter('local', 100)
+
+    assert allowed_in_a_row(limiter, 'chat', 1, None) == bot.RATE_LIMITS['chat']['premium']['burst']
+    assert allowed_in_a_row(limiter, 'chat', 2, None) == bot.RATE_LIMITS['chat']['free']['burst']
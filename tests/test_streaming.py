@@ -0,0 +1,118 @@
+"""
+Потоковые ответы и circuit breaker LLM на заглушках tools/fake_openai.py и tools/fake_telegram.py
+"""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def bot(load_function, telegram, openai):
+    return load_function(
+        'telegram-bot',
+        TELEGRAM_API_URL=telegram.base_url,
+        TELEGRAM_BOT_TOKEN='test',
+        OPENAI_BASE_URL=openai.base_url,
+        OPENAI_API_KEY='test',
+        STREAM_EDIT_INTERVAL=0,
+        LLM_BREAKER_FAILURES=2,
+        LLM_BREAKER_OPEN_SECONDS=0.2,
+        TRACE_SAMPLE_RATE=0,
+    )
+
+
+def telegram_calls(telegram, method: str) -> list:
+    return [request for name, request in telegram.requests if name == method]
+
+
+def test_streamed_reply_sends_first_sentence_then_edits(bot, telegram, openai):
+    openai.config['reply'] = 'Привет! Я так рада тебя слышать, как прошёл твой день?'
+
+    text = bot.deliver_streamed_reply(42, bot.stream_ai_response('привет', 'friendly', []))
+
+    assert text == openai.config['reply']
+    sent = telegram_calls(telegram, 'sendMessage')
+    assert [request['text'] for request in sent] == ['Привет!']
+    edits = telegram_calls(telegram, 'editMessageText')
+    assert edits and edits[-1]['text'] == text
+    assert all(edit['message_id'] == 1 for edit in edits)
+
+
+def test_short_stream_is_sent_once_without_edits(bot, telegram, openai):
+    openai.config['reply'] = 'Ага'
+
+    assert bot.deliver_streamed_reply(42, bot.stream_ai_response('ок', 'friendly', [])) == 'Ага'
+    assert [request['text'] for request in telegram_calls(telegram, 'sendMessage')] == ['Ага']
+    assert telegram_calls(telegram, 'editMessageText') == []
+
+
+def test_empty_stream_falls_back_to_error_text(bot, telegram, openai):
+    openai.config['reply'] = ''
+
+    text = bot.deliver_streamed_reply(42, bot.stream_ai_response('привет', 'friendly', []))
+
+    assert text.strip()
+    assert [request['text'] for request in telegram_calls(telegram, 'sendMessage')] == [text]
+    assert bot.get_llm_breaker_stats()['openai']['failures'] == 1
+
+
+def test_breaker_opens_after_failures_and_recovers_through_probe(bot, openai):
+    breaker = bot._llm_breakers['openai']
+    openai.config['error_rate'] = 1.0
+
+    for _ in range(2):
+        ''.join(bot.stream_ai_response('привет', 'friendly', []))
+    assert breaker.stats()['state'] == 'open'
+
+    requests_before = len(openai.requests)
+    reply = ''.join(bot.stream_ai_response('привет', 'friendly', []))
+    assert reply in bot.FALLBACK_RESPONSES['friendly']
+    assert len(openai.requests) == requests_before
+    assert breaker.stats()['rejected'] == 1
+
+    time.sleep(0.25)
+    openai.config['error_rate'] = 0.0
+    reply = ''.join(bot.stream_ai_response('привет', 'friendly', []))
+    assert reply == openai.config['reply']
+    assert breaker.stats()['state'] == 'closed'
+
+
+def test_failed_probe_reopens_breaker(bot, openai):
+    breaker = bot._llm_breakers['openai']
+    openai.config['error_rate'] = 1.0
+    for _ in range(2):
+        ''.join(bot.stream_ai_response('привет', 'friendly', []))
+
+    time.sleep(0.25)
+    ''.join(bot.stream_ai_response('привет', 'friendly', []))
+
+    stats = breaker.stats()
+    assert stats['state'] == 'open'
+    assert stats['trips'] == 2
+
+
+def test_closing_stream_early_releases_half_open_probe(bot, openai):
+    breaker = bot._llm_breakers['openai']
+    openai.config['error_rate'] = 1.0
+    for _ in range(2):
+        ''.join(bot.stream_ai_response('привет', 'friendly', []))
+    time.sleep(0.25)
+    openai.config['error_rate'] = 0.0
+
+    fragments = bot.stream_ai_response('привет', 'friendly', [])
+    next(fragments)
+    assert breaker.stats()['state'] == 'half_open'
+    fragments.close()
+
+    assert breaker.stats()['state'] == 'closed'
+    assert breaker.allow_request()
+
+
+@pytest.mark.parametrize('status', [401, 403, 404])
+def test_client_errors_count_as_llm_failures(bot, openai, status):
+    openai.config.update(error_rate=1.0, error_status=status)
+
+    ''.join(bot.stream_ai_response('привет', 'friendly', []))
+    assert bot.generate_ai_response('привет', 'friendly', [])
+
+    assert bot.get_llm_breaker_stats()['openai']['failures'] == 2
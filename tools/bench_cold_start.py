@@ -0,0 +1,149 @@
+"""
+Бенчмарк холодного старта обеих функций.
+
+Каждый замер идёт в свежем процессе Python: время импорта index.py, задержка первого
+и второго вызова handler для одного пути (OPTIONS, GET health-check, POST) и список
+тяжёлых модулей, которые к этому моменту оказались загружены. По каждому пути
+печатается медиана из --runs прогонов.
+
+    python tools/bench_cold_start.py --runs 7
+    DATABASE_URL=postgresql://localhost/bot_bench python tools/bench_cold_start.py --output cold.json
+
+Пути, которым нужна БД, запускаются только при заданном DATABASE_URL; исходящие вызовы
+Telegram уходят в локальную заглушку tools/fake_telegram.py.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ('psycopg2', 'requests', 'urllib3')
+
+# функция -> путь -> (event, нужна ли БД)
+PATHS = {
+    'telegram-bot': {
+        'options': ({'httpMethod': 'OPTIONS'}, False),
+        'health': ({'httpMethod': 'GET'}, False),
+        'post_ignored': ({'httpMethod': 'POST', 'body': json.dumps({'update_id': 1})}, False),
+        'post_command': ({'httpMethod': 'POST', 'body': json.dumps({
+            'update_id': 2,
+            'message': {
+                'message_id': 1,
+                'chat': {'id': 900001},
+                'from': {'id': 900001, 'first_name': 'Bench'},
+                'text': '/premium'
+            }
+        })}, True),
+    },
+    'generate-photo': {
+        'options': ({'httpMethod': 'OPTIONS'}, False),
+        'health': ({'httpMethod': 'GET'}, False),
+        'post_invalid': ({'httpMethod': 'POST', 'body': json.dumps({})}, False),
+        'job_status': ({'httpMethod': 'GET', 'queryStringParameters': {'job_id': '0'}}, True),
+    },
+}
+
+
+def run_child(function: str, path: str):
+    """
+    Выполняется в свежем процессе: импортирует функцию и дважды вызывает handler
+    """
+    import importlib.util
+
+    event, _ = PATHS[function][path]
+    started = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(function.replace('-', '_'), ROOT / 'backend' / function / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    imported = time.perf_counter()
+    response = module.handler(dict(event), None)
+    first = time.perf_counter()
+    module.handler(dict(event), None)
+    second = time.perf_counter()
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'first_call_ms': (first - imported) * 1000,
+        'second_call_ms': (second - first) * 1000,
+        'status': response.get('statusCode'),
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules]
+    }))
+
+
+def measure(function: str, path: str, env: dict) -> dict:
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, __file__, '--child', function, path],
+        env=env, capture_output=True, text=True, check=True
+    )
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample['process_ms'] = (time.perf_counter() - started) * 1000
+    return sample
+
+
+def summarize(samples: list) -> dict:
+    summary = {
+        key: round(statistics.median(sample[key] for sample in samples), 2)
+        for key in ('process_ms', 'import_ms', 'first_call_ms', 'second_call_ms')
+    }
+    summary['status'] = samples[-1]['status']
+    summary['heavy_modules'] = samples[-1]['heavy_modules']
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time and first-invocation latency per handler path')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per path')
+    parser.add_argument('--function', choices=sorted(PATHS), action='append', help='limit to one function (repeatable)')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--child', nargs=2, metavar=('FUNCTION', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import fake_telegram
+
+    telegram = fake_telegram.start_server(rate=0, latency_ms=0)
+    env = {
+        **os.environ,
+        'TELEGRAM_API_URL': telegram.base_url,
+        'TELEGRAM_BOT_TOKEN': os.environ.get('TELEGRAM_BOT_TOKEN', 'bench'),
+        'TRACE_SAMPLE_RATE': '0',
+        'WEBHOOK_MODE': 'sync',
+    }
+    has_db = bool(os.environ.get('DATABASE_URL'))
+
+    report = {}
+    for function in args.function or PATHS:
+        for path, (_, needs_db) in PATHS[function].items():
+            if needs_db and not has_db:
+                report[f"{function}:{path}"] = {'skipped': 'DATABASE_URL is not set'}
+                continue
+            report[f"{function}:{path}"] = summarize([measure(function, path, env) for _ in range(args.runs)])
+
+    telegram.shutdown()
+
+    for name, summary in report.items():
+        if 'skipped' in summary:
+            print(f"{name:32} skipped: {summary['skipped']}")
+            continue
+        print(
+            f"{name:32} process {summary['process_ms']:7.1f} ms  import {summary['import_ms']:6.1f} ms  "
+            f"first {summary['first_call_ms']:7.1f} ms  second {summary['second_call_ms']:6.1f} ms  "
+            f"status {summary['status']}  loaded: {', '.join(summary['heavy_modules']) or '-'}"
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
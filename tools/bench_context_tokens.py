@@ -0,0 +1,123 @@
+"""
+Бенчмарк размера контекста LLM на длинных синтетических диалогах.
+
+Прогоняет ход за ходом логику telegram-bot (выборка несвёрнутой истории, упаковка
+по бюджету токенов, свёртка в summary) поверх in-memory истории и локальной
+заглушки OpenAI, и сравнивает с наивным вариантом "вся история в промпт".
+
+    python tools/bench_context_tokens.py --turns 500 --dialogues 3 --output tokens.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_openai
+
+USER_LINES = [
+    'Привет! Как прошёл твой день?',
+    'Я сегодня был на работе до вечера, очень устал 😅',
+    'Расскажи, что ты любишь делать по выходным?',
+    'Я недавно начал учиться играть на гитаре',
+    'Завтра у меня важная встреча, немного волнуюсь',
+    'Какую музыку ты слушаешь?',
+    'Мы с друзьями собираемся в поход в горы на следующей неделе',
+    'Ха-ха, ты смешная',
+    'А ты помнишь, что я рассказывал про свою собаку?',
+]
+
+
+def load_bot_module():
+    spec = importlib.util.spec_from_file_location('telegram_bot', ROOT / 'backend' / 'telegram-bot' / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def prompt_tokens(bot, messages: list) -> int:
+    return sum(bot.estimate_tokens(m['content']) for m in messages)
+
+
+def run_dialogue(bot, turns: int, rng: random.Random, checkpoints: set) -> dict:
+    personality = bot.PERSONALITIES['friendly']
+    rows = []
+    summary = None
+    summary_upto_id = 0
+    folds = 0
+    packed_series = []
+    naive_series = []
+
+    for turn in range(1, turns + 1):
+        user_message = rng.choice(USER_LINES) + ' ' + ' '.join(rng.choice(USER_LINES).split()[:rng.randint(0, 6)])
+        unsummarized = [r for r in rows if r['id'] > summary_upto_id]
+        chat_history = unsummarized[-(bot.CHAT_HISTORY_WINDOW + bot.SUMMARY_FOLD_BATCH):]
+
+        packed = prompt_tokens(bot, bot.build_llm_messages(personality, chat_history, user_message, summary))
+        naive = prompt_tokens(bot, [{'content': personality['system']}] + rows + [{'content': user_message}])
+        packed_series.append(packed)
+        naive_series.append(naive)
+        if turn in checkpoints:
+            print(f"turn {turn:>6}: packed+summary {packed:>6} tokens | full history {naive:>8} tokens")
+
+        rows.append({'id': len(rows) + 1, 'role': 'user', 'content': user_message})
+        rows.append({'id': len(rows) + 1, 'role': 'assistant', 'content': fake_openai.DEFAULT_REPLY})
+
+        to_fold = bot.select_turns_to_fold(chat_history)
+        if to_fold:
+            new_summary = bot.summarize_turns(summary, to_fold)
+            if new_summary:
+                summary = new_summary
+                summary_upto_id = to_fold[-1]['id']
+                folds += 1
+
+    tail = packed_series[len(packed_series) // 2:]
+    return {
+        'turns': turns,
+        'folds': folds,
+        'packed_max': max(packed_series),
+        'packed_mean_second_half': round(sum(tail) / len(tail), 1),
+        'naive_last': naive_series[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prompt tokens per turn over long synthetic dialogues')
+    parser.add_argument('--turns', type=int, default=300)
+    parser.add_argument('--dialogues', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    args = parser.parse_args()
+
+    server = fake_openai.start_server(first_token_ms=0, token_ms=0)
+    os.environ.setdefault('DATABASE_URL', 'postgresql://unused')
+    os.environ['OPENAI_API_KEY'] = 'bench'
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    bot = load_bot_module()
+
+    rng = random.Random(args.seed)
+    checkpoints = {1, 10, 25, 50, 100, 200, 500, 1000, 2000, args.turns}
+    results = []
+    for index in range(args.dialogues):
+        print(f"dialogue {index + 1}/{args.dialogues}")
+        results.append(run_dialogue(bot, args.turns, rng, checkpoints))
+
+    report = {
+        'context_token_budget': bot.CONTEXT_TOKEN_BUDGET,
+        'history_window': bot.CHAT_HISTORY_WINDOW,
+        'fold_batch': bot.SUMMARY_FOLD_BATCH,
+        'dialogues': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
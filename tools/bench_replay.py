@@ -0,0 +1,464 @@
+"""
+Replay-бенчмарк обеих функций на локальных заглушках Telegram и OpenAI и локальном Postgres.
+
+Прогоняет трейс обновлений Telegram (записанный JSONL или синтетический) через handler
+telegram-bot, а запросы к генерации фото - через handler generate-photo, поднятый на
+локальном HTTP-сервере вместо PHOTO_SERVICE_URL. Для каждого вызова считает задержку,
+SQL-запросы и выдачи соединений из пула, исходящие HTTP-вызовы по сервисам и пишет
+сводку p50/p95/p99 в JSON, который можно сравнить с прошлым прогоном через --compare.
+
+    createdb bot_bench
+    DATABASE_URL=postgresql://localhost/bot_bench python tools/bench_replay.py --apply-migrations \\
+        --users 50 --messages 20 --concurrency 8 --output bench.json
+    DATABASE_URL=... python tools/bench_replay.py --trace updates.jsonl --compare bench.json
+
+Прогон завершается с кодом 1, если обычное сообщение в среднем стоит больше
+--max-chat-statements SQL-запросов (claim update, блокировка, начало и конец хода, unlock).
+
+Строка трейса - это update Telegram ({"update_id": ..., "message": {...}}) или прямой
+запрос к generate-photo: {"function": "generate-photo", "body": {"telegram_id": ..., "chat_id": ...}}.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlparse
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_openai
+import fake_telegram
+
+CHAT_LINES = [
+    'Привет! Как прошёл твой день?',
+    'Я сегодня был на работе до вечера, очень устал 😅',
+    'Расскажи, что ты любишь делать по выходным?',
+    'Какую музыку ты слушаешь?',
+    'Ха-ха, ты смешная',
+    'Спокойной ночи 💕',
+]
+COMMANDS = ['/profile', '/settings', '/mode flirty', '/mode friendly', '/premium']
+
+_local = threading.local()
+
+
+def count(name: str, amount: int = 1):
+    counts = getattr(_local, 'counts', None)
+    if counts is not None:
+        counts[name] += amount
+
+
+_counting_cursors = {}
+_counting_cursors_lock = threading.Lock()
+
+
+def counting_cursor_class(base):
+    """
+    Подкласс курсора (обычного, RealDictCursor, серверного), который считает execute
+    в счётчик текущего потока
+    """
+    with _counting_cursors_lock:
+        cls = _counting_cursors.get(base)
+        if cls is None:
+            class CountingCursor(base):
+                def execute(self, query, vars=None):
+                    count('db_statements')
+                    return super().execute(query, vars)
+
+                def executemany(self, query, vars_list):
+                    count('db_statements')
+                    return super().executemany(query, vars_list)
+
+                def copy_expert(self, sql, file, size=8192):
+                    count('db_statements')
+                    return super().copy_expert(sql, file, size)
+
+            cls = _counting_cursors[base] = CountingCursor
+        return cls
+
+
+def make_counting_connection_class():
+    import psycopg2.extensions
+
+    class CountingConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+            return super().cursor(*args, cursor_factory=counting_cursor_class(base), **kwargs)
+
+    return CountingConnection
+
+
+def load_function(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), ROOT / 'backend' / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def instrument(module, connection_class, hosts: dict):
+    """
+    Счётчики без подмены логики: фабрика соединений пула и response-хук общей HTTP-сессии
+    """
+    module._db_pool.connection_factory = connection_class
+
+    original_getconn = module._db_pool.getconn
+
+    def getconn():
+        count('db_checkouts')
+        return original_getconn()
+
+    module._db_pool.getconn = getconn
+
+    def on_response(response, *args, **kwargs):
+        count('http:' + hosts.get(urlparse(response.url).netloc, urlparse(response.url).netloc))
+
+    module.http_session().hooks['response'].append(on_response)
+
+
+def apply_migrations(database_url: str):
+    import psycopg2
+
+    def version(path: Path) -> int:
+        return int(path.name.split('__', 1)[0].lstrip('V'))
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    for path in sorted((ROOT / 'db_migrations').glob('V*.sql'), key=version):
+        cur.execute(path.read_text(encoding='utf-8'))
+    cur.close()
+    conn.close()
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+        self.in_flight = 0
+
+    def call(self, target: str, kind: str, fn):
+        with self._lock:
+            self.in_flight += 1
+        _local.counts = Counter()
+        started = time.perf_counter()
+        try:
+            result = fn()
+            status = result.get('statusCode', 200)
+        except Exception as e:
+            result, status = None, f"exception:{type(e).__name__}"
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        counts, _local.counts = _local.counts, None
+        with self._lock:
+            self.in_flight -= 1
+            self.samples.append({'target': target, 'kind': kind, 'ms': elapsed_ms, 'status': status, 'counts': counts})
+        return result
+
+
+class FunctionServer(ThreadingHTTPServer):
+    """
+    Поднимает handler функции на HTTP, как это делает платформа, и записывает каждый вызов
+    """
+    daemon_threads = True
+
+    def __init__(self, address, module, recorder: Recorder):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _invoke(self, method: str):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else '{}'
+                parsed = urlparse(self.path)
+                event = {
+                    'httpMethod': method,
+                    'headers': dict(self.headers),
+                    'queryStringParameters': dict(parse_qsl(parsed.query)),
+                    'body': body
+                }
+                try:
+                    kind = json.loads(body).get('action') or 'request'
+                except ValueError:
+                    kind = 'request'
+                result = recorder.call(server.name, kind, lambda: module.handler(event, None)) or {
+                    'statusCode': 500, 'body': '{}'
+                }
+                payload = (result.get('body') or '').encode('utf-8')
+                self.send_response(result.get('statusCode', 200))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                self._invoke('POST')
+
+            def do_GET(self):
+                self._invoke('GET')
+
+        super().__init__(address, Handler)
+        self.name = 'generate-photo'
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/"
+
+
+def synthetic_trace(users: int, messages: int, photo_share: float, command_share: float, seed: int) -> list:
+    """
+    Каждый пользователь начинает с /start, дальше - случайная смесь сообщений, команд и /photo.
+    Потоки пользователей перемешаны, но порядок внутри пользователя сохраняется.
+    """
+    rng = random.Random(seed)
+    base_update_id = int(time.time()) * 1000
+    per_user = []
+    for index in range(users):
+        telegram_id = 700000000 + index
+        texts = ['/start']
+        for _ in range(messages):
+            roll = rng.random()
+            if roll < photo_share:
+                texts.append('/photo')
+            elif roll < photo_share + command_share:
+                texts.append(rng.choice(COMMANDS))
+            else:
+                texts.append(rng.choice(CHAT_LINES))
+        per_user.append([(telegram_id, text) for text in texts])
+
+    trace = []
+    while per_user:
+        queue = rng.choice(per_user)
+        telegram_id, text = queue.pop(0)
+        if not queue:
+            per_user.remove(queue)
+        trace.append({
+            'update_id': base_update_id + len(trace),
+            'message': {
+                'message_id': len(trace) + 1,
+                'date': int(time.time()),
+                'chat': {'id': telegram_id, 'type': 'private'},
+                'from': {'id': telegram_id, 'first_name': f"Bench{telegram_id % 1000}", 'username': f"bench{telegram_id}"},
+                'text': text
+            }
+        })
+    return trace
+
+
+def load_trace(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def update_kind(update: dict) -> str:
+    text = (update.get('message') or {}).get('text', '')
+    if text.startswith('/photo'):
+        return 'photo'
+    if text.startswith('/'):
+        return 'command'
+    return 'chat'
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def summarize(samples: list) -> dict:
+    latencies = [sample['ms'] for sample in samples]
+    totals = Counter()
+    for sample in samples:
+        totals.update(sample['counts'])
+    n = max(1, len(samples))
+    return {
+        'count': len(samples),
+        'errors': sum(1 for sample in samples if sample['status'] != 200),
+        'latency_ms': {
+            'mean': round(sum(latencies) / n, 1),
+            'p50': round(percentile(latencies, 0.50), 1),
+            'p95': round(percentile(latencies, 0.95), 1),
+            'p99': round(percentile(latencies, 0.99), 1),
+            'max': round(max(latencies, default=0.0), 1)
+        },
+        'db_statements_per_update': round(totals['db_statements'] / n, 2),
+        'db_checkouts_per_update': round(totals['db_checkouts'] / n, 2),
+        'http_calls_per_update': {
+            key.split(':', 1)[1]: round(value / n, 2) for key, value in sorted(totals.items()) if key.startswith('http:')
+        }
+    }
+
+
+def build_report(recorder: Recorder, wall_seconds: float, modules: dict, config: dict, fakes: dict) -> dict:
+    targets = {}
+    for target in sorted({sample['target'] for sample in recorder.samples}):
+        samples = [sample for sample in recorder.samples if sample['target'] == target]
+        targets[target] = {
+            'all': summarize(samples),
+            'by_kind': {
+                kind: summarize([sample for sample in samples if sample['kind'] == kind])
+                for kind in sorted({sample['kind'] for sample in samples})
+            }
+        }
+    bot_updates = targets.get('telegram-bot', {}).get('all', {}).get('count', 0)
+    return {
+        'config': config,
+        'wall_seconds': round(wall_seconds, 2),
+        'throughput_per_second': round(bot_updates / wall_seconds, 2) if wall_seconds else 0.0,
+        'targets': targets,
+        'db_pool': {name: module.get_db_pool_stats() for name, module in modules.items()},
+        'fakes': fakes
+    }
+
+
+def compare(report: dict, baseline: dict):
+    print(f"{'target/kind':32} {'p50':>16} {'p95':>16} {'stmts/upd':>14}")
+    for target, data in report['targets'].items():
+        for kind, stats in [('all', data['all'])] + list(data['by_kind'].items()):
+            old = baseline.get('targets', {}).get(target, {})
+            old = old.get('all') if kind == 'all' else old.get('by_kind', {}).get(kind)
+            if not old:
+                continue
+            cells = []
+            for new_value, old_value in (
+                (stats['latency_ms']['p50'], old['latency_ms']['p50']),
+                (stats['latency_ms']['p95'], old['latency_ms']['p95']),
+                (stats['db_statements_per_update'], old['db_statements_per_update'])
+            ):
+                delta = (new_value - old_value) / old_value * 100 if old_value else 0.0
+                cells.append(f"{new_value:>8} ({delta:+5.0f}%)")
+            print(f"{target + '/' + kind:32} {cells[0]:>16} {cells[1]:>16} {cells[2]:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Telegram update traces through both functions')
+    parser.add_argument('--trace', help='JSONL file with Telegram updates; synthetic trace if omitted')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=10, help='updates per user after /start')
+    parser.add_argument('--photo-share', type=float, default=0.05)
+    parser.add_argument('--command-share', type=float, default=0.15)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--apply-migrations', action='store_true', help='run db_migrations/*.sql first (empty database only)')
+    parser.add_argument('--openai-first-token-ms', type=float, default=300)
+    parser.add_argument('--openai-token-ms', type=float, default=20)
+    parser.add_argument('--openai-image-ms', type=float, default=2000)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-image-bytes', type=int, default=0, help='serve generated images of this size from the fake instead of a placeholder URL')
+    parser.add_argument('--telegram-latency-ms', type=float, default=30)
+    parser.add_argument('--telegram-rate', type=float, default=0, help='fake Telegram global rate limit, 0 disables it')
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='previous JSON report to diff against')
+    parser.add_argument('--max-chat-statements', type=float, default=6, help='fail if a chat update averages more SQL statements, 0 disables the check')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        parser.error('DATABASE_URL must point to a local Postgres database')
+    if args.apply_migrations:
+        apply_migrations(os.environ['DATABASE_URL'])
+
+    openai = fake_openai.start_server(
+        first_token_ms=args.openai_first_token_ms,
+        token_ms=args.openai_token_ms,
+        image_ms=args.openai_image_ms,
+        error_rate=args.openai_error_rate,
+        **({'image_url': None, 'image_bytes': args.openai_image_bytes} if args.openai_image_bytes else {})
+    )
+    telegram = fake_telegram.start_server(
+        rate=args.telegram_rate,
+        latency_ms=args.telegram_latency_ms,
+        error_rate=args.telegram_error_rate
+    )
+
+    os.environ.update(TELEGRAM_API_URL=telegram.base_url, OPENAI_BASE_URL=openai.base_url)
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'bench')
+    os.environ.setdefault('OPENAI_API_KEY', 'bench')
+    os.environ.setdefault('RATE_LIMIT_MODE', 'off')
+    os.environ.setdefault('ADMIN_TOKEN', 'bench')
+
+    recorder = Recorder()
+    photo = load_function('generate-photo')
+    photo_server = FunctionServer(('127.0.0.1', 0), photo, recorder)
+    threading.Thread(target=photo_server.serve_forever, daemon=True).start()
+    os.environ['PHOTO_SERVICE_URL'] = photo_server.base_url
+    bot = load_function('telegram-bot')
+
+    hosts = {
+        urlparse(telegram.base_url).netloc: 'telegram',
+        urlparse(openai.base_url).netloc: 'openai',
+        urlparse(photo_server.base_url).netloc: 'photo_service'
+    }
+    connection_class = make_counting_connection_class()
+    instrument(bot, connection_class, hosts)
+    instrument(photo, connection_class, hosts)
+
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(
+        args.users, args.messages, args.photo_share, args.command_share, args.seed
+    )
+
+    def replay(item: dict):
+        if item.get('function') == 'generate-photo':
+            event = {'httpMethod': 'POST', 'body': json.dumps(item['body'])}
+            recorder.call('generate-photo', 'direct', lambda: photo.handler(event, None))
+        else:
+            event = {'httpMethod': 'POST', 'body': json.dumps(item)}
+            recorder.call('telegram-bot', update_kind(item), lambda: bot.handler(event, None))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(replay, trace))
+    bot_wall = time.monotonic() - started
+
+    while recorder.in_flight:
+        time.sleep(0.1)
+
+    report = build_report(
+        recorder,
+        bot_wall,
+        {'telegram-bot': bot, 'generate-photo': photo},
+        {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        {
+            'openai_requests': len(openai.requests),
+            'telegram_requests': len(telegram.requests),
+            'telegram_rejected_429': telegram.rejected
+        }
+    )
+
+    print(json.dumps({'wall_seconds': report['wall_seconds'], 'throughput_per_second': report['throughput_per_second']}))
+    for target, data in report['targets'].items():
+        for kind, stats in data['by_kind'].items():
+            latency = stats['latency_ms']
+            print(
+                f"{target}/{kind}: n={stats['count']} errors={stats['errors']} "
+                f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms "
+                f"sql={stats['db_statements_per_update']} checkouts={stats['db_checkouts_per_update']} "
+                f"http={stats['http_calls_per_update']}"
+            )
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    chat = report['targets'].get('telegram-bot', {}).get('by_kind', {}).get('chat')
+    if args.max_chat_statements and chat and chat['db_statements_per_update'] > args.max_chat_statements:
+        sys.exit(f"chat turn averages {chat['db_statements_per_update']} SQL statements, budget is {args.max_chat_statements}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Локальная заглушка OpenAI API для тестов и бенчмарков.
+
+Отдаёт /v1/chat/completions (обычный ответ и SSE-поток при "stream": true)
+и /v1/images/generations с настраиваемыми задержками и долей ошибок. С --serve-images
+ссылки на картинки ведут на сам сервер: GET /files/<имя> отдаёт image_bytes байт
+по частям, как CDN с результатами генерации.
+
+    python tools/fake_openai.py --port 8081 --first-token-ms 300 --token-ms 40
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 OPENAI_API_KEY=test LLM_STREAMING=1 ...
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = 'Привет! Я так рада тебя слышать 😊 Как прошёл твой день? Расскажи мне всё-всё!'
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeOpenAI/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.path.startswith('/files/'):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+        size = self.server.config['image_bytes']
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        chunk = bytes(range(256)) * 256
+        while size > 0:
+            self.wfile.write(chunk[:size])
+            size -= len(chunk)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        config = self.server.config
+        self.server.record(self.path, request)
+
+        if random.random() < config['error_rate']:
+            time.sleep(config['first_token_ms'] / 1000)
+            self._send_json(config['error_status'], {'error': {'message': 'fake upstream error'}})
+            return
+
+        if self.path.endswith('/chat/completions'):
+            self._chat(request, config)
+        elif self.path.endswith('/images/generations'):
+            time.sleep(config['image_ms'] / 1000)
+            self._send_json(200, {'data': [{'url': config['image_url'] or self.server.next_image_url()}]})
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def _chat(self, request: dict, config: dict):
+        reply = config['reply']
+        time.sleep(config['first_token_ms'] / 1000)
+        usage = {'prompt_tokens': sum(len(m.get('content', '')) // 4 for m in request.get('messages', []))}
+
+        if not request.get('stream'):
+            time.sleep(config['token_ms'] * len(reply.split()) / 1000)
+            self._send_json(200, {
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                'usage': usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        words = reply.split(' ')
+        for index, word in enumerate(words):
+            piece = word if index == 0 else ' ' + word
+            chunk = {'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(config['token_ms'] / 1000)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, **config):
+        super().__init__(address, FakeOpenAIHandler)
+        self.config = {
+            'reply': DEFAULT_REPLY,
+            'first_token_ms': 300,
+            'token_ms': 40,
+            'image_ms': 2000,
+            'image_url': 'https://via.placeholder.com/1024x1024.png?text=Fake+Photo',
+            'image_bytes': 1024 * 1024,
+            'error_rate': 0.0,
+            'error_status': 500,
+            **config
+        }
+        self.requests = []
+        self._lock = threading.Lock()
+        self._images = 0
+
+    def next_image_url(self) -> str:
+        with self._lock:
+            self._images += 1
+            return f"http://{self.server_address[0]}:{self.server_address[1]}/files/image-{self._images}.png"
+
+    def record(self, path: str, request: dict):
+        with self._lock:
+            self.requests.append((path, request))
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+
+def start_server(host: str = '127.0.0.1', port: int = 0, **config) -> FakeOpenAIServer:
+    server = FakeOpenAIServer((host, port), **config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OpenAI stand-in with SSE streaming')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--first-token-ms', type=float, default=300)
+    parser.add_argument('--token-ms', type=float, default=40)
+    parser.add_argument('--image-ms', type=float, default=2000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of the injected errors')
+    parser.add_argument('--serve-images', action='store_true', help='return image URLs served by this process instead of a placeholder')
+    parser.add_argument('--image-bytes', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        (args.host, args.port),
+        first_token_ms=args.first_token_ms,
+        token_ms=args.token_ms,
+        image_ms=args.image_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        image_bytes=args.image_bytes,
+        **({'image_url': None} if args.serve_images else {})
+    )
+    print(f"Fake OpenAI listening on {server.base_url}")
+    server.serve_forever()
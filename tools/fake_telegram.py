@@ -0,0 +1,226 @@
+"""
+Локальная заглушка Telegram Bot API для тестов и бенчмарков.
+
+Принимает /bot<token>/sendMessage, editMessageText и sendPhoto (по URL, file_id или
+multipart-загрузкой файла, в том числе chunked), ограничивает
+общий темп отправки как Telegram (429 с parameters.retry_after) и отвечает 403
+для чатов, заблокировавших бота. getUpdates отдаёт обновления, добавленные
+через push_update(), с long polling и подтверждением по offset.
+
+    python tools/fake_telegram.py --port 8082 --rate 30 --blocked 42,43
+    TELEGRAM_API_URL=http://127.0.0.1:8082 TELEGRAM_BOT_TOKEN=test python backend/telegram-bot/index.py broadcast --text "..."
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_multipart(raw: bytes, boundary: str) -> dict:
+    """
+    Поля формы как строки (chat_id - числом), у файлов - только размер в '<поле>_bytes'
+    """
+    fields = {'_raw_bytes': len(raw)}
+    for part in raw.split(b'--' + boundary.encode())[1:-1]:
+        headers, _, value = part[2:-2].partition(b'\r\n\r\n')
+        disposition = headers.decode('utf-8').split('\r\n')[0]
+        name = disposition.split('name="', 1)[1].split('"', 1)[0]
+        if 'filename="' in disposition:
+            fields[f"{name}_bytes"] = len(value)
+        else:
+            fields[name] = value.decode('utf-8')
+    if str(fields.get('chat_id', '')).lstrip('-').isdigit():
+        fields['chat_id'] = int(fields['chat_id'])
+    return fields
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeTelegram/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunk = self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_request(self) -> dict:
+        raw = self._read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(raw or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            return parse_multipart(raw, content_type.split('boundary=', 1)[1])
+        return {'_raw_bytes': len(raw)}
+
+    def do_POST(self):
+        request = self._read_request()
+        method = self.path.rsplit('/', 1)[-1]
+        config = self.server.config
+
+        if method == 'getUpdates':
+            updates = self.server.wait_updates(request.get('offset'), request.get('limit') or 100, request.get('timeout') or 0)
+            self._send_json(200, {'ok': True, 'result': updates})
+            return
+        if method == 'deleteWebhook':
+            self._send_json(200, {'ok': True, 'result': True})
+            return
+
+        time.sleep(config['latency_ms'] / 1000)
+
+        retry_after = self.server.take_slot()
+        if retry_after:
+            self._send_json(429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after}
+            })
+            return
+
+        if random.random() < config['error_rate']:
+            self._send_json(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+            return
+
+        chat_id = request.get('chat_id')
+        if chat_id in config['blocked']:
+            self._send_json(403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'})
+            return
+
+        if method in ('sendMessage', 'sendPhoto'):
+            message = self.server.record(method, request)
+            self._send_json(200, {'ok': True, 'result': message})
+        elif method == 'editMessageText':
+            self.server.record(method, request)
+            self._send_json(200, {'ok': True, 'result': {'message_id': request.get('message_id'), 'chat': {'id': chat_id}}})
+        else:
+            self._send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, **config):
+        super().__init__(address, FakeTelegramHandler)
+        self.config = {
+            'rate': 30.0,
+            'retry_after': 1,
+            'latency_ms': 20,
+            'error_rate': 0.0,
+            'blocked': set(),
+            **config
+        }
+        self.config['blocked'] = set(self.config['blocked'])
+        self.requests = []
+        self.rejected = 0
+        self._window = deque()
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._updates = []
+        self._next_update_id = 1
+        self._updates_changed = threading.Condition(self._lock)
+
+    def push_update(self, message: dict) -> int:
+        """
+        Кладёт входящее сообщение в очередь getUpdates и возвращает его update_id
+        """
+        with self._updates_changed:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append({'update_id': update_id, 'message': message})
+            self._updates_changed.notify_all()
+            return update_id
+
+    def wait_updates(self, offset, limit: int, timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        with self._updates_changed:
+            if offset is not None:
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_changed.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    @property
+    def pending_updates(self) -> int:
+        with self._lock:
+            return len(self._updates)
+
+    def take_slot(self) -> int:
+        """
+        Скользящее окно в одну секунду. Возвращает retry_after, если лимит превышен.
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 1.0:
+                self._window.popleft()
+            if self.config['rate'] and len(self._window) >= self.config['rate']:
+                self.rejected += 1
+                return self.config['retry_after']
+            self._window.append(now)
+            return 0
+
+    def record(self, method: str, request: dict) -> dict:
+        with self._lock:
+            self._message_id += 1
+            self.requests.append((method, request))
+            return {
+                'message_id': self._message_id,
+                'chat': {'id': request.get('chat_id')},
+                'date': int(time.time()),
+                'text': request.get('text'),
+                'photo': [{'file_id': f"fake-file-{self._message_id}"}] if method == 'sendPhoto' else None
+            }
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+def start_server(host: str = '127.0.0.1', port: int = 0, **config) -> FakeTelegramServer:
+    server = FakeTelegramServer((host, port), **config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Telegram Bot API stand-in with rate limiting')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--rate', type=float, default=30.0, help='accepted requests per second, 0 disables the limit')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--blocked', default='', help='comma-separated chat ids that answer 403')
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(
+        (args.host, args.port),
+        rate=args.rate,
+        retry_after=args.retry_after,
+        latency_ms=args.latency_ms,
+        error_rate=args.error_rate,
+        blocked={int(chat_id) for chat_id in args.blocked.split(',') if chat_id}
+    )
+    print(f"Fake Telegram listening on {server.base_url}")
+    server.serve_forever()